@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+"""
+Benchmark cho Remote Control Service (system-control.py)
+Chạy service thật trên loopback (process riêng) với temp directories thay cho
+ALLOWED_EXTENSIONS và systemctl/sudo giả, rồi đo:
+  - upload MB/s và peak RSS của service theo kích thước file, theo từng kiểu upload
+  - p50/p99 latency của ping, list_files, list_services
+  - throughput/latency khi có N clients đồng thời
+Kết quả ghi ra JSON để so sánh giữa các lần chạy.
+
+    python3 bench-system-control.py --sizes 1,8,32 --clients 1,4,8 --output bench.json
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import platform
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+SERVICE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'system-control.py')
+
+# Protocol constants (giống system-control.py)
+FRAME_MAGIC = 0xFF
+FRAME_HEADER = struct.Struct('>BBI')
+FRAME_JSON = 1
+FRAME_UPLOAD_CHUNK = 2
+UPLOAD_CHUNK_HEADER = struct.Struct('>16sQ')
+CHUNK_SIZE = 64 * 1024
+
+STUB_UNITS = 20  # Số .service giả trong thư mục systemd tạm
+START_TIMEOUT = 15
+RESPONSE_TIMEOUT = 300
+
+STUB_SYSTEMCTL = """#!/bin/sh
+# systemctl giả cho benchmark: show trả về trạng thái cố định, các lệnh khác thành công
+case "$1" in
+  is-active) echo active;;
+  is-enabled) echo enabled;;
+  show)
+    shift; first=1
+    for u in "$@"; do
+      case "$u" in --*) continue;; esac
+      [ $first = 1 ] || echo; first=0
+      printf 'Id=%s\\nActiveState=active\\nSubState=running\\nUnitFileState=enabled\\n' "$u"
+    done;;
+esac
+exit 0
+"""
+
+STUB_SUDO = """#!/bin/sh
+# sudo giả cho benchmark: bỏ qua options, đọc password từ stdin rồi chạy lệnh
+while [ $# -gt 0 ]; do
+  case "$1" in -*) shift;; *) break;; esac
+done
+read _password
+exec "$@"
+"""
+
+
+def serve(root, port):
+    """Chạy RemoteControlService trong process này với cấu hình benchmark (--serve)"""
+    import importlib.util
+
+    spec = importlib.util.spec_from_file_location('system_control', SERVICE_SCRIPT)
+    service_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(service_module)
+
+    for ext in list(service_module.ALLOWED_EXTENSIONS):
+        service_module.ALLOWED_EXTENSIONS[ext] = os.path.join(root, ext.strip('.'))
+    service_module.HOST = '127.0.0.1'
+    service_module.PORT = port
+    service_module.STATE_DIR = os.path.join(root, 'state')
+    service_module.HELPER_SOCKET_PATH = os.path.join(root, 'no-helper.sock')
+
+    service = service_module.RemoteControlService()
+    service.setup_mdns_advertisement = lambda: None
+    service.start_server()
+
+
+class BenchEnvironment:
+    """Temp directories, systemctl/sudo giả và service process trên loopback port"""
+
+    def __init__(self):
+        self.root = tempfile.mkdtemp(prefix='bench-system-control-')
+        self.port = None
+        self.process = None
+        self.log_path = os.path.join(self.root, 'service.log')
+
+    def start(self):
+        bin_dir = os.path.join(self.root, 'bin')
+        os.makedirs(bin_dir)
+        for name, content in (('systemctl', STUB_SYSTEMCTL), ('sudo', STUB_SUDO)):
+            path = os.path.join(bin_dir, name)
+            with open(path, 'w') as f:
+                f.write(content)
+            os.chmod(path, 0o755)
+
+        for ext in ('py', 'sh', 'service'):
+            os.makedirs(os.path.join(self.root, ext))
+        for i in range(STUB_UNITS):
+            with open(os.path.join(self.root, 'service', f'bench-{i:02d}.service'), 'w') as f:
+                f.write(f"[Unit]\nDescription=Benchmark unit {i}\n\n[Service]\nExecStart=/bin/true\n")
+
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        self.port = probe.getsockname()[1]
+        probe.close()
+
+        env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''))
+        self.log_file = open(self.log_path, 'w')
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--serve', self.root, str(self.port)],
+            stdout=self.log_file, stderr=subprocess.STDOUT, env=env
+        )
+
+        deadline = time.time() + START_TIMEOUT
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Service exited with code {self.process.returncode}, see {self.log_path}")
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f"Service did not start within {START_TIMEOUT}s, see {self.log_path}")
+
+    def stop(self, keep=False):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log_file.close()
+        if keep:
+            print(f"Benchmark files kept in {self.root}")
+        else:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+class RssSampler:
+    """Lấy mẫu VmRSS của service process để tìm peak RSS trong một phase"""
+
+    def __init__(self, pid, interval=0.01):
+        self.status_path = f'/proc/{pid}/status'
+        self.interval = interval
+        self.peak_kb = None
+        self.running = False
+        self.thread = None
+
+    def read_rss_kb(self):
+        try:
+            with open(self.status_path) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def sample(self):
+        while self.running:
+            rss = self.read_rss_kb()
+            if rss is not None:
+                self.peak_kb = max(self.peak_kb or 0, rss)
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak_kb = self.read_rss_kb()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+
+
+class FramedClient:
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.settimeout(RESPONSE_TIMEOUT)
+        self.buffer = bytearray()
+
+    def send(self, command):
+        self.send_frame(FRAME_JSON, json.dumps(command).encode())
+
+    def send_frame(self, frame_type, payload):
+        self.sock.sendall(FRAME_HEADER.pack(FRAME_MAGIC, frame_type, len(payload)) + payload)
+
+    def recv(self):
+        while True:
+            if len(self.buffer) >= FRAME_HEADER.size:
+                _magic, _frame_type, length = FRAME_HEADER.unpack_from(self.buffer)
+                end = FRAME_HEADER.size + length
+                if len(self.buffer) >= end:
+                    payload = bytes(self.buffer[FRAME_HEADER.size:end])
+                    del self.buffer[:end]
+                    return json.loads(payload)
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError('Service closed connection')
+            self.buffer += data
+
+    def recv_action(self, actions):
+        """Đọc tới response có action thuộc actions (bỏ qua upload_ack, events...)"""
+        while True:
+            response = self.recv()
+            if response.get('action') in actions:
+                return response
+
+    def close(self):
+        self.sock.close()
+
+
+class LegacyClient(FramedClient):
+    """Newline-delimited JSON (app cũ, không dùng framing)"""
+
+    def __init__(self, port):
+        super().__init__(port)
+        self.reader = self.sock.makefile('rb')
+
+    def send(self, command):
+        self.sock.sendall(json.dumps(command).encode())
+
+    def recv(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError('Service closed connection')
+        return json.loads(line)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def latency_summary(samples_ms):
+    return {
+        'count': len(samples_ms),
+        'mean_ms': round(sum(samples_ms) / len(samples_ms), 3) if samples_ms else None,
+        'p50_ms': round(percentile(samples_ms, 50), 3) if samples_ms else None,
+        'p99_ms': round(percentile(samples_ms, 99), 3) if samples_ms else None,
+        'max_ms': round(max(samples_ms), 3) if samples_ms else None
+    }
+
+
+def upload_once(port, mode, filename, data):
+    """Upload một file, trả về response cuối cùng của service"""
+    if mode == 'session':
+        client = FramedClient(port)
+        client.send({
+            'action': 'upload_begin',
+            'filename': filename,
+            'file_size': len(data),
+            'sha256': hashlib.sha256(data).hexdigest()
+        })
+        ready = client.recv_action({'upload_ready', 'upload_error'})
+        if ready['action'] != 'upload_ready':
+            client.close()
+            return ready
+
+        raw_id = bytes.fromhex(ready['upload_id'])
+        view = memoryview(data)
+        for offset in range(ready['offset'], len(data), CHUNK_SIZE):
+            chunk = view[offset:offset + CHUNK_SIZE]
+            client.send_frame(FRAME_UPLOAD_CHUNK, UPLOAD_CHUNK_HEADER.pack(raw_id, offset) + bytes(chunk))
+        client.send({'action': 'upload_commit', 'upload_id': ready['upload_id']})
+    else:
+        client = FramedClient(port) if mode == 'framed' else LegacyClient(port)
+        client.send({
+            'action': 'upload_file',
+            'filename': filename,
+            'file_data': base64.b64encode(data).decode(),
+            'file_size': len(data),
+            'md5_hash': hashlib.md5(data).hexdigest()
+        })
+
+    response = client.recv_action({'upload_success', 'upload_error'})
+    client.close()
+    return response
+
+
+def bench_uploads(env, sizes_mb, modes, legacy_max_mb, repeat):
+    results = []
+    for size_mb in sizes_mb:
+        data = os.urandom(int(size_mb * 1024 * 1024))
+        for mode in modes:
+            if mode == 'legacy' and size_mb > legacy_max_mb:
+                # Legacy mode parse lại toàn bộ buffer mỗi chunk, file lớn mất quá lâu
+                results.append({'mode': mode, 'size_mb': size_mb, 'skipped': f'> legacy max {legacy_max_mb}MB'})
+                continue
+
+            runs = []
+            with RssSampler(env.process.pid) as rss:
+                for i in range(repeat):
+                    started = time.perf_counter()
+                    response = upload_once(env.port, mode, f'bench-{mode}-{size_mb}-{i}.py', data)
+                    elapsed = time.perf_counter() - started
+                    runs.append({
+                        'ok': response.get('action') == 'upload_success',
+                        'seconds': round(elapsed, 4),
+                        'mb_per_s': round(size_mb / elapsed, 2),
+                        'error': response.get('error')
+                    })
+
+            ok_runs = [run for run in runs if run['ok']]
+            results.append({
+                'mode': mode,
+                'size_mb': size_mb,
+                'runs': runs,
+                'errors': len(runs) - len(ok_runs),
+                'best_mb_per_s': max((run['mb_per_s'] for run in ok_runs), default=None),
+                'mean_mb_per_s': round(sum(run['mb_per_s'] for run in ok_runs) / len(ok_runs), 2) if ok_runs else None,
+                'peak_rss_kb': rss.peak_kb
+            })
+            print(f"  upload {mode:<8} {size_mb:>6}MB  "
+                  f"{results[-1]['mean_mb_per_s']} MB/s  peak RSS {rss.peak_kb} kB  errors {results[-1]['errors']}")
+    return results
+
+
+COMMAND_RESPONSES = {
+    'ping': {'pong'},
+    'list_files': {'file_list', 'file_list_error'},
+    'list_services': {'services_list', 'services_error'}
+}
+
+
+def run_command(client, action):
+    started = time.perf_counter()
+    client.send({'action': action})
+    response = client.recv_action(COMMAND_RESPONSES[action] | {'error'})
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    return elapsed_ms, response.get('action') in COMMAND_RESPONSES[action] and 'error' not in response
+
+
+def bench_latency(env, iterations, warmup=10):
+    results = {}
+    client = FramedClient(env.port)
+    for action in COMMAND_RESPONSES:
+        for _ in range(warmup):
+            run_command(client, action)
+        samples = []
+        errors = 0
+        for _ in range(iterations):
+            elapsed_ms, ok = run_command(client, action)
+            samples.append(elapsed_ms)
+            errors += not ok
+        results[action] = dict(latency_summary(samples), errors=errors)
+        print(f"  {action:<14} p50 {results[action]['p50_ms']}ms  p99 {results[action]['p99_ms']}ms  errors {errors}")
+    client.close()
+    return results
+
+
+def bench_concurrency(env, client_counts, iterations, upload_mb):
+    results = []
+    upload_data = os.urandom(int(upload_mb * 1024 * 1024))
+    for count in client_counts:
+        samples = []
+        errors = []
+        lock = threading.Lock()
+
+        def command_worker():
+            local_samples, local_errors = [], 0
+            try:
+                client = FramedClient(env.port)
+                for i in range(iterations):
+                    elapsed_ms, ok = run_command(client, 'ping' if i % 2 == 0 else 'list_services')
+                    local_samples.append(elapsed_ms)
+                    local_errors += not ok
+                client.close()
+            except (OSError, ValueError) as e:
+                local_errors += 1
+                print(f"    client error: {e}")
+            with lock:
+                samples.extend(local_samples)
+                errors.append(local_errors)
+
+        threads = [threading.Thread(target=command_worker) for _ in range(count)]
+        with RssSampler(env.process.pid) as rss:
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            command_elapsed = time.perf_counter() - started
+
+        # Upload đồng thời: mỗi client một file upload_mb qua upload session
+        upload_results = []
+
+        def upload_worker(index):
+            response = upload_once(env.port, 'session', f'bench-concurrent-{count}-{index}.py', upload_data)
+            with lock:
+                upload_results.append(response.get('action') == 'upload_success')
+
+        threads = [threading.Thread(target=upload_worker, args=(i,)) for i in range(count)]
+        with RssSampler(env.process.pid) as upload_rss:
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            upload_elapsed = time.perf_counter() - started
+
+        results.append({
+            'clients': count,
+            'commands': dict(latency_summary(samples),
+                             ops_per_s=round(len(samples) / command_elapsed, 1),
+                             errors=sum(errors),
+                             peak_rss_kb=rss.peak_kb),
+            'uploads': {
+                'size_mb': upload_mb,
+                'ok': sum(upload_results),
+                'errors': len(upload_results) - sum(upload_results),
+                'seconds': round(upload_elapsed, 3),
+                'aggregate_mb_per_s': round(upload_mb * sum(upload_results) / upload_elapsed, 2),
+                'peak_rss_kb': upload_rss.peak_kb
+            }
+        })
+        print(f"  {count:>3} clients  {results[-1]['commands']['ops_per_s']} ops/s  "
+              f"p99 {results[-1]['commands']['p99_ms']}ms  "
+              f"uploads {results[-1]['uploads']['aggregate_mb_per_s']} MB/s  "
+              f"peak RSS {upload_rss.peak_kb} kB")
+    return results
+
+
+def parse_list(value, cast):
+    return [cast(item) for item in value.split(',') if item.strip()]
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == '--serve':
+        serve(sys.argv[2], int(sys.argv[3]))
+        return
+
+    parser = argparse.ArgumentParser(description='Benchmark Remote Control Service trên loopback')
+    parser.add_argument('--sizes', default='1,8,32', help='Kích thước file upload (MB), cách nhau bởi dấu phẩy')
+    parser.add_argument('--modes', default='session,framed,legacy', help='Kiểu upload: session, framed, legacy')
+    parser.add_argument('--legacy-max-size', type=float, default=4, help='Bỏ qua legacy upload lớn hơn (MB)')
+    parser.add_argument('--repeat', type=int, default=3, help='Số lần upload mỗi kích thước')
+    parser.add_argument('--iterations', type=int, default=200, help='Số request mỗi action khi đo latency')
+    parser.add_argument('--clients', default='1,4,8', help='Số clients đồng thời')
+    parser.add_argument('--concurrent-upload-size', type=float, default=4, help='File upload mỗi client (MB)')
+    parser.add_argument('--output', default=None, help='File JSON kết quả')
+    parser.add_argument('--keep', action='store_true', help='Giữ lại temp directory và service log')
+    args = parser.parse_args()
+
+    env = BenchEnvironment()
+    env.start()
+    print(f"Service started on 127.0.0.1:{env.port} (pid {env.process.pid})")
+
+    results = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args)
+        }
+    }
+    try:
+        print("Upload throughput:")
+        results['upload'] = bench_uploads(env, parse_list(args.sizes, float), parse_list(args.modes, str),
+                                          args.legacy_max_size, args.repeat)
+        print("Command latency:")
+        results['latency'] = bench_latency(env, args.iterations)
+        print("Concurrent clients:")
+        results['concurrency'] = bench_concurrency(env, parse_list(args.clients, int),
+                                                   max(1, args.iterations // 4), args.concurrent_upload_size)
+    finally:
+        env.stop(keep=args.keep)
+
+    output = args.output or f"bench-system-control-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
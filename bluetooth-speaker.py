@@ -12,6 +12,7 @@ import threading
 import logging
 import time
 import os
+from collections import deque
 from datetime import datetime
 
 # Setup logging
@@ -22,6 +23,84 @@ logger = logging.getLogger(__name__)
 HOST = '0.0.0.0'
 PORT = 8765
 
+# Logging configuration cho các monitoring loop (giảm ghi SD card / journal)
+LOG_RATE_LIMIT_INTERVAL = 60  # Mỗi message key chỉ log 1 lần / 60 giây
+COMMAND_OUTPUT_BUFFER_SIZE = 200  # Số output pactl/bluetoothctl giữ trong RAM
+
+
+class RateLimitedLogger:
+    """
+    Log theo message key, mỗi key tối đa 1 lần trong `interval` giây.
+    Các message bị chặn được đếm lại và báo kèm ở lần log kế tiếp.
+    """
+
+    def __init__(self, base_logger, interval=LOG_RATE_LIMIT_INTERVAL):
+        self.base_logger = base_logger
+        self.interval = interval
+        self.last_emitted = {}  # key -> timestamp lần log cuối
+        self.suppressed = {}  # key -> số message bị chặn từ lần log cuối
+        self.lock = threading.Lock()
+
+    def log(self, key, level, message):
+        """Log message nếu key chưa log trong interval, ngược lại tăng counter"""
+        if not self.base_logger.isEnabledFor(level):
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            last = self.last_emitted.get(key)
+            if last is not None and now - last < self.interval:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return
+            suppressed = self.suppressed.pop(key, 0)
+            self.last_emitted[key] = now
+
+        if suppressed:
+            message = f"{message} ({suppressed} similar messages suppressed)"
+        self.base_logger.log(level, message)
+
+    def info(self, key, message):
+        self.log(key, logging.INFO, message)
+
+    def warning(self, key, message):
+        self.log(key, logging.WARNING, message)
+
+    def get_counters(self):
+        """Số message đang bị chặn theo từng key"""
+        with self.lock:
+            return dict(self.suppressed)
+
+
+class CommandOutputBuffer:
+    """
+    Ring buffer trong RAM cho output đầy đủ của pactl/bluetoothctl.
+    Không ghi ra journal, chỉ dump khi app gửi action 'dump_logs'.
+    """
+
+    def __init__(self, maxlen=COMMAND_OUTPUT_BUFFER_SIZE):
+        self.entries = deque(maxlen=maxlen)
+        self.total_recorded = 0
+        self.lock = threading.Lock()
+
+    def record(self, label, output):
+        """Lưu output của một command vào buffer"""
+        with self.lock:
+            self.total_recorded += 1
+            self.entries.append({
+                'timestamp': datetime.now().isoformat(),
+                'command': label,
+                'output': output
+            })
+
+    def dump(self, limit=None):
+        """Lấy các entries mới nhất (tối đa `limit`)"""
+        with self.lock:
+            entries = list(self.entries)
+            total = self.total_recorded
+        if limit:
+            entries = entries[-limit:]
+        return entries, total
+
 class BluetoothSpeakerService:
     def __init__(self):
         self.connected_speakers = []
@@ -30,6 +109,8 @@ class BluetoothSpeakerService:
         self.monitoring_enabled = True
         self.last_known_devices = {}  # Track device states
         self.monitoring_thread = None
+        self.rate_logger = RateLimitedLogger(logger)
+        self.command_output = CommandOutputBuffer()
 
     def handle_client(self, client_socket, client_address):
         """Xử lý kết nối từ client"""
@@ -63,6 +144,8 @@ class BluetoothSpeakerService:
                         self.disconnect_speaker(mac_address, client_socket)
                     elif command.get('action') == 'list_speakers':
                         self.list_connected_speakers(client_socket)
+                    elif command.get('action') == 'dump_logs':
+                        self.dump_command_logs(command, client_socket)
                     elif command.get('action') == 'auto_reconnect':
                         # Manual trigger auto-reconnect từ app
                         threading.Thread(target=self.auto_reconnect_paired_devices, daemon=True).start()
@@ -103,6 +186,24 @@ class BluetoothSpeakerService:
                 if client in self.clients:
                     self.clients.remove(client)
 
+    def dump_command_logs(self, command, client_socket):
+        """Gửi output pactl/bluetoothctl đã lưu trong ring buffer về client"""
+        try:
+            entries, total = self.command_output.dump(command.get('limit'))
+            self.send_response(client_socket, {
+                'action': 'command_logs',
+                'entries': entries,
+                'returned': len(entries),
+                'total_recorded': total,
+                'suppressed_counters': self.rate_logger.get_counters()
+            })
+        except Exception as e:
+            logger.error(f"Error dumping command logs: {e}")
+            self.send_response(client_socket, {
+                'action': 'dump_logs_error',
+                'error': str(e)
+            })
+
     def set_bluetooth_as_default_sink(self, mac_address, device_name=None):
         """Set Bluetooth device làm default audio sink trong PulseAudio"""
         try:
@@ -120,8 +221,8 @@ class BluetoothSpeakerService:
                     text=True
                 )
 
-                logger.info(f"Retry {retry+1}/{max_retries}: Available sinks:\n{pa_result.stdout}")
-                logger.info(f"Looking for MAC: {mac_formatted} or device name: {device_name}")
+                self.command_output.record('pactl list short sinks', pa_result.stdout)
+                logger.debug(f"Retry {retry+1}/{max_retries}: looking for MAC: {mac_formatted} or device name: {device_name}")
 
                 # Tìm sink của Bluetooth device
                 found_sink = None
@@ -143,7 +244,7 @@ class BluetoothSpeakerService:
                             # ✅ Check 1: MAC address trong sink name (ưu tiên cao nhất)
                             if mac_formatted.lower() in sink_lower:
                                 match_score = 100
-                                logger.info(f"✅ Match by MAC address: {sink_name}")
+                                logger.debug(f"✅ Match by MAC address: {sink_name}")
 
                             # ✅ Check 2: Device name trong sink name
                             elif device_name:
@@ -157,19 +258,19 @@ class BluetoothSpeakerService:
                                 for variant in device_variants:
                                     if variant.lower() in sink_lower:
                                         match_score = 80
-                                        logger.info(f"✅ Match by device name variant '{variant}': {sink_name}")
+                                        logger.debug(f"✅ Match by device name variant '{variant}': {sink_name}")
                                         break
 
                             # ✅ Check 3: Chỉ cần có "bluez_sink" và là sink duy nhất
                             elif 'bluez_sink' in sink_lower or 'bluez_output' in sink_lower:
                                 match_score = 50
-                                logger.info(f"⚠️ Fallback match (bluez sink found): {sink_name}")
+                                logger.debug(f"⚠️ Fallback match (bluez sink found): {sink_name}")
 
                             # Chọn sink có điểm cao nhất
                             if match_score > best_match_score:
                                 best_match_score = match_score
                                 found_sink = sink_name
-                                logger.info(f"Current best match (score {match_score}): {found_sink}")
+                                logger.debug(f"Current best match (score {match_score}): {found_sink}")
 
                                 # Nếu tìm thấy perfect match (MAC address), không cần tìm nữa
                                 if match_score == 100:
@@ -201,14 +302,17 @@ class BluetoothSpeakerService:
                     else:
                         logger.error(f"❌ Failed to set default sink!")
                         logger.error(f"Return code: {set_result.returncode}")
-                        logger.error(f"Stderr: {set_result.stderr}")
-                        logger.error(f"Stdout: {set_result.stdout}")
+                        logger.error(f"Stderr: {set_result.stderr.strip()}")
+                        self.command_output.record('pactl set-default-sink', set_result.stdout + set_result.stderr)
                         return False
 
                 # Nếu chưa tìm thấy hoặc match score thấp, đợi một chút
                 elif not found_sink or best_match_score < 50:
                     if retry < max_retries - 1:
-                        logger.info(f"No suitable Bluetooth sink found yet (best score: {best_match_score}). Waiting... ({retry+1}/{max_retries})")
+                        self.rate_logger.info(
+                            f"sink_wait:{mac_address}",
+                            f"No suitable Bluetooth sink found yet for {mac_address} (best score: {best_match_score}). Waiting..."
+                        )
                         time.sleep(2)
 
             logger.warning(f"Could not find PulseAudio sink for device {mac_address} after {max_retries} retries")
@@ -223,7 +327,7 @@ class BluetoothSpeakerService:
     def set_default_to_audiocodec(self):
         """Set default sink về HDMI (LUÔN LUÔN ưu tiên HDMI)"""
         try:
-            logger.info("Setting default audio sink to HDMI (always prioritize HDMI)...")
+            self.rate_logger.info('set_hdmi_sink', "Setting default audio sink to HDMI (always prioritize HDMI)...")
 
             # Lấy danh sách sinks
             pa_result = subprocess.run(
@@ -232,7 +336,7 @@ class BluetoothSpeakerService:
                 text=True
             )
 
-            logger.info(f"Available sinks:\n{pa_result.stdout}")
+            self.command_output.record('pactl list short sinks', pa_result.stdout)
 
             # Tìm HDMI sink (LUÔN LUÔN ưu tiên HDMI)
             hdmi_sink = None
@@ -279,8 +383,8 @@ class BluetoothSpeakerService:
                     logger.error(f"Stderr: {set_result.stderr}")
                     return False
             else:
-                logger.error("❌ HDMI sink NOT FOUND! Available sinks:")
-                logger.error(pa_result.stdout)
+                self.rate_logger.log('hdmi_not_found', logging.ERROR,
+                                     "❌ HDMI sink NOT FOUND! (sinks list available via dump_logs)")
                 return False
 
         except Exception as e:
@@ -307,7 +411,7 @@ class BluetoothSpeakerService:
                             ['pactl', 'move-sink-input', input_id, sink_name],
                             capture_output=True
                         )
-                        logger.info(f"Moved audio stream {input_id} to {sink_name}")
+                        logger.debug(f"Moved audio stream {input_id} to {sink_name}")
 
         except Exception as e:
             logger.warning(f"Could not move audio streams: {e}")
@@ -326,7 +430,7 @@ class BluetoothSpeakerService:
                 capture_output=True,
                 text=True
             )
-            logger.info(f"[FALLBACK] All available sinks:\n{all_sinks.stdout}")
+            self.command_output.record('pactl list short sinks', all_sinks.stdout)
 
             # CHỈ tìm HDMI sink
             hdmi_sinks = []
@@ -653,7 +757,7 @@ class BluetoothSpeakerService:
                 capture_output=True,
                 text=True
             )
-            logger.info(f"All devices output: {all_devices_result.stdout}")
+            self.command_output.record('bluetoothctl devices', all_devices_result.stdout)
 
             # Lấy danh sách paired devices
             paired_result = subprocess.run(
@@ -661,7 +765,7 @@ class BluetoothSpeakerService:
                 capture_output=True,
                 text=True
             )
-            logger.info(f"Paired devices output: {paired_result.stdout}")
+            self.command_output.record('bluetoothctl paired-devices', paired_result.stdout)
 
             # Xử lý tất cả devices
             for line in all_devices_result.stdout.split('\n'):
@@ -678,8 +782,7 @@ class BluetoothSpeakerService:
                             text=True
                         )
 
-                        logger.info(f"=== Device: {name} ({mac}) ===")
-                        logger.debug(f"Info output: {info_result.stdout}")
+                        self.command_output.record(f'bluetoothctl info {mac}', info_result.stdout)
 
                         is_connected = 'Connected: yes' in info_result.stdout
                         is_paired = 'Paired: yes' in info_result.stdout
@@ -696,7 +799,7 @@ class BluetoothSpeakerService:
                         elif 'Phone' in info_result.stdout:
                             device_type = 'phone'
 
-                        logger.info(f"Device: {name} - Connected: {is_connected}, Paired: {is_paired}, Type: {device_type}")
+                        logger.debug(f"Device: {name} - Connected: {is_connected}, Paired: {is_paired}, Type: {device_type}")
 
                         # Lấy thêm thông tin battery nếu có
                         battery_level = None
@@ -741,7 +844,7 @@ class BluetoothSpeakerService:
                 capture_output=True,
                 text=True
             )
-            logger.info(f"PulseAudio sinks: {pa_sinks_result.stdout}")
+            self.command_output.record('pactl list short sinks', pa_sinks_result.stdout)
 
             response = {
                 'action': 'connected_speakers',
@@ -814,7 +917,7 @@ class BluetoothSpeakerService:
         while self.monitoring_enabled:
             try:
                 # Sử dụng pactl subscribe để lắng nghe events real-time
-                logger.info("Starting pactl subscribe for real-time sink monitoring...")
+                self.rate_logger.info('pactl_subscribe_start', "Starting pactl subscribe for real-time sink monitoring...")
 
                 # Start pactl subscribe process
                 proc = subprocess.Popen(
@@ -863,18 +966,20 @@ class BluetoothSpeakerService:
 
                                 # Nếu KHÔNG có BT device nào connected => orphaned sink
                                 if not has_active_bt:
-                                    logger.warning(f"⚠️ [Event Monitor] Orphaned Bluetooth sink detected: {current_sink}")
-                                    logger.info("🔧 [Event Monitor] Forcing HDMI...")
+                                    self.rate_logger.warning(
+                                        'event_monitor_orphaned_sink',
+                                        f"⚠️ [Event Monitor] Orphaned Bluetooth sink detected: {current_sink}, forcing HDMI..."
+                                    )
 
                                     if self.set_default_to_audiocodec():
-                                        logger.info("✅ [Event Monitor] HDMI set successfully")
+                                        self.rate_logger.info('event_monitor_hdmi_set', "✅ [Event Monitor] HDMI set successfully")
                                     else:
                                         logger.error("❌ [Event Monitor] Failed to set HDMI, trying fallback...")
                                         self.force_set_hdmi_fallback()
 
             except Exception as e:
-                logger.error(f"Error in PulseAudio event monitoring: {e}")
-                logger.info("Restarting PulseAudio event monitoring in 10 seconds...")
+                self.rate_logger.log('pa_monitor_error', logging.ERROR,
+                                     f"Error in PulseAudio event monitoring: {e} (restarting in 10 seconds)")
                 time.sleep(10)
 
         logger.info("PulseAudio event monitoring stopped")
@@ -1010,13 +1115,15 @@ class BluetoothSpeakerService:
                 # Nếu sink hiện tại là Bluetooth nhưng KHÔNG có BT device nào connected
                 # => Loa bị tắt đột ngột, chưa kịp update state
                 if current_sink and 'bluez' in current_sink.lower() and not has_active_bt_device:
-                    logger.warning(f"⚠️ Detected orphaned Bluetooth sink: {current_sink}")
-                    logger.info("🔧 Bluetooth device disconnected but sink still active - forcing HDMI...")
+                    self.rate_logger.warning(
+                        'monitor_orphaned_sink',
+                        f"⚠️ Detected orphaned Bluetooth sink: {current_sink} - forcing HDMI..."
+                    )
 
                     if self.set_default_to_audiocodec():
-                        logger.info("✅ HDMI set as default after detecting orphaned BT sink")
+                        self.rate_logger.info('monitor_orphaned_sink_hdmi', "✅ HDMI set as default after detecting orphaned BT sink")
                     else:
-                        logger.warning("⚠️ Failed to set HDMI!")
+                        self.rate_logger.warning('monitor_orphaned_sink_failed', "⚠️ Failed to set HDMI!")
 
                     # Broadcast event
                     self.broadcast_response({
@@ -1033,7 +1140,10 @@ class BluetoothSpeakerService:
 
             except Exception as e:
                 consecutive_errors += 1
-                logger.error(f"Error in continuous monitoring (attempt {consecutive_errors}/{max_consecutive_errors}): {e}")
+                self.rate_logger.log(
+                    'continuous_monitoring_error', logging.ERROR,
+                    f"Error in continuous monitoring (attempt {consecutive_errors}/{max_consecutive_errors}): {e}"
+                )
 
                 if consecutive_errors >= max_consecutive_errors:
                     logger.error("⚠️ Too many consecutive errors in monitoring, restarting...")
@@ -1069,8 +1179,8 @@ class BluetoothSpeakerService:
                 text=True
             )
 
-            logger.info(f"All devices: {all_devices_result.stdout}")
-            logger.info(f"Paired devices: {paired_result.stdout}")
+            self.command_output.record('bluetoothctl devices', all_devices_result.stdout)
+            self.command_output.record('bluetoothctl paired-devices', paired_result.stdout)
 
             reconnected_count = 0
             attempted_devices = []
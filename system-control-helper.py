@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+"""
+Privileged helper cho Remote Control Service (system-control.py)
+Chạy bằng root, nhận lệnh qua Unix socket local với whitelist cố định:
+install file, chmod, systemctl verbs, daemon-reload, snapshot/restore deploy history,
+mở file chỉ-root-đọc-được cho download_file (fd gửi qua SCM_RIGHTS).
+system-control.py gọi helper thay vì fork `echo password | sudo -S` cho mỗi thao tác
+"""
+
+import json
+import socket
+import threading
+import logging
+import subprocess
+import os
+import pwd
+import grp
+import shutil
+import errno
+import struct
+import uuid
+
+try:
+    import dbus
+except ImportError:
+    dbus = None
+
+# Setup logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+SOCKET_PATH = '/run/system-control-helper.sock'
+# Bản cài của chính helper nằm ở /usr/local/lib/system-control (root:root 0755),
+# không bao giờ ghi file trùng tên vào managed dirs (/home/orangepi do user ghi được)
+HELPER_FILENAME = 'system-control-helper.py'
+CLIENT_USER = 'orangepi'  # User chạy system-control.py
+
+# Các thư mục được phép install (giống ALLOWED_EXTENSIONS trong system-control.py)
+ALLOWED_EXTENSIONS = {
+    '.py': '/home/orangepi',
+    '.sh': '/usr/local/bin',
+    '.service': '/etc/systemd/system'
+}
+# File nguồn chỉ được lấy từ staging dir của system-control.py
+STAGING_DIR = '/home/orangepi/.system-control'
+# Snapshots của deploy history (hardlink tới bản cũ của managed files)
+HISTORY_DIR = os.path.join(STAGING_DIR, 'history')
+# Ngoài managed files, download_file chỉ được đọc trong các thư mục này (giống system-control.py)
+DOWNLOAD_ALLOWED_DIRS = ('/var/log', '/var/lib/systemd/coredump', '/var/crash')
+ALLOWED_MODES = {0o644, 0o755}
+SYSTEMCTL_VERBS = {'start', 'stop', 'restart', 'try-restart', 'reload', 'enable', 'disable'}
+SYSTEMCTL_TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+
+SYSTEMD_BUS_NAME = 'org.freedesktop.systemd1'
+SYSTEMD_PATH = '/org/freedesktop/systemd1'
+SYSTEMD_MANAGER_IFACE = 'org.freedesktop.systemd1.Manager'
+
+
+class HelperError(Exception):
+    """Request không hợp lệ hoặc bị từ chối"""
+
+
+def validate_destination(path):
+    """Destination phải là file trực tiếp trong thư mục tương ứng với extension"""
+    if not isinstance(path, str) or not os.path.isabs(path):
+        raise HelperError(f'Invalid destination: {path}')
+
+    filename = os.path.basename(path)
+    file_ext = os.path.splitext(filename)[1].lower()
+    if (file_ext not in ALLOWED_EXTENSIONS or filename.startswith('.') or filename == HELPER_FILENAME or
+            os.path.dirname(path) != ALLOWED_EXTENSIONS[file_ext]):
+        raise HelperError(f'Destination not allowed: {path}')
+    return path
+
+
+def validate_source(path):
+    """File nguồn phải là regular file trong staging dir hoặc temp file (dot-file) trong managed dirs"""
+    if not isinstance(path, str):
+        raise HelperError(f'Invalid source: {path}')
+
+    real_path = os.path.realpath(path)
+    directory = os.path.dirname(real_path)
+    in_staging = real_path.startswith(STAGING_DIR + os.sep)
+    is_dest_temp = directory in ALLOWED_EXTENSIONS.values() and os.path.basename(real_path).startswith('.')
+    if not (in_staging or is_dest_temp) or not os.path.isfile(real_path) or os.path.islink(path):
+        raise HelperError(f'Source not allowed: {path}')
+    return real_path
+
+
+def validate_history_path(path, must_exist):
+    """Snapshot path phải nằm trong HISTORY_DIR (không phải symlink)"""
+    if not isinstance(path, str) or not os.path.isabs(path):
+        raise HelperError(f'Invalid history path: {path}')
+
+    real_path = os.path.realpath(path)
+    if not real_path.startswith(HISTORY_DIR + os.sep) or os.path.islink(path):
+        raise HelperError(f'History path not allowed: {path}')
+    if must_exist != os.path.isfile(real_path):
+        raise HelperError(f"History path {'missing' if must_exist else 'already exists'}: {path}")
+    return real_path
+
+
+def validate_download_path(path):
+    """File đọc cho download_file: managed file hoặc regular file trong DOWNLOAD_ALLOWED_DIRS"""
+    if not isinstance(path, str) or not os.path.isabs(path):
+        raise HelperError(f'Invalid download path: {path}')
+
+    real_path = os.path.realpath(path)
+    try:
+        validate_destination(real_path)
+        allowed = True
+    except HelperError:
+        allowed = any(real_path.startswith(directory + os.sep) for directory in DOWNLOAD_ALLOWED_DIRS)
+    if not allowed or not os.path.isfile(real_path):
+        raise HelperError(f'Download path not allowed: {path}')
+    return real_path
+
+
+def validate_unit(unit, pending_units=()):
+    """Unit phải là custom unit có file trong /etc/systemd/system (hoặc sắp được install)"""
+    if (not isinstance(unit, str) or not unit.endswith('.service') or '/' in unit or
+            not (unit in pending_units or os.path.isfile(os.path.join(ALLOWED_EXTENSIONS['.service'], unit)))):
+        raise HelperError(f'Unit not allowed: {unit}')
+    return unit
+
+
+def validate_mode(mode):
+    if mode not in ALLOWED_MODES:
+        raise HelperError(f'Mode not allowed: {mode}')
+    return mode
+
+
+def fsync_directory(directory):
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class PrivilegedHelper:
+    def __init__(self):
+        self.server_socket = None
+        self.allowed_uids = {0}
+        try:
+            self.allowed_uids.add(pwd.getpwnam(CLIENT_USER).pw_uid)
+        except KeyError:
+            logger.warning(f"User {CLIENT_USER} not found, only root can use the helper")
+
+        # systemd Manager qua D-Bus (không fork systemctl), fallback về systemctl nếu không có dbus
+        self.systemd_manager = None
+        if dbus is not None:
+            try:
+                bus = dbus.SystemBus()
+                self.systemd_manager = dbus.Interface(
+                    bus.get_object(SYSTEMD_BUS_NAME, SYSTEMD_PATH),
+                    SYSTEMD_MANAGER_IFACE
+                )
+            except Exception as e:
+                logger.warning(f"Cannot connect to systemd over D-Bus, using systemctl: {e}")
+
+    # =========================
+    # Operations
+    # =========================
+    def stage_copy(self, src, dest, mode):
+        """Copy src vào temp file trong thư mục đích (fsync + chmod), trả về temp path"""
+        directory = os.path.dirname(dest)
+        temp_path = os.path.join(directory, f'.{os.path.basename(dest)}.{uuid.uuid4().hex[:8]}.tmp')
+
+        src_fd = os.open(src, os.O_RDONLY | os.O_NOFOLLOW)
+        try:
+            dest_fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+            try:
+                while True:
+                    block = os.read(src_fd, CHUNK_SIZE)
+                    if not block:
+                        break
+                    os.write(dest_fd, block)
+                os.fchmod(dest_fd, mode)
+                os.fsync(dest_fd)
+            finally:
+                os.close(dest_fd)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        finally:
+            os.close(src_fd)
+
+        return temp_path
+
+    def op_install_file(self, request):
+        """Copy file nguồn vào đích bằng temp file + atomic rename"""
+        src = validate_source(request.get('src'))
+        dest = validate_destination(request.get('dest'))
+        mode = validate_mode(request.get('mode', 0o644))
+
+        temp_path = self.stage_copy(src, dest, mode)
+        os.replace(temp_path, dest)
+        fsync_directory(os.path.dirname(dest))
+        logger.info(f"Installed {dest} (mode {mode:o})")
+        return {}
+
+    def op_snapshot_file(self, request):
+        """Hardlink bản hiện tại của managed file vào history (copy nếu khác filesystem)"""
+        src = validate_destination(request.get('src'))
+        dest = validate_history_path(request.get('dest'), must_exist=False)
+        if not os.path.isdir(os.path.dirname(dest)):
+            raise HelperError(f'History directory missing: {os.path.dirname(dest)}')
+
+        try:
+            os.link(src, dest)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copy2(src, dest)
+        return {}
+
+    def op_restore_file(self, request):
+        """Đưa snapshot về lại managed file: link vào temp trong thư mục đích rồi atomic rename"""
+        src = validate_history_path(request.get('src'), must_exist=True)
+        dest = validate_destination(request.get('dest'))
+        directory = os.path.dirname(dest)
+        temp_path = os.path.join(directory, f'.{os.path.basename(dest)}.{uuid.uuid4().hex[:8]}.tmp')
+
+        try:
+            os.link(src, temp_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            temp_path = self.stage_copy(src, dest, os.stat(src).st_mode & 0o777)
+        os.replace(temp_path, dest)
+        fsync_directory(directory)
+        logger.info(f"Restored {dest} from {src}")
+        return {}
+
+    def op_remove_file(self, request):
+        """Xoá managed file (rollback một deploy đã tạo file mới)"""
+        path = validate_destination(request.get('path'))
+        if os.path.lexists(path):
+            os.unlink(path)
+            fsync_directory(os.path.dirname(path))
+            logger.info(f"Removed {path}")
+        return {}
+
+    def op_open_file(self, request):
+        """Mở file để đọc, fd được gửi kèm response (SCM_RIGHTS), service tự sendfile"""
+        path = validate_download_path(request.get('path'))
+        return {'fd': os.open(path, os.O_RDONLY | os.O_CLOEXEC | os.O_NOFOLLOW)}
+
+    def op_chmod(self, request):
+        path = validate_destination(request.get('path'))
+        mode = validate_mode(request.get('mode'))
+        os.chmod(path, mode)
+        return {}
+
+    def op_systemctl(self, request):
+        verb = request.get('verb')
+        if verb not in SYSTEMCTL_VERBS:
+            raise HelperError(f'systemctl verb not allowed: {verb}')
+        units = request.get('units') or [request.get('unit')]
+        units = [validate_unit(unit) for unit in units]
+        return self.systemctl(verb, units)
+
+    def op_daemon_reload(self, request):
+        return self.systemctl('daemon-reload', [])
+
+    def op_install_bundle(self, request):
+        """
+        Install nhiều file trong một transaction: stage tất cả, backup hardlink, rename,
+        một lần daemon-reload, restart units. Lỗi ở bất kỳ bước nào thì restore toàn bộ
+        """
+        files = request.get('files') or []
+        entries = []
+        for entry in files:
+            entries.append((validate_source(entry.get('src')),
+                            validate_destination(entry.get('dest')),
+                            validate_mode(entry.get('mode', 0o644))))
+        pending_units = {os.path.basename(dest) for _, dest, _ in entries if dest.endswith('.service')}
+        units = [validate_unit(unit, pending_units) for unit in request.get('restart_units', [])]
+        daemon_reload = bool(request.get('daemon_reload'))
+        deploy_id = uuid.uuid4().hex[:12]
+
+        staged = []  # (temp_path, dest, backup_path hoặc None)
+        installed = []
+        try:
+            for src, dest, mode in entries:
+                temp_path = self.stage_copy(src, dest, mode)
+                backup_path = None
+                if os.path.exists(dest):
+                    backup_path = os.path.join(os.path.dirname(dest), f'.{os.path.basename(dest)}.bak-{deploy_id}')
+                    os.link(dest, backup_path)
+                staged.append((temp_path, dest, backup_path))
+
+            for temp_path, dest, backup_path in staged:
+                os.replace(temp_path, dest)
+                installed.append((dest, backup_path))
+            for directory in {os.path.dirname(dest) for _, dest, _ in staged}:
+                fsync_directory(directory)
+
+            if daemon_reload:
+                self.check_systemctl(self.systemctl('daemon-reload', []))
+            if units:
+                self.check_systemctl(self.systemctl('try-restart', units))
+
+        except Exception as e:
+            logger.error(f"Bundle {deploy_id} failed, rolling back: {e}")
+            for dest, backup_path in installed:
+                if backup_path:
+                    os.replace(backup_path, dest)
+                else:
+                    os.unlink(dest)
+            for temp_path, dest, backup_path in staged:
+                for path in (temp_path, backup_path):
+                    if path and os.path.exists(path):
+                        os.unlink(path)
+            if installed and daemon_reload:
+                self.systemctl('daemon-reload', [])
+            if installed and units:
+                self.systemctl('try-restart', units)
+            raise HelperError(f'Bundle install failed and was rolled back: {e}')
+
+        for _, _, backup_path in staged:
+            if backup_path:
+                os.unlink(backup_path)
+
+        logger.info(f"Bundle {deploy_id} installed: {[dest for dest, _ in installed]}, restarted {units}")
+        return {}
+
+    def check_systemctl(self, result):
+        if result['return_code'] != 0:
+            raise HelperError(result['stderr'].strip() or f"systemctl exit code {result['return_code']}")
+
+    def systemctl(self, verb, units):
+        """
+        daemon-reload/enable/disable qua D-Bus nếu có (đồng bộ, không fork).
+        start/stop/restart dùng systemctl vì cần đợi job hoàn thành để biết kết quả
+        """
+        if self.systemd_manager is not None and verb in ('daemon-reload', 'enable', 'disable'):
+            try:
+                if verb == 'enable':
+                    self.systemd_manager.EnableUnitFiles(units, False, True)
+                elif verb == 'disable':
+                    self.systemd_manager.DisableUnitFiles(units, False)
+                self.systemd_manager.Reload()
+                return {'return_code': 0, 'stdout': '', 'stderr': ''}
+            except dbus.DBusException as e:
+                return {'return_code': 1, 'stdout': '', 'stderr': str(e)}
+
+        result = subprocess.run(['systemctl', verb] + units, capture_output=True, text=True,
+                                timeout=SYSTEMCTL_TIMEOUT)
+        return {'return_code': result.returncode, 'stdout': result.stdout, 'stderr': result.stderr}
+
+    # =========================
+    # Socket server
+    # =========================
+    def handle_request(self, request):
+        operations = {
+            'install_file': self.op_install_file,
+            'chmod': self.op_chmod,
+            'systemctl': self.op_systemctl,
+            'daemon_reload': self.op_daemon_reload,
+            'install_bundle': self.op_install_bundle,
+            'snapshot_file': self.op_snapshot_file,
+            'restore_file': self.op_restore_file,
+            'remove_file': self.op_remove_file,
+            'open_file': self.op_open_file
+        }
+        op = request.get('op')
+        if op not in operations:
+            raise HelperError(f'Operation not allowed: {op}')
+
+        response = operations[op](request)
+        response['ok'] = True
+        return response
+
+    def peer_uid(self, client_socket):
+        creds = client_socket.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        return uid
+
+    def handle_client(self, client_socket):
+        """Mỗi client giữ kết nối lâu dài, mỗi dòng là một JSON request"""
+        try:
+            uid = self.peer_uid(client_socket)
+            if uid not in self.allowed_uids:
+                logger.warning(f"Rejected helper client with uid {uid}")
+                return
+
+            reader = client_socket.makefile('rb')
+            for line in reader:
+                try:
+                    request = json.loads(line)
+                    response = self.handle_request(request)
+                except (HelperError, ValueError, OSError, subprocess.SubprocessError) as e:
+                    response = {'ok': False, 'error': str(e)}
+                except Exception as e:
+                    logger.error(f"Unexpected helper error: {e}")
+                    response = {'ok': False, 'error': str(e)}
+
+                fd = response.pop('fd', None)
+                if fd is None:
+                    client_socket.sendall((json.dumps(response) + "\n").encode())
+                    continue
+                try:
+                    socket.send_fds(client_socket, [(json.dumps(response) + "\n").encode()], [fd])
+                finally:
+                    os.close(fd)
+
+        except Exception as e:
+            logger.error(f"Helper client error: {e}")
+        finally:
+            client_socket.close()
+
+    def start_server(self):
+        if os.path.exists(SOCKET_PATH):
+            os.unlink(SOCKET_PATH)
+
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(SOCKET_PATH)
+
+        # Chỉ root và group của CLIENT_USER mở được socket
+        try:
+            os.chown(SOCKET_PATH, 0, grp.getgrnam(CLIENT_USER).gr_gid)
+            os.chmod(SOCKET_PATH, 0o660)
+        except KeyError:
+            os.chmod(SOCKET_PATH, 0o600)
+
+        self.server_socket.listen(5)
+        logger.info(f"Privileged helper listening on {SOCKET_PATH} "
+                    f"(systemd via {'D-Bus' if self.systemd_manager is not None else 'systemctl'})")
+
+        try:
+            while True:
+                client_socket, _ = self.server_socket.accept()
+                threading.Thread(target=self.handle_client, args=(client_socket,), daemon=True).start()
+
+        except KeyboardInterrupt:
+            logger.info("Shutting down...")
+        finally:
+            self.server_socket.close()
+            if os.path.exists(SOCKET_PATH):
+                os.unlink(SOCKET_PATH)
+
+
+def main():
+    helper = PrivilegedHelper()
+    helper.start_server()
+
+if __name__ == "__main__":
+    main()
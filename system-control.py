@@ -13,10 +13,44 @@ import logging
 import time
 import os
 import hashlib
+import heapq
 import base64
+import codecs
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import fnmatch
+import grp
+import io
+import queue
+import re
+import select
+import signal
+import lzma
+import math
+import struct
+import shlex
+import shutil
 import sys
+import tarfile
+import tempfile
+import termios
+import uuid
+import zlib
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+# D-Bus (optional): theo dõi systemd unit state realtime, không có thì dùng polling
+try:
+    import dbus
+    import dbus.mainloop.glib
+    from gi.repository import GLib
+except ImportError:
+    dbus = None
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -35,317 +69,4330 @@ ALLOWED_EXTENSIONS = {
     '.service': '/etc/systemd/system'
 }
 MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB
+MAX_MESSAGE_SIZE = 200 * 1024 * 1024  # 200MB (base64 của file 100MB + JSON overhead)
 CHUNK_SIZE = 64 * 1024  # 64KB chunks
+RECEIVE_SIZE = 64 * 1024  # Bytes đọc mỗi lần recv
+# Memory budget cho bytes đã nhận nhưng chưa xử lý xong, tính chung cho mọi client.
+# Hết budget thì reader ngừng recv (TCP tự làm chậm client) thay vì cấp phát thêm.
+RECEIVE_MEMORY_BUDGET = 64 * 1024 * 1024
+RECEIVE_CLIENT_CAP = 32 * 1024 * 1024  # Tối đa mỗi client khi không phải client giữ budget lâu nhất
 SUDO_PASSWORD = 'orangepi'
+# File index cho list_files: cập nhật bằng inotify, fallback quét lại định kỳ
+FILE_INDEX_RESCAN_INTERVAL = 2  # Giây tối thiểu giữa 2 lần quét lại khi không có inotify
+FILE_INDEX_TOMBSTONES = 1000  # Số file đã xoá được nhớ cho 'since' queries
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+INOTIFY_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+# Deploy history: snapshot (hardlink) bản cũ trước mỗi lần install, cho phép rollback local
+HISTORY_MAX_DEPLOYS = 20
+
+# Sau khi upload unit file/script: gom các thay đổi trong một đợt upload rồi mới
+# daemon-reload một lần và try-restart các units bị ảnh hưởng cùng lúc
+UNIT_APPLY_DEBOUNCE = 2.0  # Giây không có upload mới thì áp dụng
+UNIT_APPLY_MAX_DELAY = 15.0  # Upload liên tục thì vẫn áp dụng sau tối đa chừng này giây
+
+# tail_logs: journal của custom units, gửi theo batch
+LOG_TAIL_DEFAULT_LINES = 100
+LOG_TAIL_MAX_LINES = 5000
+LOG_BATCH_SIZE = 100  # Entries tối đa mỗi message log_entries
+LOG_BATCH_INTERVAL = 0.25  # Follow mode: gửi batch chưa đầy sau chừng này giây
+JOURNAL_FIELDS = ['MESSAGE', 'PRIORITY', '_PID', 'SYSLOG_IDENTIFIER']
+JOURNAL_PRIORITIES = ['emerg', 'alert', 'crit', 'err', 'warning', 'notice', 'info', 'debug']
+JOURNAL_GROUPS = ('systemd-journal', 'adm')  # Groups đọc được system journal không cần sudo
+
+# open_shell: PTY sessions, input/output qua FRAME_SHELL_DATA frames
+SHELL_COMMAND = ['/bin/bash', '--login']  # Không có bash thì dùng /bin/sh
+SHELL_MAX_SESSIONS = 8
+SHELL_READ_SIZE = 16 * 1024
+SHELL_INPUT_TIMEOUT = 5  # Giây chờ shell đọc input khi PTY buffer đầy
+SHELL_EXIT_POLL_INTERVAL = 0.5  # Kiểm tra shell đã thoát chưa khi PTY không có output
+SHELL_DEFAULT_TERM = 'xterm-256color'
+
+# Multiplexing: command có request_id (framed mode) được xử lý song song với reader,
+# response mang lại request_id để client ghép với request
+COMMAND_WORKERS = 4  # Threads dùng chung cho control commands
+MAX_PENDING_REQUESTS = 16  # Số request chưa xử lý xong tối đa mỗi connection
+# Các action này chạy tuần tự theo thứ tự nhận trên transfer lane riêng của connection (bulk priority)
+TRANSFER_ACTIONS = {
+    'upload_file', 'upload_begin', 'upload_chunk', 'upload_commit', 'upload_abort',
+    'deploy_bundle', 'upload_delta', 'download_file', 'delta_signatures'
+}
+
+# Thống kê theo action cho 'stats': bucket latency cố định, số action có giới hạn
+STATS_LATENCY_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000)  # Cận trên mỗi bucket
+STATS_MAX_ACTIONS = 64  # Action name do client gửi, vượt quá thì gộp vào 'other'
+STATS_PUSH_KEY = '(push)'  # Bytes gửi ngoài một command (events, script output, job results)
+
+# Telemetry: đọc /proc và /sys/class/thermal mỗi TELEMETRY_INTERVAL giây vào ring buffers cấp phát sẵn
+TELEMETRY_INTERVAL = 1.0
+TELEMETRY_WINDOWS = (  # (tên, giây mỗi điểm, số điểm giữ lại)
+    ('1s', 1, 600),  # 10 phút
+    ('1m', 60, 1440),  # 24 giờ
+    ('1h', 3600, 720)  # 30 ngày
+)
+TELEMETRY_METRICS = {  # metric -> đơn vị, theo thứ tự cột trong ring buffer
+    'cpu': '%',
+    'iowait': '%',
+    'mem': '%',
+    'swap': '%',
+    'temp': 'C',
+    'load1': '',
+    'disk_read': 'B/s',
+    'disk_write': 'B/s',
+    'disk_busy': '%'
+}
+TELEMETRY_DISK_PATTERN = re.compile(r'(mmcblk\d+|sd[a-z]+|nvme\d+n\d+|vd[a-z]+)$')  # Chỉ whole disks
+
+# Bulk work (transfers, scripts) nhường CPU và SD card cho kiosk (Chromium) trên cùng máy
+BULK_NICE = 10
+BULK_IO_CLASS = 2  # ioprio class: 2 = best-effort, 3 = idle (có thể bị đói I/O hoàn toàn)
+BULK_IO_LEVEL = 7  # Best-effort level: 0 (cao nhất) .. 7 (thấp nhất)
+IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'i686': 289, 'armv7l': 314, 'armv6l': 314, 'aarch64': 30, 'riscv64': 30}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+TRANSFER_BANDWIDTH_LIMIT = 0  # Bytes/s cho ghi upload + gửi download, 0 = không giới hạn
+TRANSFER_BUSY_RATE = 2 * 1024 * 1024  # Bytes/s khi kiosk đang bận
+TRANSFER_BUSY_CPU = 60.0  # % CPU của các process khác (không tính system-control) coi là bận
+TRANSFER_BUSY_HYSTERESIS = 10.0
+TRANSFER_LOAD_CHECK_INTERVAL = 1.0
+TRANSFER_BURST = 256 * 1024  # Dung lượng token bucket
+
+# Streaming script execution: output gửi theo chunk, buffer giới hạn (back-pressure)
+SCRIPT_OUTPUT_CHUNK = 4096
+SCRIPT_OUTPUT_QUEUE_CHUNKS = 64  # Tối đa ~256KB output chờ gửi, đầy thì script bị block khi ghi
+SCRIPT_KILL_GRACE = 5  # Giây chờ sau SIGTERM trước khi SIGKILL
+SCRIPT_DEFAULT_TIMEOUT = 30  # Timeout mặc định cho execute_script không streaming
+
+# Job pool cho script: giới hạn số script chạy đồng thời để không làm đơ kiosk browser.
+# Giá trị mặc định, đổi được qua 'job_limits' (lưu trong STATE_DIR/job-limits.json)
+SCRIPT_MAX_WORKERS = 2
+SCRIPT_RESERVED_WORKERS = 1  # Workers chỉ chạy short jobs, script dài không chiếm hết pool
+SCRIPT_SHORT_TIMEOUT = SCRIPT_DEFAULT_TIMEOUT  # Job có timeout <= giá trị này (hoặc priority > 0) là short
+JOB_RETENTION = 100  # Số job đã xong được giữ lại kết quả
+JOB_OUTPUT_TAIL = 4096  # Ký tự output cuối mỗi stream giữ lại trong kết quả job
+
+# Services hệ thống bị ẩn khỏi list_services (so khớp một phần tên)
+SYSTEM_SERVICE_PATTERNS = {
+    'dbus.service', 'dbus-', 'systemd-', 'getty@', 'network', 'ssh', 'bluetooth',
+    'avahi-', 'cups-', 'plymouth-', 'udev-', 'ModemManager', 'NetworkManager',
+    'accounts-daemon', 'polkit', 'udisks2', 'packagekit', 'snapd',
+    'rsyslog', 'cron', 'atd', 'smartmontools', 'thermald', 'display', 'chronyd',
+    'log', 'smartd'
+}
+UNIT_STATE_PROPERTIES = ['Id', 'ActiveState', 'SubState', 'UnitFileState']
+WATCH_POLL_INTERVAL = 1.0  # Polling fallback khi không có D-Bus (chỉ chạy khi có subscriber)
+WATCH_UNITS_REFRESH_INTERVAL = 30  # D-Bus mode: quét lại danh sách custom units (units bị xoá, rollback)
+
+SYSTEMD_BUS_NAME = 'org.freedesktop.systemd1'
+SYSTEMD_PATH = '/org/freedesktop/systemd1'
+SYSTEMD_MANAGER_IFACE = 'org.freedesktop.systemd1.Manager'
+SYSTEMD_UNIT_IFACE = 'org.freedesktop.systemd1.Unit'
+
+# Privileged helper (system-control-helper.py), fallback về sudo nếu helper không chạy
+HELPER_SOCKET_PATH = '/run/system-control-helper.sock'
+# Helper chạy bằng root từ /usr/local/lib/system-control: không bao giờ nhận upload trùng tên
+HELPER_FILENAME = 'system-control-helper.py'
+HELPER_TIMEOUT = 150
+
+# State directory (upload sessions, ...) - phải cùng filesystem với /home/orangepi
+STATE_DIR = '/home/orangepi/.system-control'
+UPLOAD_SESSION_TTL = 24 * 60 * 60  # Session upload dở dang được giữ 24h để resume
+UPLOAD_ACK_INTERVAL = 1024 * 1024  # Gửi upload_ack mỗi 1MB nhận được
+
+# Bundle deploy: nhiều file trong một tar archive, install trong một transaction
+BUNDLE_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.xz')
+BUNDLE_INSTALL_TIMEOUT = 120  # Install + daemon-reload + restart units
+
+# Compression codecs hỗ trợ cho upload (theo thứ tự ưu tiên của device)
+SUPPORTED_COMPRESSION = ['zlib', 'lzma']
+
+# Delta upload (rsync-style): block size mặc định và giới hạn client được chọn
+DELTA_BLOCK_SIZE = 2048
+DELTA_MIN_BLOCK_SIZE = 256
+DELTA_MAX_BLOCK_SIZE = 64 * 1024
+
+# Framed protocol: mỗi frame = header (magic, frame type, payload length) + payload
+# Byte 0xFF không bao giờ xuất hiện trong UTF-8 nên phân biệt được với legacy JSON
+FRAME_MAGIC = 0xFF
+FRAME_HEADER = struct.Struct('>BBI')
+FRAME_JSON = 1
+FRAME_UPLOAD_CHUNK = 2  # Payload = UPLOAD_CHUNK_HEADER + raw file bytes
+
+FRAME_DOWNLOAD_CHUNK = 3  # Server -> client: DOWNLOAD_CHUNK_HEADER + raw file bytes (os.sendfile)
+FRAME_SHELL_DATA = 4  # Hai chiều: SHELL_DATA_HEADER + raw terminal bytes
+
+# Header của upload chunk: upload_id (16 bytes UUID) + offset trong file
+UPLOAD_CHUNK_HEADER = struct.Struct('>16sQ')
+DOWNLOAD_CHUNK_HEADER = struct.Struct('>16sQ')  # download_id + offset trong file
+SHELL_DATA_HEADER = struct.Struct('>I')  # channel id của shell session
+
+# download_file: ngoài managed files chỉ đọc được trong các thư mục này (logs, core dumps)
+DOWNLOAD_ALLOWED_DIRS = ('/var/log', '/var/lib/systemd/coredump', '/var/crash')
+DOWNLOAD_FRAME_SIZE = 1024 * 1024  # Bytes file tối đa mỗi download frame
+
+
+def encode_frame(frame_type, payload):
+    """Đóng gói payload bytes thành một frame"""
+    return FRAME_HEADER.pack(FRAME_MAGIC, frame_type, len(payload)) + payload
+
+
+def run_privileged_script(script, timeout=None):
+    """Chạy shell script với quyền root (echo password | sudo -S sh -c)"""
+    command = f"echo '{SUDO_PASSWORD}' | sudo -S sh -c {shlex.quote(script)}"
+    return subprocess.run(command, shell=True, capture_output=True, text=True, timeout=timeout)
+
+
+def lower_thread_priority():
+    """
+    Hạ CPU (nice) và I/O priority (ioprio_set) của thread hiện tại: trên Linux mỗi thread
+    là một task riêng, process fork từ thread này (scripts) thừa hưởng cả hai.
+    Không có CAP_SYS_NICE thì không nâng lại được, nên chỉ gọi trên threads làm bulk work
+    """
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, max(os.getpriority(os.PRIO_PROCESS, tid), BULK_NICE))
+    except OSError as e:
+        logger.warning(f"Cannot renice bulk thread: {e}")
+
+    syscall_number = IOPRIO_SET_SYSCALLS.get(os.uname().machine)
+    if syscall_number is None:
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    ioprio = (BULK_IO_CLASS << IOPRIO_CLASS_SHIFT) | BULK_IO_LEVEL
+    if libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, tid, ioprio) != 0:
+        logger.warning(f"Cannot set I/O priority of bulk thread (errno {ctypes.get_errno()})")
+
+
+class PrivilegedHelperClient:
+    """
+    Kết nối lâu dài tới privileged helper qua Unix socket.
+    Mỗi request là một dòng JSON, không fork process nào phía service
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.sock = None
+        self.reader = None
+        self.lock = threading.Lock()
+
+    def available(self):
+        return os.path.exists(self.socket_path)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.reader = None
+
+    def connect(self):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(HELPER_TIMEOUT)
+            self.sock.connect(self.socket_path)
+            self.reader = self.sock.makefile('rb')
+
+    def call(self, op, **params):
+        """
+        Gửi request tới helper, trả về response dict hoặc None nếu helper không dùng được.
+        Chỉ thử lại (và để caller fallback về sudo) khi request chưa gửi đi được; đã gửi rồi
+        mà mất kết nối/timeout thì helper có thể đã chạy op, trả về lỗi thay vì chạy lại lần nữa
+        """
+        if not self.available():
+            return None
+
+        params['op'] = op
+        message = (json.dumps(params) + "\n").encode()
+        with self.lock:
+            # Thử lại một lần nếu kết nối cũ đã bị đóng (helper restart: sendall báo EPIPE)
+            for attempt in range(2):
+                try:
+                    self.connect()
+                    self.sock.sendall(message)
+                except OSError as e:
+                    self.close()
+                    if attempt:
+                        logger.warning(f"Privileged helper unavailable, falling back to sudo: {e}")
+                    continue
+
+                try:
+                    line = self.reader.readline()
+                    if not line:
+                        raise ConnectionError('Helper closed connection')
+                    return json.loads(line)
+
+                except (OSError, ValueError) as e:
+                    self.close()
+                    logger.error(f"Privileged helper '{op}' failed after the request was sent: {e}")
+                    return {'ok': False, 'error': f"Helper '{op}' did not complete (outcome unknown): {e}"}
+
+        return None
+
+    def open_file(self, path):
+        """
+        Helper mở file bằng quyền root và gửi fd qua SCM_RIGHTS (response là một dòng JSON).
+        Trả về fd, hoặc None nếu helper không dùng được. Helper từ chối thì raise PermissionError
+        """
+        if not self.available():
+            return None
+
+        message = (json.dumps({'op': 'open_file', 'path': path}) + "\n").encode()
+        with self.lock:
+            for attempt in range(2):
+                fds = []
+                try:
+                    self.connect()
+                    self.sock.sendall(message)
+                    data, fds, _, _ = socket.recv_fds(self.sock, 4096, 1)
+                    while data and not data.endswith(b'\n'):
+                        more = self.sock.recv(4096)
+                        if not more:
+                            break
+                        data += more
+                    if not data.endswith(b'\n'):
+                        raise ConnectionError('Helper closed connection')
+                    response = json.loads(data)
+                    break
+
+                except (OSError, ValueError) as e:
+                    for fd in fds:
+                        os.close(fd)
+                    self.close()
+                    if attempt:
+                        logger.warning(f"Privileged helper unavailable for open_file: {e}")
+            else:
+                return None
+
+        if not response.get('ok') or not fds:
+            for fd in fds:
+                os.close(fd)
+            raise PermissionError(response.get('error', f'Helper did not return a file descriptor for {path}'))
+        return fds[0]
+
+
+class BundleError(Exception):
+    """Bundle không hợp lệ hoặc install thất bại (đã rollback)"""
+
+
+class FrameError(Exception):
+    """Frame không hợp lệ (sai magic hoặc quá lớn)"""
+
+
+class FrameDecoder:
+    """
+    Incremental decoder cho length-prefixed frames.
+    Mỗi byte nhận được chỉ được copy vào buffer và cắt ra payload đúng một lần,
+    không decode/parse lại toàn bộ buffer sau mỗi chunk như legacy mode.
+    """
+
+    def __init__(self, max_frame_size=MAX_MESSAGE_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.pending_length = None  # Payload length của frame đang nhận
+        self.pending_type = None
+
+    def feed(self, data):
+        """Thêm data mới, trả về list (frame_type, payload) đã hoàn chỉnh"""
+        self.buffer += data
+        frames = []
+        pos = 0
+
+        while True:
+            if self.pending_length is None:
+                if len(self.buffer) - pos < FRAME_HEADER.size:
+                    break
+                magic, frame_type, length = FRAME_HEADER.unpack_from(self.buffer, pos)
+                if magic != FRAME_MAGIC:
+                    raise FrameError(f"Invalid frame magic: {magic:#x}")
+                if length > self.max_frame_size:
+                    raise FrameError(f"Frame too large: {length} bytes")
+                pos += FRAME_HEADER.size
+                self.pending_type = frame_type
+                self.pending_length = length
+
+            if len(self.buffer) - pos < self.pending_length:
+                break
+
+            end = pos + self.pending_length
+            frames.append((self.pending_type, bytes(self.buffer[pos:end])))
+            pos = end
+            self.pending_type = None
+            self.pending_length = None
+
+        # Chỉ giữ lại phần chưa đủ một frame
+        if pos:
+            del self.buffer[:pos]
+        return frames
+
+    def buffered_size(self):
+        return len(self.buffer)
+
+class ReceiveBudget:
+    """
+    Budget bộ nhớ toàn cục cho bytes đang nằm trong receive buffers của các client.
+    Reader gọi acquire() trước mỗi recv và bị block khi vượt RECEIVE_MEMORY_BUDGET
+    hoặc RECEIVE_CLIENT_CAP. Client giữ reservation lâu nhất luôn được đi tiếp
+    (chỉ bị giới hạn bởi MAX_MESSAGE_SIZE), nên không thể deadlock khi mọi client
+    đều đang chờ và một message lớn hơn budget vẫn nhận được.
+    """
+
+    def __init__(self, limit, client_cap):
+        self.limit = limit
+        self.client_cap = client_cap
+        self.holders = {}  # client -> bytes đang giữ (theo thứ tự bắt đầu giữ)
+        self.detached = {}  # client -> bytes của commands đang xử lý bất đồng bộ
+        self.client_stats = {}  # client -> {'peak', 'stall_time', 'stalls'}
+        self.used = 0
+        self.peak = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def can_take(self, client, nbytes):
+        held = self.holders.get(client, 0)
+        if held and next(iter(self.holders)) is client:
+            return True
+        return self.used + nbytes <= self.limit and held + nbytes <= self.client_cap
+
+    def acquire(self, client, nbytes):
+        """Giữ nbytes cho client, block tới khi budget cho phép"""
+        with self.condition:
+            stats = self.client_stats.setdefault(client, {'peak': 0, 'stall_time': 0.0, 'stalls': 0})
+            if not self.can_take(client, nbytes):
+                started = time.time()
+                self.stalls += 1
+                stats['stalls'] += 1
+                self.waiting += 1
+                while not self.can_take(client, nbytes):
+                    self.condition.wait()
+                self.waiting -= 1
+                stalled = time.time() - started
+                self.stall_time += stalled
+                stats['stall_time'] += stalled
+
+            held = self.holders.get(client, 0) + nbytes
+            self.holders[client] = held
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+            stats['peak'] = max(stats['peak'], held)
+
+    def settle(self, client, nbytes):
+        """Đặt lại số bytes client thật sự còn giữ (phần đã xử lý xong được trả lại budget)"""
+        with self.condition:
+            held = self.holders.get(client, 0)
+            total = nbytes + self.detached.get(client, 0)
+            if total:
+                self.holders[client] = total  # Client vẫn giữ bytes thì giữ nguyên thứ tự
+            else:
+                self.holders.pop(client, None)
+            self.used += total - held
+            if total < held:
+                self.condition.notify_all()
+
+    def detach(self, client, nbytes):
+        """nbytes của một command được giữ tới khi finish(), kể cả sau khi reader đã đọc tiếp"""
+        with self.condition:
+            self.detached[client] = self.detached.get(client, 0) + nbytes
+
+    def finish(self, client, nbytes):
+        with self.condition:
+            remaining = self.detached.get(client, 0) - nbytes
+            if remaining > 0:
+                self.detached[client] = remaining
+            else:
+                self.detached.pop(client, None)
+
+            held = self.holders.get(client, 0) - nbytes
+            if held > 0:
+                self.holders[client] = held
+            else:
+                self.holders.pop(client, None)
+            self.used -= nbytes
+            self.condition.notify_all()
+
+    def release(self, client):
+        """Client ngắt kết nối: trả toàn bộ, trả về stats của client"""
+        self.settle(client, 0)
+        with self.condition:
+            return self.client_stats.pop(client, None)
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                'limit': self.limit,
+                'client_cap': self.client_cap,
+                'buffered': self.used,
+                'peak_buffered': self.peak,
+                'clients_buffering': len(self.holders),
+                'clients_waiting': self.waiting,
+                'stalls': self.stalls,
+                'stall_time': round(self.stall_time, 3)
+            }
+
+
+class ActionStats:
+    """
+    Counters theo action: số lần gọi, số lỗi, histogram latency (bucket cố định),
+    bytes nhận/gửi. Chỉ là các list số nguyên kích thước cố định, cập nhật dưới một lock
+    """
 
-class RemoteControlService:
     def __init__(self):
-        self.clients = []
-        self.server_socket = None
+        self.lock = threading.Lock()
+        self.started_time = time.time()
+        self.actions = {}  # action -> [count, errors, bytes_in, bytes_out, total_ms, max_ms, buckets]
 
-        # Ensure upload directories exist (with proper permissions)
-        for ext, directory in ALLOWED_EXTENSIONS.items():
+    def entry(self, action):
+        """Entry của action (gọi khi giữ lock)"""
+        entry = self.actions.get(action)
+        if entry is None:
+            if len(self.actions) >= STATS_MAX_ACTIONS:
+                action = 'other'
+                entry = self.actions.get(action)
+            if entry is None:
+                entry = self.actions[action] = [0, 0, 0, 0, 0.0, 0.0, [0] * (len(STATS_LATENCY_BUCKETS_MS) + 1)]
+        return entry
+
+    def record(self, action, elapsed_ms, failed):
+        bucket = len(STATS_LATENCY_BUCKETS_MS)
+        for index, limit in enumerate(STATS_LATENCY_BUCKETS_MS):
+            if elapsed_ms <= limit:
+                bucket = index
+                break
+
+        with self.lock:
+            entry = self.entry(action)
+            entry[0] += 1
+            entry[1] += failed
+            entry[4] += elapsed_ms
+            entry[5] = max(entry[5], elapsed_ms)
+            entry[6][bucket] += 1
+
+    def add_received(self, action, nbytes):
+        with self.lock:
+            self.entry(action)[2] += nbytes
+
+    def add_sent(self, action, nbytes):
+        with self.lock:
+            self.entry(action)[3] += nbytes
+
+    def reset(self):
+        with self.lock:
+            self.actions = {}
+            self.started_time = time.time()
+
+    def snapshot(self):
+        with self.lock:
+            actions = {}
+            for action, (count, errors, bytes_in, bytes_out, total_ms, max_ms, buckets) in self.actions.items():
+                actions[action] = {
+                    'count': count,
+                    'errors': errors,
+                    'bytes_received': bytes_in,
+                    'bytes_sent': bytes_out,
+                    'mean_ms': round(total_ms / count, 3) if count else None,
+                    'max_ms': round(max_ms, 3),
+                    'latency_histogram': list(buckets)
+                }
+            return {
+                'since': self.started_time,
+                'latency_buckets_ms': list(STATS_LATENCY_BUCKETS_MS) + ['inf'],
+                'actions': actions
+            }
+
+
+class TelemetryRing:
+    """
+    Một độ phân giải telemetry: ring buffer cấp phát sẵn (avg và max mỗi metric)
+    cộng accumulator của điểm đang gom. Điểm được chốt khi sample rơi sang bucket mới
+    """
+
+    def __init__(self, name, step, capacity, metric_count):
+        self.name = name
+        self.step = step
+        self.capacity = capacity
+        self.metric_count = metric_count
+        self.timestamps = array('d', [0.0] * capacity)
+        self.avg = array('d', [math.nan] * (capacity * metric_count))
+        self.max = array('d', [math.nan] * (capacity * metric_count))
+        self.head = 0  # Slot ghi tiếp theo
+        self.count = 0
+        self.bucket = None  # Bucket đang gom (timestamp // step)
+        self.sums = array('d', [0.0] * metric_count)
+        self.counts = array('I', [0] * metric_count)
+        self.peaks = array('d', [-math.inf] * metric_count)
+
+    def add(self, timestamp, values):
+        bucket = int(timestamp // self.step)
+        if self.bucket is not None and bucket != self.bucket:
+            self.flush()
+        self.bucket = bucket
+
+        for index, value in enumerate(values):
+            if value == value:  # NaN = metric không đọc được
+                self.sums[index] += value
+                self.counts[index] += 1
+                if value > self.peaks[index]:
+                    self.peaks[index] = value
+
+    def flush(self):
+        """Chốt điểm đang gom vào slot tiếp theo (ghi đè điểm cũ nhất khi đầy)"""
+        base = self.head * self.metric_count
+        self.timestamps[self.head] = self.bucket * self.step
+        for index in range(self.metric_count):
+            count = self.counts[index]
+            self.avg[base + index] = self.sums[index] / count if count else math.nan
+            self.max[base + index] = self.peaks[index] if count else math.nan
+            self.sums[index] = 0.0
+            self.counts[index] = 0
+            self.peaks[index] = -math.inf
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def points(self, since=None, limit=None, columns=None):
+        """
+        Các điểm cũ -> mới (kèm điểm đang gom, đánh dấu partial).
+        Trả về (timestamps, avg_columns, max_columns, partial)
+        """
+        columns = range(self.metric_count) if columns is None else columns
+        rows = []
+        for offset in range(self.count):
+            slot = (self.head - self.count + offset) % self.capacity
+            if since is None or self.timestamps[slot] > since:
+                base = slot * self.metric_count
+                rows.append((self.timestamps[slot],
+                             [self.avg[base + index] for index in columns],
+                             [self.max[base + index] for index in columns]))
+
+        partial = self.bucket is not None and (since is None or self.bucket * self.step > since)
+        if partial:
+            rows.append((self.bucket * self.step,
+                         [self.sums[index] / self.counts[index] if self.counts[index] else math.nan
+                          for index in columns],
+                         [self.peaks[index] if self.counts[index] else math.nan for index in columns]))
+        if limit is not None:
+            rows = rows[-limit:] if limit else []
+            partial = partial and bool(rows)
+
+        timestamps = [row[0] for row in rows]
+        avg_columns = [[row[1][position] for row in rows] for position in range(len(columns))]
+        max_columns = [[row[2][position] for row in rows] for position in range(len(columns))]
+        return timestamps, avg_columns, max_columns, partial
+
+
+class TelemetrySampler:
+    """
+    Đọc CPU, memory, swap, load, nhiệt độ và I/O của SD card từ /proc, /sys mỗi
+    TELEMETRY_INTERVAL giây. Mỗi sample được cộng thẳng vào accumulator của mọi
+    TelemetryRing (1s / 1m / 1h), không cấp phát gì thêm theo thời gian.
+    File descriptors mở một lần, đọc lại bằng pread
+    """
+
+    def __init__(self, interval=TELEMETRY_INTERVAL, windows=TELEMETRY_WINDOWS):
+        self.interval = interval
+        self.metrics = list(TELEMETRY_METRICS)
+        self.rings = {name: TelemetryRing(name, step, capacity, len(self.metrics))
+                      for name, step, capacity in windows}
+        self.lock = threading.Lock()
+        self.fds = {}  # path -> fd
+        self.thermal_paths = []
+        self.previous_cpu = None  # (total, idle, iowait)
+        self.previous_disks = None  # device -> (sectors_read, sectors_written, io_ticks)
+        self.previous_time = None
+        self.latest = None  # (timestamp, values)
+        self.started_time = None
+        self.samples = 0
+        self.cpu_time = 0.0  # CPU time của sampler thread
+
+    def start(self):
+        try:
+            zones = sorted(os.listdir('/sys/class/thermal'))
+        except OSError:
+            zones = []
+        self.thermal_paths = [f'/sys/class/thermal/{zone}/temp' for zone in zones
+                              if zone.startswith('thermal_zone')]
+        self.started_time = time.time()
+        threading.Thread(target=self.run, daemon=True).start()
+        logger.info(f"Telemetry sampler: every {self.interval}s, {len(self.thermal_paths)} thermal zones")
+
+    def run(self):
+        next_tick = time.monotonic()
+        while True:
+            started = time.thread_time()
             try:
-                if directory == '/home/orangepi':
-                    os.makedirs(directory, exist_ok=True)
-                # Note: /usr/local/bin and /etc/systemd/system should already exist
-                # and need root permissions to write
-            except PermissionError:
-                logger.warning(f"Cannot create directory {directory} - need root permissions")
+                self.sample()
+            except Exception as e:
+                logger.error(f"Telemetry sample failed: {e}")
+            self.cpu_time += time.thread_time() - started
 
-    def receive_full_message(self, client_socket):
-        """Nhận đầy đủ JSON message từ client"""
-        buffer = b""
+            next_tick += self.interval
+            delay = next_tick - time.monotonic()
+            if delay < 0:
+                next_tick = time.monotonic()  # Bị trễ (suspend, quá tải): không đuổi theo
+                delay = 0
+            time.sleep(delay)
 
+    def read(self, path):
+        fd = self.fds.get(path)
+        if fd is None:
+            fd = self.fds[path] = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
         try:
-            # Nhận data theo chunks
-            while True:
-                chunk = client_socket.recv(65536)  # 64KB chunks
-                if not chunk:
-                    logger.warning("No more data received")
-                    break
+            return os.pread(fd, 65536, 0)
+        except OSError:
+            os.close(fd)
+            del self.fds[path]
+            raise
 
-                buffer += chunk
-                logger.debug(f"Received chunk: {len(chunk)} bytes, total buffer: {len(buffer)} bytes")
+    def sample(self):
+        now = time.time()
+        elapsed = now - self.previous_time if self.previous_time else None
+        self.previous_time = now
+        values = [math.nan] * len(self.metrics)
 
-                # Try to decode và parse JSON
-                try:
-                    message_str = buffer.decode('utf-8')
+        try:
+            fields = [int(value) for value in self.read('/proc/stat').split(b'\n', 1)[0].split()[1:9]]
+            total, idle, iowait = sum(fields), fields[3] + fields[4], fields[4]
+            if self.previous_cpu and total > self.previous_cpu[0]:
+                delta = total - self.previous_cpu[0]
+                values[0] = 100.0 * (delta - (idle - self.previous_cpu[1])) / delta
+                values[1] = 100.0 * (iowait - self.previous_cpu[2]) / delta
+            self.previous_cpu = (total, idle, iowait)
+        except (OSError, ValueError, IndexError):
+            pass
 
-                    # Thử parse JSON
-                    command = json.loads(message_str)
-                    logger.info(f"Successfully received complete JSON: {len(message_str)} bytes")
-                    return command
+        try:
+            meminfo = {}
+            for line in self.read('/proc/meminfo').splitlines():
+                key, _, rest = line.partition(b':')
+                if key in (b'MemTotal', b'MemAvailable', b'SwapTotal', b'SwapFree'):
+                    meminfo[key] = int(rest.split()[0])
+            if meminfo.get(b'MemTotal'):
+                values[2] = 100.0 * (1 - meminfo.get(b'MemAvailable', 0) / meminfo[b'MemTotal'])
+            if meminfo.get(b'SwapTotal'):
+                values[3] = 100.0 * (1 - meminfo.get(b'SwapFree', 0) / meminfo[b'SwapTotal'])
+            elif b'SwapTotal' in meminfo:
+                values[3] = 0.0
+        except (OSError, ValueError, IndexError):
+            pass
 
-                except json.JSONDecodeError as e:
-                    # JSON chưa complete, tiếp tục nhận
-                    logger.debug(f"Incomplete JSON, continuing... Error: {e}")
+        temps = []
+        for path in self.thermal_paths:
+            try:
+                temps.append(int(self.read(path)) / 1000.0)
+            except (OSError, ValueError):
+                pass
+        if temps:
+            values[4] = max(temps)
 
-                    # Kiểm tra size limit
-                    if len(buffer) > 200 * 1024 * 1024:  # 200MB limit
-                        logger.error("Message too large, aborting")
-                        break
-                    continue
+        try:
+            values[5] = float(self.read('/proc/loadavg').split()[0])
+        except (OSError, ValueError, IndexError):
+            pass
 
-                except UnicodeDecodeError:
-                    # UTF-8 decode lỗi, có thể data chưa đủ
-                    logger.debug("Unicode decode error, continuing...")
-                    if len(buffer) > 200 * 1024 * 1024:
-                        logger.error("Message too large, aborting")
-                        break
-                    continue
+        try:
+            disks = {}
+            for line in self.read('/proc/diskstats').splitlines():
+                parts = line.split()
+                if len(parts) >= 13 and TELEMETRY_DISK_PATTERN.match(parts[2].decode()):
+                    disks[parts[2]] = (int(parts[5]), int(parts[9]), int(parts[12]))
+            if self.previous_disks is not None and elapsed:
+                read_bytes = written_bytes = 0
+                busy = 0.0
+                for device, (sectors_read, sectors_written, io_ticks) in disks.items():
+                    previous = self.previous_disks.get(device)
+                    if previous:
+                        read_bytes += (sectors_read - previous[0]) * 512
+                        written_bytes += (sectors_written - previous[1]) * 512
+                        busy = max(busy, (io_ticks - previous[2]) / (elapsed * 10.0))
+                values[6] = read_bytes / elapsed
+                values[7] = written_bytes / elapsed
+                values[8] = min(busy, 100.0)
+            self.previous_disks = disks
+        except (OSError, ValueError, IndexError):
+            pass
 
-        except socket.error as e:
-            logger.error(f"Socket error while receiving: {e}")
-        except Exception as e:
-            logger.error(f"Unexpected error receiving message: {e}")
+        with self.lock:
+            for ring in self.rings.values():
+                ring.add(now, values)
+            self.latest = (now, values)
+            self.samples += 1
 
-        logger.warning("Failed to receive complete message")
-        return None
+    def latest_value(self, metric):
+        """Giá trị mới nhất của metric, None nếu chưa có hoặc không đọc được"""
+        with self.lock:
+            if self.latest is None:
+                return None
+            value = self.latest[1][self.metrics.index(metric)]
+            return None if value != value else value
 
-    def handle_client(self, client_socket, client_address):
-        """Xử lý kết nối từ client"""
-        logger.info(f"Client connected from {client_address}")
-        self.clients.append(client_socket)
+    @staticmethod
+    def clean(value):
+        """NaN -> None (JSON hợp lệ cho client), làm tròn 2 chữ số"""
+        return None if value != value else round(value, 2)
 
-        # Set socket timeout to None (no timeout)
-        client_socket.settimeout(None)
+    def current(self):
+        with self.lock:
+            if self.latest is None:
+                return None
+            timestamp, values = self.latest
+            return dict({'timestamp': timestamp},
+                        **{metric: self.clean(value) for metric, value in zip(self.metrics, values)})
+
+    def query(self, window, since=None, limit=None, metrics=None):
+        ring = self.rings.get(window) if isinstance(window, str) else None
+        if ring is None:
+            raise ValueError(f'Unknown window {window!r}. Valid windows: {list(self.rings)}')
+        metrics = self.metrics if not metrics else metrics
+        unknown = [metric for metric in metrics if metric not in TELEMETRY_METRICS]
+        if unknown:
+            raise ValueError(f'Unknown metrics {unknown}. Valid metrics: {self.metrics}')
+        columns = [self.metrics.index(metric) for metric in metrics]
+
+        with self.lock:
+            timestamps, avg_columns, max_columns, partial = ring.points(since, limit, columns)
 
+        result = {
+            'window': window,
+            'step': ring.step,
+            'timestamps': timestamps,
+            'values': {metric: [self.clean(value) for value in column]
+                       for metric, column in zip(metrics, avg_columns)},
+            'partial': partial
+        }
+        if ring.step > self.interval:
+            result['max'] = {metric: [self.clean(value) for value in column]
+                             for metric, column in zip(metrics, max_columns)}
+        return result
+
+    def get_stats(self):
+        uptime = time.time() - self.started_time if self.started_time else 0
+        return {
+            'interval': self.interval,
+            'samples': self.samples,
+            'sampler_cpu_percent': round(100.0 * self.cpu_time / uptime, 4) if uptime else None,
+            'windows': [{'window': ring.name, 'step': ring.step, 'capacity': ring.capacity,
+                         'points': ring.count} for ring in self.rings.values()]
+        }
+
+
+class TransferThrottle:
+    """
+    Token bucket dùng chung cho bulk transfers (ghi file upload, gửi download frames).
+    Rate là bandwidth_limit (0 = không giới hạn); khi kiosk bận, tức CPU của các process
+    khác (đo từ telemetry, trừ phần của chính system-control) vượt busy_cpu, rate giảm
+    còn busy_rate. Bucket cho phép nợ: consume() ghi trước rồi ngủ đủ phần vượt quá,
+    transfer lane chậm lại thì ReceiveBudget làm reader dừng đọc (TCP back-pressure)
+    """
+
+    def __init__(self, telemetry, settings_path):
+        self.telemetry = telemetry
+        self.settings_path = settings_path
+        self.bandwidth_limit = TRANSFER_BANDWIDTH_LIMIT
+        self.busy_rate = TRANSFER_BUSY_RATE
+        self.busy_cpu = TRANSFER_BUSY_CPU
+        self.lock = threading.Lock()
+        self.tokens = TRANSFER_BURST
+        self.last_refill = time.monotonic()
+        self.busy = False
+        self.kiosk_cpu = None
+        self.last_check = None  # (monotonic, process_time)
+        self.throttled_bytes = 0
+        self.wait_time = 0.0
+        self.load()
+
+    def load(self):
         try:
-            while True:
-                command = self.receive_full_message(client_socket)
-                if command is None:
-                    logger.warning("Received None command, breaking connection")
-                    break
+            with open(self.settings_path) as f:
+                self.configure(**json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"Ignoring transfer limits in {self.settings_path}: {e}")
 
-                if not isinstance(command, dict):
-                    logger.error(f"Invalid command type: {type(command)}")
-                    continue
+    def configure(self, bandwidth_limit=None, busy_rate=None, busy_cpu=None):
+        for key, value in (('bandwidth_limit', bandwidth_limit), ('busy_rate', busy_rate), ('busy_cpu', busy_cpu)):
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+                raise ValueError(f'{key} must be a non-negative number')
+        with self.lock:
+            if bandwidth_limit is not None:
+                self.bandwidth_limit = bandwidth_limit
+            if busy_rate is not None:
+                self.busy_rate = busy_rate
+            if busy_cpu is not None:
+                self.busy_cpu = busy_cpu
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.settings_path), exist_ok=True)
+        temp_path = self.settings_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.get_settings(), f)
+        os.replace(temp_path, self.settings_path)
+
+    def get_settings(self):
+        return {'bandwidth_limit': self.bandwidth_limit, 'busy_rate': self.busy_rate, 'busy_cpu': self.busy_cpu}
+
+    def update_load(self, now):
+        """Đo lại CPU của kiosk tối đa mỗi TRANSFER_LOAD_CHECK_INTERVAL (gọi khi giữ lock)"""
+        process_time = time.process_time()
+        if self.last_check is not None and now - self.last_check[0] < TRANSFER_LOAD_CHECK_INTERVAL:
+            return
+        previous, self.last_check = self.last_check, (now, process_time)
+        total_cpu = self.telemetry.latest_value('cpu')
+        if previous is None or total_cpu is None:
+            return
+
+        own_cpu = 100.0 * (process_time - previous[1]) / ((now - previous[0]) * (os.cpu_count() or 1))
+        self.kiosk_cpu = max(0.0, total_cpu - own_cpu)
+        # Hysteresis để rate không dao động quanh ngưỡng
+        threshold = self.busy_cpu - TRANSFER_BUSY_HYSTERESIS if self.busy else self.busy_cpu
+        busy = self.kiosk_cpu >= threshold
+        if busy != self.busy:
+            logger.info(f"Kiosk {'busy' if busy else 'idle'} (other processes {self.kiosk_cpu:.0f}% CPU), "
+                        f"transfer rate {'limited' if busy else 'restored'}")
+            self.busy = busy
+
+    def current_rate(self):
+        """Bytes/s được phép lúc này, 0 = không giới hạn (gọi khi giữ lock)"""
+        rates = [rate for rate in (self.bandwidth_limit, self.busy_rate if self.busy else 0) if rate]
+        return min(rates) if rates else 0
+
+    def consume(self, nbytes):
+        with self.lock:
+            now = time.monotonic()
+            self.update_load(now)
+            rate = self.current_rate()
+            if not rate:
+                self.tokens = TRANSFER_BURST
+                self.last_refill = now
+                return
+
+            self.tokens = min(TRANSFER_BURST, self.tokens + (now - self.last_refill) * rate) - nbytes
+            self.last_refill = now
+            delay = -self.tokens / rate if self.tokens < 0 else 0
+            if delay:
+                self.throttled_bytes += nbytes
+                self.wait_time += delay
+
+        if delay:
+            time.sleep(delay)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.get_settings(), **{
+                'rate': self.current_rate(),
+                'busy': self.busy,
+                'kiosk_cpu': round(self.kiosk_cpu, 1) if self.kiosk_cpu is not None else None,
+                'throttled_bytes': self.throttled_bytes,
+                'wait_time': round(self.wait_time, 3),
+                'nice': BULK_NICE,
+                'io_class': BULK_IO_CLASS,
+                'io_level': BULK_IO_LEVEL
+            })
+
+
+class StreamingFileWriter:
+    """
+    Ghi file theo từng chunk vào temp file trong chính destination directory,
+    hash md5/sha256 ngay khi nhận bytes, fsync rồi atomic rename vào file đích.
+    File đích không bao giờ ở trạng thái ghi dở.
 
-                action = command.get('action', 'unknown')
-                logger.info(f"Processing command: {action}")
+    Nếu destination dir không ghi được (vd /usr/local/bin), temp file nằm trong
+    staging dir và được install bằng một lệnh sudo duy nhất (install + mv).
+    """
 
+    def __init__(self, file_path, file_ext, staging_dir, temp_path=None, throttle=None):
+        self.file_path = file_path
+        self.throttle = throttle  # TransferThrottle: giới hạn tốc độ ghi
+        self.mode = 0o755 if file_ext == '.sh' else 0o644
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+        if temp_path and os.path.exists(temp_path):
+            # Resume: hash lại phần đã ghi rồi ghi tiếp vào cuối file
+            self.temp_path = temp_path
+            self.file = open(temp_path, 'r+b')
+            for block in iter(lambda: self.file.read(CHUNK_SIZE), b''):
+                self.md5.update(block)
+                self.sha256.update(block)
+                self.size += len(block)
+        else:
+            prefix = f'.{os.path.basename(file_path)}.'
+            try:
+                fd, self.temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=prefix, suffix='.tmp')
+            except PermissionError:
+                os.makedirs(staging_dir, exist_ok=True)
+                fd, self.temp_path = tempfile.mkstemp(dir=staging_dir, prefix=prefix, suffix='.tmp')
+            self.file = os.fdopen(fd, 'wb')
+
+        self.in_destination = os.path.dirname(self.temp_path) == os.path.dirname(file_path)
+
+    def write(self, data):
+        if self.throttle is not None:
+            self.throttle.consume(len(data))
+        self.file.write(data)
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def hexdigest(self, algorithm):
+        return self.sha256.hexdigest() if algorithm == 'sha256' else self.md5.hexdigest()
+
+    def prepare(self):
+        """fsync + chmod temp file, sẵn sàng để install"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        os.fchmod(self.file.fileno(), self.mode)
+        self.close()
+
+    def install_command(self):
+        """Shell command install temp file vào file đích (dùng khi cần quyền root)"""
+        if self.in_destination:
+            return f"mv -f {shlex.quote(self.temp_path)} {shlex.quote(self.file_path)}"
+
+        # Copy vào destination dưới tên tạm rồi rename
+        dest_temp = os.path.join(os.path.dirname(self.file_path), os.path.basename(self.temp_path))
+        return (f"install -m {self.mode:o} {shlex.quote(self.temp_path)} {shlex.quote(dest_temp)} && "
+                f"sync {shlex.quote(dest_temp)} && mv -f {shlex.quote(dest_temp)} {shlex.quote(self.file_path)}")
+
+    def install_cleanup_command(self):
+        """Shell command xoá file tạm còn sót trong destination nếu install bị huỷ giữa chừng"""
+        if self.in_destination:
+            return f"rm -f {shlex.quote(self.temp_path)}"
+        dest_temp = os.path.join(os.path.dirname(self.file_path), os.path.basename(self.temp_path))
+        return f"rm -f {shlex.quote(dest_temp)}"
+
+    def commit(self, helper=None):
+        """
+        fsync temp file và atomic rename vào file đích. Trả về (success, message).
+        Nếu cần quyền root thì dùng privileged helper, không có helper thì dùng sudo
+        """
+        try:
+            self.prepare()
+
+            if self.in_destination:
+                os.replace(self.temp_path, self.file_path)
+                dir_fd = os.open(os.path.dirname(self.file_path), os.O_RDONLY)
                 try:
-                    if action == 'ping':
-                        # Respond to ping for device discovery
-                        self.send_response(client_socket, {
-                            'action': 'pong',
-                            'service': 'orangepi-remote-control',
-                            'version': '1.0'
-                        })
-                    elif action == 'upload_file':
-                        self.handle_file_upload(command, client_socket)
-                    elif action == 'list_files':
-                        self.list_uploaded_files(client_socket)
-                    elif action == 'execute_script':
-                        self.handle_script_execution(command, client_socket)
-                    elif action == 'list_services':
-                        self.list_custom_services(client_socket)
-                    elif action == 'manage_service':
-                        self.handle_service_management(command, client_socket)
-                    else:
-                        logger.warning(f"Unknown action: {action}")
-                        self.send_response(client_socket, {
-                            "error": f"Unknown action: {action}"
-                        })
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+                return True, "Success"
 
-                except Exception as e:
-                    logger.error(f"Error handling command '{action}': {e}")
-                    self.send_response(client_socket, {"error": str(e)})
+            response = helper.call('install_file', src=self.temp_path, dest=self.file_path,
+                                   mode=self.mode) if helper else None
+            if response is not None:
+                os.unlink(self.temp_path)
+                if not response.get('ok'):
+                    return False, f"Helper failed: {response.get('error')}"
+                return True, "Success with helper"
+
+            logger.info(f"Using sudo to install file to {self.file_path}")
+            result = run_privileged_script(self.install_command())
+            os.unlink(self.temp_path)
+
+            if result.returncode != 0:
+                return False, f"Sudo failed: {result.stderr}"
+            return True, "Success with sudo"
 
         except Exception as e:
-            logger.error(f"Client handler error: {e}")
-        finally:
-            if client_socket in self.clients:
-                self.clients.remove(client_socket)
-            client_socket.close()
-            logger.info(f"Client {client_address} disconnected")
+            self.abort()
+            return False, f"Write error: {e}"
 
-    def send_response(self, client_socket, response):
-        """Gửi response về client"""
+    def abort(self):
+        """Bỏ file tạm, file đích giữ nguyên"""
+        self.close()
         try:
-            message = json.dumps(response) + "\n"
-            client_socket.sendall(message.encode())
-        except Exception as e:
-            logger.error(f"Error sending response: {e}")
+            os.unlink(self.temp_path)
+        except FileNotFoundError:
+            pass
 
-    def broadcast_response(self, response):
-        """Gửi response tới tất cả clients"""
-        for client in self.clients[:]:
+
+class DeployHistory:
+    """
+    Lịch sử deploy của managed files. Trước khi install, bản hiện tại được hardlink vào
+    history_dir/<deploy_id>/ - không tốn thêm dung lượng vì mọi kiểu install đều rename
+    inode mới vào chỗ file cũ, inode cũ chỉ còn được giữ bởi snapshot.
+    Giữ HISTORY_MAX_DEPLOYS deploy gần nhất, index lưu trong history_dir/index.json
+    """
+
+    def __init__(self, history_dir, helper):
+        self.history_dir = history_dir
+        self.index_path = os.path.join(history_dir, 'index.json')
+        self.helper = helper
+        self.deploys = []  # Cũ -> mới
+        self.lock = threading.Lock()
+
+        try:
+            with open(self.index_path, 'r') as f:
+                self.deploys = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Cannot load deploy history {self.index_path}: {e}")
+
+    def begin(self, source, deploy_id=None):
+        return {
+            'deploy_id': deploy_id or uuid.uuid4().hex[:12],
+            'time': time.time(),
+            'source': source,
+            'files': []
+        }
+
+    def snapshot(self, deploy, file_path, sha256=None):
+        """Snapshot bản hiện tại của file_path (nếu có) vào deploy, gọi trước khi install"""
+        entry = {'file_path': file_path, 'existed': os.path.isfile(file_path), 'snapshot': None,
+                 'sha256_before': sha256}
+        deploy['files'].append(entry)
+        if not entry['existed']:
+            return
+
+        snapshot_dir = os.path.join(self.history_dir, deploy['deploy_id'])
+        snapshot_path = os.path.join(snapshot_dir, os.path.basename(file_path))
+        try:
+            os.makedirs(snapshot_dir, exist_ok=True)
+            self.link(file_path, snapshot_path)
+            entry['snapshot'] = snapshot_path
+        except (OSError, subprocess.SubprocessError) as e:
+            # Vẫn install, nhưng file này không rollback được
+            logger.warning(f"Cannot snapshot {file_path}: {e}")
+            entry['error'] = str(e)
+
+    def link(self, src, dest):
+        """Hardlink src -> dest; file của root thì qua privileged helper hoặc sudo"""
+        try:
+            os.link(src, dest)
+            return
+        except PermissionError:
+            pass  # fs.protected_hardlinks: không link được file của root
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copy2(src, dest)
+            return
+
+        response = self.helper.call('snapshot_file', src=src, dest=dest)
+        if response is not None:
+            if not response.get('ok'):
+                raise OSError(f"Helper failed: {response.get('error')}")
+            return
+
+        result = run_privileged_script(f"ln -f {shlex.quote(src)} {shlex.quote(dest)} 2>/dev/null || "
+                                       f"cp -p {shlex.quote(src)} {shlex.quote(dest)}")
+        if result.returncode != 0:
+            raise OSError(f"Sudo failed: {result.stderr.strip()}")
+
+    def commit(self, deploy, installed_hashes):
+        """Ghi nhận deploy đã install xong (installed_hashes: file_path -> sha256 mới)"""
+        for entry in deploy['files']:
+            entry['sha256_after'] = installed_hashes.get(entry['file_path'])
+
+        with self.lock:
+            self.deploys.append(deploy)
+            expired = self.deploys[:-HISTORY_MAX_DEPLOYS]
+            self.deploys = self.deploys[-HISTORY_MAX_DEPLOYS:]
+            data = json.dumps(self.deploys)
+
+        for old in expired:
+            self.discard(old)
+        self.save(data)
+
+    def discard(self, deploy):
+        """Xoá snapshots của deploy (install lỗi hoặc deploy đã quá cũ)"""
+        shutil.rmtree(os.path.join(self.history_dir, deploy['deploy_id']), ignore_errors=True)
+
+    def save(self, data):
+        try:
+            os.makedirs(self.history_dir, exist_ok=True)
+            temp_path = f'{self.index_path}.tmp'
+            with open(temp_path, 'w') as f:
+                f.write(data)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            logger.warning(f"Cannot save deploy history: {e}")
+
+    def get(self, deploy_id=None):
+        """Deploy theo id, hoặc deploy gần nhất nếu deploy_id là None"""
+        with self.lock:
+            if deploy_id is None:
+                return self.deploys[-1] if self.deploys else None
+            return next((deploy for deploy in self.deploys if deploy['deploy_id'] == deploy_id), None)
+
+    def list(self, file_path=None):
+        """Deploys mới nhất trước, lọc theo file nếu có"""
+        with self.lock:
+            deploys = list(reversed(self.deploys))
+        if file_path is not None:
+            deploys = [dict(deploy, files=[entry for entry in deploy['files'] if entry['file_path'] == file_path])
+                       for deploy in deploys]
+            deploys = [deploy for deploy in deploys if deploy['files']]
+        return deploys
+
+
+class StreamDecompressor:
+    """
+    Giải nén streaming (zlib/lzma), mỗi lần trả ra tối đa CHUNK_SIZE bytes
+    để một chunk nén nhỏ không thể bung ra chiếm nhiều RAM
+    """
+
+    def __init__(self, codec):
+        if codec == 'zlib':
+            self.decompressor = zlib.decompressobj()
+        elif codec == 'lzma':
+            self.decompressor = lzma.LZMADecompressor()
+        else:
+            raise ValueError(f'Unsupported compression: {codec}. Supported: {SUPPORTED_COMPRESSION}')
+
+        self.codec = codec
+        self.compressed_size = 0
+        self.raw_size = 0
+        self.decompress_time = 0.0
+
+    def feed(self, data):
+        """Generator trả về từng block đã giải nén từ data"""
+        self.compressed_size += len(data)
+        while True:
+            started = time.monotonic()
+            try:
+                if self.codec == 'zlib':
+                    block = self.decompressor.decompress(data, CHUNK_SIZE)
+                    data = self.decompressor.unconsumed_tail
+                    more = bool(data)
+                else:
+                    block = self.decompressor.decompress(data, max_length=CHUNK_SIZE)
+                    data = b''
+                    more = not self.decompressor.needs_input and not self.decompressor.eof
+            except (zlib.error, lzma.LZMAError, EOFError) as e:
+                # EOFError: lzma nhận thêm bytes sau khi stream đã kết thúc
+                raise ValueError(f'Invalid {self.codec} data: {e}') from e
+            self.decompress_time += time.monotonic() - started
+
+            if block:
+                self.raw_size += len(block)
+                yield block
+            if not more:
+                break
+
+    @property
+    def eof(self):
+        return self.decompressor.eof
+
+    def get_stats(self):
+        return {
+            'codec': self.codec,
+            'compressed_size': self.compressed_size,
+            'raw_size': self.raw_size,
+            'decompress_time': round(self.decompress_time, 4)
+        }
+
+
+class UploadSession:
+    """
+    Một upload session: data được stream vào temp file của StreamingFileWriter,
+    metadata lưu ra file .json để resume được sau khi mất kết nối hoặc restart service
+    """
+
+    def __init__(self, upload_id, filename, file_size, hash_algorithm, expected_hash, staging_dir,
+                 compression=None, bundle=False):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.file_size = file_size
+        self.hash_algorithm = hash_algorithm
+        self.expected_hash = expected_hash
+        self.staging_dir = staging_dir
+        self.compression = compression
+        self.bundle = bundle  # Tar archive cho deploy_bundle, không install trực tiếp
+        # offset tính theo bytes trên đường truyền (compressed stream nếu có nén)
+        self.decompressor = StreamDecompressor(compression) if compression else None
+        self.meta_path = os.path.join(staging_dir, f'{upload_id}.json')
+        self.temp_path = None
+        self.failed = False  # Lỗi sau khi đã ghi một phần chunk, session phải bỏ
+        self.throttle = None  # TransferThrottle của service (set khi open_writer)
+        self.created_time = time.time()
+        self.offset = 0
+        self.last_ack_offset = 0
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def to_dict(self):
+        return {
+            'upload_id': self.upload_id,
+            'filename': self.filename,
+            'file_size': self.file_size,
+            'hash_algorithm': self.hash_algorithm,
+            'expected_hash': self.expected_hash,
+            'temp_path': self.temp_path,
+            'compression': self.compression,
+            'bundle': self.bundle,
+            'created_time': self.created_time
+        }
+
+    @classmethod
+    def load(cls, meta_path, staging_dir):
+        """Load session từ file metadata, offset lấy theo data đã thực sự ghi xuống disk"""
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+
+        session = cls(meta['upload_id'], meta['filename'], meta['file_size'],
+                      meta['hash_algorithm'], meta['expected_hash'], staging_dir,
+                      meta.get('compression'), meta.get('bundle', False))
+        session.created_time = meta.get('created_time', time.time())
+        session.temp_path = meta.get('temp_path')
+        if session.temp_path and os.path.exists(session.temp_path):
+            session.offset = os.path.getsize(session.temp_path)
+        session.last_ack_offset = session.offset
+        return session
+
+    def save(self):
+        with open(self.meta_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    def open_writer(self, file_path, file_ext, throttle=None):
+        """
+        Mở writer (tạo temp file mới hoặc mở lại temp file khi resume).
+        throttle được tính trong write_chunk, ngoài session lock
+        """
+        with self.lock:
+            self.throttle = throttle
+            if self.writer is None:
+                self.writer = StreamingFileWriter(file_path, file_ext, self.staging_dir, self.temp_path)
+                if not self.decompressor:
+                    self.offset = self.writer.size
+                    self.last_ack_offset = self.offset
+                if self.writer.temp_path != self.temp_path:
+                    self.temp_path = self.writer.temp_path
+                    self.save()
+
+    def matches(self, filename, file_size, hash_algorithm, expected_hash, compression):
+        return (self.filename == filename and self.file_size == file_size and
+                self.hash_algorithm == hash_algorithm and self.expected_hash == expected_hash and
+                self.compression == compression)
+
+    def is_complete(self):
+        if self.decompressor and not self.decompressor.eof:
+            return False
+        return self.writer is not None and self.writer.size == self.file_size
+
+    def write_chunk(self, offset, data):
+        """
+        Ghi chunk tại offset. Chunk trùng (đã nhận) được bỏ qua,
+        chunk nhảy cóc thì raise ValueError với offset mong đợi
+        """
+        with self.lock:
+            if self.writer is None:
+                raise ValueError('Upload session not open, send upload_begin first')
+            if offset < 0:
+                raise ValueError(f'Invalid offset {offset}')
+            if offset + len(data) <= self.offset:
+                return self.offset
+            if offset > self.offset:
+                raise ValueError(f'Unexpected offset {offset}, expected {self.offset}')
+
+            # Chunk chồng lên phần đã nhận: chỉ ghi phần mới
+            data = data[self.offset - offset:]
+            written = self.writer.size
+            try:
+                if self.decompressor:
+                    for block in self.decompressor.feed(data):
+                        if self.writer.size + len(block) > self.file_size:
+                            raise ValueError(f'Decompressed data exceeds declared file size ({self.file_size} bytes)')
+                        self.writer.write(block)
+                else:
+                    if self.offset + len(data) > self.file_size:
+                        raise ValueError(f'Chunk exceeds declared file size ({self.file_size} bytes)')
+                    self.writer.write(data)
+            except Exception:
+                # Decompressor hoặc temp file đã đi quá self.offset: không resume tiếp được
+                if self.decompressor or self.writer.size != written:
+                    self.failed = True
+                raise
+
+            self.offset += len(data)
+            new_offset = self.offset
+            written = self.writer.size - written
+
+        # Chờ throttle sau khi nhả lock, để flush/commit/abort của session không bị chặn theo
+        if self.throttle is not None and written:
+            self.throttle.consume(written)
+        return new_offset
+
+    def flush(self):
+        with self.lock:
+            if self.writer is not None:
+                self.writer.flush()
+
+    def close(self):
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+
+    def discard(self):
+        """Xoá temp file và metadata"""
+        with self.lock:
+            if self.writer is not None:
+                self.writer.abort()
+                self.writer = None
+            elif self.temp_path:
+                try:
+                    os.unlink(self.temp_path)
+                except FileNotFoundError:
+                    pass
+        try:
+            os.unlink(self.meta_path)
+        except FileNotFoundError:
+            pass
+
+
+class FileHashIndex:
+    """
+    Index sha256 của các managed files, lưu ra disk để dùng lại qua các lần restart.
+    Entry được coi là còn đúng khi size và mtime của file không đổi
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.entries = {}  # path -> {'size', 'mtime_ns', 'sha256'}
+        self.dirty = False
+        self.lock = threading.Lock()
+
+        try:
+            with open(index_path, 'r') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Cannot load hash index {index_path}: {e}")
+
+    def get_hash(self, path):
+        """sha256 của file (dùng cache nếu size/mtime không đổi), None nếu file không tồn tại"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            with self.lock:
+                if self.entries.pop(path, None) is not None:
+                    self.dirty = True
+            return None
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                return entry['sha256']
+
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha256.update(block)
+
+        self.record(path, sha256.hexdigest(), stat)
+        return sha256.hexdigest()
+
+    def record(self, path, sha256, stat=None):
+        """Cập nhật entry sau khi file vừa được ghi (hash đã biết, không cần đọc lại)"""
+        try:
+            stat = stat or os.stat(path)
+        except OSError:
+            return
+
+        with self.lock:
+            self.entries[path] = {
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'sha256': sha256
+            }
+            self.dirty = True
+
+    def refresh(self, directories):
+        """Hash lại các file thay đổi trong managed directories, bỏ entries của file đã xoá"""
+        seen = set()
+        for file_ext, directory in directories.items():
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for filename in names:
+                path = os.path.join(directory, filename)
+                if filename.endswith(file_ext) and os.path.isfile(path):
+                    try:
+                        self.get_hash(path)
+                        seen.add(path)
+                    except OSError as e:
+                        logger.debug(f"Cannot hash {path}: {e}")
+
+        with self.lock:
+            for path in list(self.entries):
+                if path not in seen:
+                    del self.entries[path]
+                    self.dirty = True
+
+    def known_hashes(self):
+        with self.lock:
+            return {entry['sha256'] for entry in self.entries.values()}
+
+    def save(self):
+        """Ghi index ra disk (atomic) nếu có thay đổi"""
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.entries)
+            self.dirty = False
+
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            temp_path = f'{self.index_path}.tmp'
+            with open(temp_path, 'w') as f:
+                f.write(data)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            logger.warning(f"Cannot save hash index: {e}")
+
+
+class ManagedFileIndex:
+    """
+    Index trong RAM của managed files (stat đã cache), cập nhật theo inotify events.
+    Mỗi thay đổi tăng version, để client hỏi 'since' chỉ nhận các file thay đổi sau version đó.
+    Directory không watch được (hoặc không có inotify) thì quét lại khi query,
+    tối đa mỗi FILE_INDEX_RESCAN_INTERVAL giây.
+    """
+
+    def __init__(self, directories):
+        self.directories = dict(directories)  # file_ext -> directory
+        self.entries = {}  # path -> file info (kèm 'version')
+        self.removed = {}  # path -> version lúc bị xoá
+        self.removed_floor = 0  # Version cũ nhất còn đủ tombstones
+        self.version = 0
+        self.lock = threading.Lock()
+        self.inotify_fd = None
+        self.watches = {}  # wd -> (file_ext, directory)
+        self.polled_dirs = dict(self.directories)  # Directories chưa có inotify watch
+        self.last_rescan = 0
+
+    def start(self):
+        """Quét lần đầu, bật inotify watch cho từng directory nếu được"""
+        self.setup_inotify()
+        for file_ext, directory in self.directories.items():
+            self.scan_directory(file_ext, directory)
+        self.last_rescan = time.time()
+
+        if self.watches:
+            threading.Thread(target=self.run_inotify, daemon=True).start()
+
+        logger.info(f"File index: {len(self.entries)} files, "
+                    f"inotify on {len(self.watches)}/{len(self.directories)} directories")
+
+    def setup_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        except (OSError, AttributeError) as e:
+            logger.info(f"inotify not available, file index uses rescans: {e}")
+            return
+
+        self.inotify_fd = fd
+        for file_ext, directory in self.directories.items():
+            wd = libc.inotify_add_watch(fd, os.fsencode(directory), INOTIFY_MASK)
+            if wd < 0:
+                logger.info(f"Cannot watch {directory} (errno {ctypes.get_errno()}), using rescans")
+                continue
+            self.watches[wd] = (file_ext, directory)
+            self.polled_dirs.pop(file_ext, None)
+
+    def run_inotify(self):
+        while True:
+            try:
+                data = os.read(self.inotify_fd, 64 * 1024)
+            except OSError as e:
+                logger.error(f"inotify read failed, falling back to rescans: {e}")
+                break
+
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(data):
+                wd, mask, _cookie, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+                name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + name_len]
+                offset += INOTIFY_EVENT.size + name_len
+                self.on_inotify_event(wd, mask, os.fsdecode(name.rstrip(b'\0')))
+
+        with self.lock:
+            for file_ext, directory in self.watches.values():
+                self.polled_dirs[file_ext] = directory
+            self.watches.clear()
+
+    def on_inotify_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # Mất events: quét lại toàn bộ
+            for file_ext, directory in self.directories.items():
+                self.scan_directory(file_ext, directory)
+            return
+
+        watch = self.watches.get(wd)
+        if watch is None:
+            return
+        file_ext, directory = watch
+
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+            # Directory bị xoá/đổi tên: watch không còn dùng được, chuyển sang rescans
+            with self.lock:
+                self.watches.pop(wd, None)
+                self.polled_dirs[file_ext] = directory
+            self.scan_directory(file_ext, directory)
+            return
+
+        if name and name.endswith(file_ext):
+            self.refresh_path(os.path.join(directory, name), file_ext, directory)
+
+    def refresh_path(self, file_path, file_ext=None, directory=None):
+        """Stat lại một file và cập nhật entry (gọi từ inotify hoặc sau khi install)"""
+        if file_ext is None:
+            directory = os.path.dirname(file_path)
+            file_ext = next((ext for ext, d in self.directories.items()
+                             if d == directory and file_path.endswith(ext)), None)
+            if file_ext is None:
+                return
+
+        try:
+            stat = os.stat(file_path)
+            info = None if not os.path.isfile(file_path) else {
+                'filename': os.path.basename(file_path),
+                'file_path': file_path,
+                'directory': directory,
+                'file_type': file_ext,
+                'size': stat.st_size,
+                'modified_time': stat.st_mtime,
+                'created_time': stat.st_ctime,
+                'permissions': oct(stat.st_mode)[-3:]
+            }
+        except OSError:
+            info = None
+
+        with self.lock:
+            self.apply(file_path, info)
+
+    def apply(self, file_path, info):
+        """Ghi thay đổi vào index, tăng version nếu thật sự khác (gọi khi giữ lock)"""
+        current = self.entries.get(file_path)
+        if info is None:
+            if current is None:
+                return
+            del self.entries[file_path]
+            self.version += 1
+            self.removed[file_path] = self.version
+            if len(self.removed) > FILE_INDEX_TOMBSTONES:
+                oldest = min(self.removed, key=self.removed.get)
+                self.removed_floor = self.removed.pop(oldest)
+            return
+
+        if current is not None and all(current[key] == info[key] for key in info):
+            return
+        self.version += 1
+        info['version'] = self.version
+        self.entries[file_path] = info
+        self.removed.pop(file_path, None)
+
+    def scan_directory(self, file_ext, directory):
+        """Đồng bộ entries của một directory với trạng thái thật trên disk"""
+        found = {}
+        try:
+            for filename in os.listdir(directory):
+                file_path = os.path.join(directory, filename)
+                if filename.endswith(file_ext) and os.path.isfile(file_path):
+                    found[file_path] = filename
+        except PermissionError:
+            logger.warning(f"Cannot access directory {directory}")
+        except OSError:
+            pass
+
+        for file_path in found:
+            self.refresh_path(file_path, file_ext, directory)
+
+        with self.lock:
+            stale = [path for path, info in self.entries.items()
+                     if info['directory'] == directory and info['file_type'] == file_ext and path not in found]
+            for path in stale:
+                self.apply(path, None)
+
+    def rescan_if_needed(self):
+        """Quét lại directories không có inotify (giới hạn tần suất)"""
+        with self.lock:
+            polled = dict(self.polled_dirs)
+            if not polled or time.time() - self.last_rescan < FILE_INDEX_RESCAN_INTERVAL:
+                return
+            self.last_rescan = time.time()
+
+        for file_ext, directory in polled.items():
+            self.scan_directory(file_ext, directory)
+
+    def query(self, file_type=None, name=None, since=None):
+        """
+        Trả về (files, removed, version, reset).
+        since: chỉ các file có version > since; reset=True nếu since quá cũ (tombstones đã bị dọn),
+        client cần lấy lại toàn bộ danh sách.
+        """
+        self.rescan_if_needed()
+
+        with self.lock:
+            reset = since is not None and since < self.removed_floor
+            if reset:
+                since = None
+
+            files = [dict(info) for info in self.entries.values()
+                     if (since is None or info['version'] > since)
+                     and (file_type is None or info['file_type'] == file_type)
+                     and (name is None or self.name_matches(info['filename'], name))]
+            removed = [] if since is None else sorted(
+                path for path, version in self.removed.items() if version > since
+                and (file_type is None or path.endswith(file_type))
+                and (name is None or self.name_matches(os.path.basename(path), name)))
+            version = self.version
+
+        if since is None:
+            files.sort(key=lambda info: (info['directory'], info['filename']))
+        else:
+            files.sort(key=lambda info: info['version'])
+        return files, removed, version, reset
+
+    @staticmethod
+    def name_matches(filename, pattern):
+        """Glob pattern nếu có ký tự đại diện, không thì tìm chuỗi con (không phân biệt hoa thường)"""
+        if any(char in pattern for char in '*?['):
+            return fnmatch.fnmatch(filename.lower(), pattern.lower())
+        return pattern.lower() in filename.lower()
+
+
+class ScriptExecution:
+    """
+    Chạy script với stdout/stderr được đọc theo chunk và đẩy qua on_output callback.
+    Queue giữa reader threads và sender có giới hạn: khi client đọc chậm, queue đầy,
+    reader ngừng đọc pipe và script tự bị block khi ghi output (back-pressure).
+    """
+
+    def __init__(self, execution_id, command, timeout=None, on_output=None):
+        self.execution_id = execution_id
+        self.command = command
+        self.timeout = timeout
+        self.on_output = on_output
+        self.output_queue = queue.Queue(maxsize=SCRIPT_OUTPUT_QUEUE_CHUNKS)
+        self.process = None
+        self.started_time = None
+        self.cancelled = False
+        self.timed_out = False
+        self.output_bytes = 0
+
+    def start(self):
+        """Khởi động process (đồng bộ, để cancel ngay sau đó luôn có process để kill)"""
+        self.started_time = time.time()
+        # Process group riêng để kill được cả các process con của script
+        self.process = subprocess.Popen(
+            self.command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            stdin=subprocess.DEVNULL,
+            start_new_session=True
+        )
+
+    def run(self):
+        """Đọc output tới khi script kết thúc, trả về dict kết quả"""
+        readers = [
+            threading.Thread(target=self.read_stream, args=('stdout', self.process.stdout), daemon=True),
+            threading.Thread(target=self.read_stream, args=('stderr', self.process.stderr), daemon=True)
+        ]
+        for reader in readers:
+            reader.start()
+
+        deadline = self.started_time + self.timeout if self.timeout else None
+        open_streams = len(readers)
+        while open_streams:
+            wait = 1.0 if deadline is None else max(0.0, min(1.0, deadline - time.time()))
+            try:
+                item = self.output_queue.get(timeout=wait)
+            except queue.Empty:
+                if deadline is not None and time.time() >= deadline and not self.timed_out:
+                    self.timed_out = True
+                    self.terminate()
+                continue
+
+            if item is None:
+                open_streams -= 1
+                continue
+
+            stream, text = item
+            if self.on_output:
+                self.on_output(stream, text)
+
+        return_code = self.process.wait()
+        return {
+            'execution_id': self.execution_id,
+            'return_code': return_code,
+            'timed_out': self.timed_out,
+            'cancelled': self.cancelled,
+            'output_bytes': self.output_bytes,
+            'duration': round(time.time() - self.started_time, 3)
+        }
+
+    def read_stream(self, stream, pipe):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        fd = pipe.fileno()
+        while True:
+            data = os.read(fd, SCRIPT_OUTPUT_CHUNK)
+            if not data:
+                break
+            self.output_bytes += len(data)
+            text = decoder.decode(data)
+            if text:
+                # Block khi queue đầy -> pipe đầy -> script bị block (back-pressure)
+                self.output_queue.put((stream, text))
+
+        tail = decoder.decode(b'', final=True)
+        if tail:
+            self.output_queue.put((stream, tail))
+        pipe.close()
+        self.output_queue.put(None)
+
+    def terminate(self):
+        """SIGTERM cả process group, SIGKILL nếu chưa thoát sau SCRIPT_KILL_GRACE giây"""
+        if self.process is None or self.process.poll() is not None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+
+        def force_kill():
+            try:
+                self.process.wait(timeout=SCRIPT_KILL_GRACE)
+            except subprocess.TimeoutExpired:
+                try:
+                    os.killpg(self.process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+        threading.Thread(target=force_kill, daemon=True).start()
+
+    def cancel(self):
+        self.cancelled = True
+        self.terminate()
+
+
+class ScriptJob:
+    """Một lần chạy script trong JobScheduler: trạng thái, thời gian và kết quả được giữ lại"""
+
+    def __init__(self, script_path, command, timeout, priority, stream, client_socket, detach=False):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.script_path = script_path
+        self.command = command
+        self.timeout = timeout
+        self.priority = priority
+        self.stream = stream
+        self.client_socket = client_socket
+        self.detach = detach
+        self.state = 'queued'
+        self.created_time = time.time()
+        self.started_time = None
+        self.finished_time = None
+        self.result = None
+        self.error = None
+        self.execution = None
+        self.cancel_requested = False
+        self.request_id = None  # request_id của execute_script, gắn vào mọi response của job
+        # Non-streaming giữ toàn bộ output để trả về một lần như trước
+        self.output = {'stdout': [], 'stderr': []}
+        self.output_tail = {'stdout': '', 'stderr': ''}
+
+    def append_output(self, stream, text):
+        if not self.stream:
+            self.output[stream].append(text)
+        self.output_tail[stream] = (self.output_tail[stream] + text)[-JOB_OUTPUT_TAIL:]
+
+    def finish(self, result):
+        self.result = result
+        self.state = 'cancelled' if result['cancelled'] else ('timeout' if result['timed_out'] else 'finished')
+        self.finished_time = time.time()
+        # Kết quả đã gửi đi, chỉ giữ lại phần đuôi
+        self.output = {'stdout': [], 'stderr': []}
+
+    def to_dict(self, include_output=False):
+        info = {
+            'job_id': self.job_id,
+            'script_path': self.script_path,
+            'state': self.state,
+            'priority': self.priority,
+            'stream': self.stream,
+            'detach': self.detach,
+            'timeout': self.timeout,
+            'created': self.created_time,
+            'started': self.started_time,
+            'finished': self.finished_time,
+            'result': self.result,
+            'error': self.error
+        }
+        if include_output:
+            info['output_tail'] = dict(self.output_tail)
+        return info
+
+
+class JobScheduler:
+    """
+    Job pool cho execute_script: tối đa max_workers script chạy cùng lúc, phần còn lại
+    chờ trong heap (priority cao trước, cùng priority thì FIFO).
+    Short jobs (có timeout <= SCRIPT_SHORT_TIMEOUT hoặc priority > 0) có heap riêng và
+    reserved_workers worker chỉ dành cho chúng, nên script ngắn không phải chờ sau script dài.
+    max_workers/reserved_workers đổi được qua 'job_limits', lưu lại qua restart.
+    Job đã xong được giữ lại JOB_RETENTION cái gần nhất để query status/kết quả.
+    """
+
+    def __init__(self, service, settings_path):
+        self.service = service
+        self.settings_path = settings_path
+        self.max_workers = SCRIPT_MAX_WORKERS
+        self.reserved_workers = SCRIPT_RESERVED_WORKERS
+        self.jobs = {}  # job_id -> ScriptJob (queued, running và finished còn giữ lại)
+        self.finished = deque()  # job_id đã xong theo thứ tự, để dọn bớt
+        self.queue = []  # heap (-priority, seq, job) của long jobs
+        self.short_queue = []  # heap (-priority, seq, job) của short jobs
+        self.seq = 0
+        self.running = 0
+        self.running_long = 0
+        self.condition = threading.Condition()
+        self.workers = []
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.settings_path) as f:
+                self.configure(**json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"Ignoring job limits in {self.settings_path}: {e}")
+
+    def configure(self, max_workers=None, reserved_workers=None):
+        if max_workers is not None and (isinstance(max_workers, bool) or not isinstance(max_workers, int) or
+                                        max_workers < 1):
+            raise ValueError('max_workers must be a positive integer')
+        if reserved_workers is not None and (isinstance(reserved_workers, bool) or
+                                             not isinstance(reserved_workers, int) or reserved_workers < 0):
+            raise ValueError('reserved_workers must be a non-negative integer')
+        with self.condition:
+            if max_workers is not None:
+                self.max_workers = max_workers
+            if reserved_workers is not None:
+                self.reserved_workers = reserved_workers
+            if self.workers:
+                self.ensure_workers()
+            # Worker thừa tự thoát, worker đang chờ xét lại slot cho long jobs
+            self.condition.notify_all()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.settings_path), exist_ok=True)
+        temp_path = self.settings_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.get_settings(), f)
+        os.replace(temp_path, self.settings_path)
+
+    def get_settings(self):
+        return {'max_workers': self.max_workers, 'reserved_workers': self.reserved_workers}
+
+    def long_slots(self):
+        """Số long jobs chạy cùng lúc tối đa, luôn ít nhất 1 để long jobs không bị treo"""
+        return max(1, self.max_workers - self.reserved_workers)
+
+    @staticmethod
+    def is_short(job):
+        return job.priority > 0 or (job.timeout is not None and job.timeout <= SCRIPT_SHORT_TIMEOUT)
+
+    def submit(self, job):
+        """Đưa job vào queue, trả về vị trí trong queue (0 = chạy ngay)"""
+        with self.condition:
+            self.ensure_workers()
+            key = (-job.priority, self.seq)
+            self.seq += 1
+            short = self.is_short(job)
+            ahead = sum(1 for entry in self.short_queue + ([] if short else self.queue)
+                        if entry[2].state == 'queued' and entry[:2] < key)
+            free = self.max_workers - self.running
+            if not short:
+                free = min(free, self.long_slots() - self.running_long)
+            position = max(0, ahead + 1 - max(0, free))
+            self.jobs[job.job_id] = job
+            heapq.heappush(self.short_queue if short else self.queue, key + (job,))
+            self.condition.notify_all()
+        return position
+
+    def ensure_workers(self):
+        while len(self.workers) < self.max_workers:
+            worker = threading.Thread(target=self.worker_loop, daemon=True)
+            self.workers.append(worker)
+            worker.start()
+
+    def next_job(self):
+        """
+        Lấy job kế tiếp (gọi khi giữ condition): short job hoặc long job nếu còn slot,
+        ưu tiên priority cao hơn rồi tới job vào trước. Trả về (job, short) hoặc None
+        """
+        for heap in (self.short_queue, self.queue):
+            while heap and heap[0][2].state != 'queued':
+                heapq.heappop(heap)  # Đã bị huỷ khi còn trong queue
+
+        candidates = []
+        if self.short_queue:
+            candidates.append((self.short_queue[0][:2], self.short_queue, True))
+        if self.queue and self.running_long < self.long_slots():
+            candidates.append((self.queue[0][:2], self.queue, False))
+        if not candidates:
+            return None
+        _key, heap, short = min(candidates, key=lambda candidate: candidate[0])
+        return heapq.heappop(heap)[2], short
+
+    def worker_loop(self):
+        lower_thread_priority()  # Scripts fork từ worker thread nên chạy với nice/ioprio thấp
+        while True:
+            with self.condition:
+                while True:
+                    if len(self.workers) > self.max_workers:
+                        self.workers.remove(threading.current_thread())  # max_workers đã giảm
+                        return
+                    selected = self.next_job()
+                    if selected is not None:
+                        break
+                    self.condition.wait()
+                job, short = selected
+                job.state = 'running'
+                job.started_time = time.time()
+                self.running += 1
+                if not short:
+                    self.running_long += 1
+
+            try:
+                self.run_job(job)
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    if not short:
+                        self.running_long -= 1
+                        self.condition.notify_all()  # Slot long job trống
+                    self.retire(job)
+
+    def run_job(self, job):
+        execution = ScriptExecution(job.job_id, job.command, job.timeout,
+                                    lambda stream, text: self.on_output(job, stream, text))
+        try:
+            execution.start()
+        except OSError as e:
+            job.state = 'failed'
+            job.error = str(e)
+            job.finished_time = time.time()
+            self.service.on_job_failed(job, e)
+            return
+
+        with self.condition:
+            job.execution = execution
+            cancel_requested = job.cancel_requested
+        if cancel_requested:
+            execution.cancel()
+
+        try:
+            self.service.run_script_job(job, execution)
+        except Exception as e:
+            job.state = 'failed'
+            job.error = str(e)
+            job.finished_time = time.time()
+            execution.cancel()
+            self.service.on_job_failed(job, e)
+
+    def on_output(self, job, stream, text):
+        job.append_output(stream, text)
+        self.service.on_job_output(job, stream, text)
+
+    def retire(self, job):
+        """Ghi nhận job đã xong, dọn bớt job cũ vượt JOB_RETENTION (gọi khi giữ condition)"""
+        self.finished.append(job.job_id)
+        job.execution = None
+        while len(self.finished) > JOB_RETENTION:
+            self.jobs.pop(self.finished.popleft(), None)
+
+    def cancel(self, job_id):
+        """Huỷ job, trả về state trước khi huỷ (None nếu không có job)"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            state = job.state
+
+            if state == 'queued':
+                # Worker sẽ bỏ qua entry này khi pop ra
+                job.state = 'cancelled'
+                job.finished_time = time.time()
+                job.result = {
+                    'execution_id': job.job_id,
+                    'return_code': None,
+                    'timed_out': False,
+                    'cancelled': True,
+                    'output_bytes': 0,
+                    'duration': 0
+                }
+                self.retire(job)
+            elif state == 'running':
+                job.cancel_requested = True
+                execution = job.execution
+            else:
+                return state
+
+        if state == 'queued':
+            self.service.on_job_cancelled_in_queue(job)
+        elif execution is not None:
+            execution.cancel()
+        return state
+
+    def release_client(self, client_socket):
+        """Client ngắt kết nối: huỷ job của client, trừ job detach (chạy tiếp, giữ kết quả)"""
+        with self.condition:
+            owned = [job for job in self.jobs.values() if job.client_socket is client_socket]
+            for job in owned:
+                job.client_socket = None
+
+        for job in owned:
+            if not job.detach and job.state in ('queued', 'running'):
+                logger.info(f"Cancelling script {job.job_id} (client disconnected)")
+                self.cancel(job.job_id)
+
+    def get(self, job_id):
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        with self.condition:
+            return sorted(self.jobs.values(), key=lambda job: job.created_time)
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                'max_workers': self.max_workers,
+                'reserved_workers': self.reserved_workers,
+                'running': self.running,
+                'running_long': self.running_long,
+                'queued': sum(1 for entry in self.queue + self.short_queue if entry[2].state == 'queued'),
+                'queued_short': sum(1 for entry in self.short_queue if entry[2].state == 'queued')
+            }
+
+
+def systemd_unit_object_path(unit):
+    """D-Bus object path của unit (systemd escape: ký tự không phải chữ/số -> _xx)"""
+    escaped = ''.join(
+        char if char.isascii() and char.isalnum() and not (i == 0 and char.isdigit()) else f'_{ord(char):02x}'
+        for i, char in enumerate(unit)
+    )
+    return f'{SYSTEMD_PATH}/unit/{escaped}'
+
+
+class UnitChangeCoalescer:
+    """
+    Gom các file vừa install trong một đợt upload. Khi không có file mới trong
+    UNIT_APPLY_DEBOUNCE giây (hoặc đã chờ UNIT_APPLY_MAX_DELAY giây), chạy một lần
+    daemon-reload + try-restart tất cả units bị ảnh hưởng, rồi báo cho các clients đã upload
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.pending = set()  # file paths
+        self.clients = set()
+        self.first_time = None
+        self.last_time = None
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def add(self, file_path, client_socket=None):
+        with self.condition:
+            now = time.time()
+            self.pending.add(file_path)
+            if client_socket is not None:
+                self.clients.add(client_socket)
+            self.first_time = self.first_time or now
+            self.last_time = now
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.pending:
+                        self.condition.wait()
+                        continue
+                    now = time.time()
+                    due = min(self.last_time + UNIT_APPLY_DEBOUNCE, self.first_time + UNIT_APPLY_MAX_DELAY)
+                    if now >= due:
+                        break
+                    self.condition.wait(due - now)
+
+                paths = sorted(self.pending)
+                clients = list(self.clients)
+                self.pending.clear()
+                self.clients.clear()
+                self.first_time = self.last_time = None
+
+            try:
+                self.service.apply_pending_unit_changes(paths, clients)
+            except Exception as e:
+                logger.error(f"Applying unit changes failed: {e}")
+
+
+class JournalTail:
+    """
+    Chạy journalctl -o json cho một unit, gom entries thành batch và gửi qua on_batch.
+    Dùng select để follow mode vẫn gửi batch chưa đầy sau LOG_BATCH_INTERVAL
+    """
+
+    def __init__(self, tail_id, command, on_batch, password=None):
+        self.tail_id = tail_id
+        self.command = command
+        self.on_batch = on_batch
+        self.password = password
+        self.process = None
+        self.stopped = False
+        self.count = 0
+        self.last_cursor = None
+        self.wake_fds = None  # Pipe đánh thức run() khi stop()
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.wake_fds = os.pipe()
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE if self.password else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        if self.password:
+            self.process.stdin.write(f'{self.password}\n'.encode())
+            self.process.stdin.close()
+
+    def run(self):
+        """Đọc tới khi journalctl kết thúc hoặc bị stop, trả về (return_code, stderr)"""
+        fd = self.process.stdout.fileno()
+        pending = b''
+        batch = []
+        last_flush = time.time()
+
+        while not self.stopped:
+            ready, _, _ = select.select([fd, self.wake_fds[0]], [], [], LOG_BATCH_INTERVAL)
+            if fd in ready:
+                data = os.read(fd, CHUNK_SIZE)
+                if not data:
+                    break
+                lines = (pending + data).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    entry = self.parse_entry(line)
+                    if entry is not None:
+                        batch.append(entry)
+                        if len(batch) >= LOG_BATCH_SIZE:
+                            self.flush(batch)
+                            batch = []
+                            last_flush = time.time()
+
+            if batch and time.time() - last_flush >= LOG_BATCH_INTERVAL:
+                self.flush(batch)
+                batch = []
+                last_flush = time.time()
+
+        entry = self.parse_entry(pending)
+        if entry is not None:
+            batch.append(entry)
+        if batch:
+            self.flush(batch)
+
+        with self.lock:
+            for wake_fd in self.wake_fds:
+                os.close(wake_fd)
+            self.wake_fds = None
+
+        # journalctl chạy qua sudo (root) có thể chưa thoát: đóng stdout để nó nhận EPIPE ở lần ghi tiếp
+        self.process.stdout.close()
+        try:
+            return_code = self.process.wait(timeout=SCRIPT_KILL_GRACE if self.stopped else None)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"journalctl for tail {self.tail_id} still running after stop (pid {self.process.pid})")
+            self.process.stderr.close()
+            return None, ''
+
+        stderr = self.process.stderr.read().decode('utf-8', errors='replace').strip()
+        self.process.stderr.close()
+        return return_code, stderr
+
+    def parse_entry(self, line):
+        if not line.strip():
+            return None
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return None
+
+        message = record.get('MESSAGE')
+        if isinstance(message, list):
+            # journald trả MESSAGE dạng mảng byte khi không phải UTF-8 hợp lệ
+            message = bytes(message).decode('utf-8', errors='replace')
+
+        self.last_cursor = record.get('__CURSOR')
+        return {
+            'cursor': self.last_cursor,
+            'timestamp': int(record.get('__REALTIME_TIMESTAMP', 0)) / 1e6,
+            'priority': int(record['PRIORITY']) if str(record.get('PRIORITY', '')).isdigit() else None,
+            'identifier': record.get('SYSLOG_IDENTIFIER'),
+            'pid': int(record['_PID']) if str(record.get('_PID', '')).isdigit() else None,
+            'message': message
+        }
+
+    def flush(self, batch):
+        self.count += len(batch)
+        self.on_batch(batch, self.last_cursor)
+
+    def stop(self):
+        self.stopped = True
+        with self.lock:
+            if self.wake_fds is not None:
+                os.write(self.wake_fds[1], b'x')
+
+        if self.process is not None and self.process.poll() is None:
+            try:
+                self.process.terminate()
+            except PermissionError:
+                # journalctl chạy qua sudo (root): kill sudo bằng sudo, sudo chuyển SIGTERM cho journalctl
+                threading.Thread(target=self.kill_privileged, daemon=True).start()
+
+    def kill_privileged(self):
+        try:
+            result = run_privileged_script(f'kill -TERM {self.process.pid}', timeout=30)
+            if result.returncode != 0 and self.process.poll() is None:
+                logger.warning(f"Cannot stop journalctl for tail {self.tail_id}: {result.stderr.strip()}")
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"Cannot stop journalctl for tail {self.tail_id}: {e}")
+
+
+class ShellSession:
+    """
+    Shell tương tác trên một PTY. Output đọc từ master fd được gửi ngay qua on_output
+    (không gom batch, mỗi phím chỉ một round trip), input ghi thẳng vào master fd.
+    Master fd non-blocking để shell không đọc input thì reader thread không bị treo.
+    Shell chạy qua `setsid --ctty`: session mới nhận PTY làm controlling terminal
+    mà không chạy code Python nào trong child sau fork
+    """
+
+    def __init__(self, channel, command, cols, rows, term, on_output):
+        self.channel = channel
+        self.command = command
+        self.cols = cols
+        self.rows = rows
+        self.term = term
+        self.on_output = on_output
+        self.process = None
+        self.master_fd = None
+        self.wake_fds = None  # Pipe đánh thức run() khi close()
+        self.lock = threading.Lock()  # Giữ master_fd không bị đóng giữa chừng khi write/resize
+        self.closed = False
+        self.kill_timer = None
+
+    def start(self):
+        setsid = shutil.which('setsid')
+        if setsid is None:
+            raise OSError('setsid (util-linux) not found')
+
+        master_fd, slave_fd = os.openpty()
+        try:
+            self.set_window_size(slave_fd, self.cols, self.rows)
+            # Child không phải process group leader nên setsid không fork: pid của Popen
+            # chính là shell, đồng thời là session id của mọi process chạy trong terminal
+            self.process = subprocess.Popen(
+                [setsid, '--ctty'] + self.command,
+                stdin=slave_fd,
+                stdout=slave_fd,
+                stderr=slave_fd,
+                cwd=os.path.expanduser('~'),
+                env=dict(os.environ, TERM=self.term)
+            )
+        except Exception:
+            os.close(master_fd)
+            raise
+        finally:
+            os.close(slave_fd)
+
+        os.set_blocking(master_fd, False)
+        self.master_fd = master_fd
+        self.wake_fds = os.pipe()
+
+    @staticmethod
+    def set_window_size(fd, cols, rows):
+        fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack('HHHH', rows, cols, 0, 0))
+
+    def resize(self, cols, rows):
+        """Kernel gửi SIGWINCH cho foreground process group của PTY"""
+        with self.lock:
+            if self.master_fd is None:
+                raise ValueError(f'Shell {self.channel} is closed')
+            self.cols, self.rows = cols, rows
+            self.set_window_size(self.master_fd, cols, rows)
+
+    def write(self, data):
+        view = memoryview(data)
+        deadline = time.time() + SHELL_INPUT_TIMEOUT
+        with self.lock:
+            if self.master_fd is None:
+                raise ValueError(f'Shell {self.channel} is closed')
+            while view:
+                try:
+                    view = view[os.write(self.master_fd, view):]
+                except BlockingIOError:
+                    remaining = deadline - time.time()
+                    if remaining <= 0 or not select.select([], [self.master_fd], [], remaining)[1]:
+                        raise TimeoutError(f'Shell {self.channel} is not reading input')
+
+    def read_output(self):
+        """Relay output đang có sẵn, trả về False khi PTY đã bị đóng phía slave (EIO)"""
+        while True:
+            try:
+                data = os.read(self.master_fd, SHELL_READ_SIZE)
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                if e.errno == errno.EIO:
+                    return False
+                raise
+            if not data:
+                return False
+            self.on_output(data)
+
+    def run(self):
+        """
+        Relay output tới khi shell thoát hoặc close(), trả về exit code.
+        Background jobs còn giữ PTY sau khi shell thoát không giữ session lại:
+        shell thoát thì relay nốt output rồi hang up cả session
+        """
+        try:
+            while not self.closed:
+                ready, _, _ = select.select([self.master_fd, self.wake_fds[0]], [], [], SHELL_EXIT_POLL_INTERVAL)
+                if self.master_fd in ready and not self.read_output():
+                    break
+                if self.process.poll() is not None:
+                    self.read_output()
+                    break
+        finally:
+            self.signal(signal.SIGHUP)
+            with self.lock:
+                os.close(self.master_fd)
+                self.master_fd = None
+                for wake_fd in self.wake_fds:
+                    os.close(wake_fd)
+                self.wake_fds = None
+
+        # Không cancel kill_timer: sau close() SIGKILL vẫn dọn các process bỏ qua SIGHUP (nohup)
+        try:
+            return self.process.wait(timeout=SCRIPT_KILL_GRACE * 2)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Shell {self.channel} (pid {self.process.pid}) did not exit after hangup")
+            return None
+
+    def close(self):
+        """Hang up cả session của shell (như đóng terminal), SIGKILL nếu vẫn còn sau SCRIPT_KILL_GRACE"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.wake_fds is not None:
+                os.write(self.wake_fds[1], b'x')
+
+        self.signal(signal.SIGHUP)
+        self.kill_timer = threading.Timer(SCRIPT_KILL_GRACE, self.signal, args=(signal.SIGKILL,))
+        self.kill_timer.daemon = True
+        self.kill_timer.start()
+
+    def signal(self, signum):
+        """
+        Gửi signal cho mọi process trong session của shell (session id = pid của shell),
+        kể cả background jobs nằm ở process group riêng và còn chạy sau khi shell đã thoát.
+        Kernel không cấp lại pid còn đang được dùng làm session id, nên không nhầm process khác
+        """
+        if self.process is None:
+            return
+        session_id = self.process.pid
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                if os.getsid(int(name)) == session_id:
+                    os.kill(int(name), signum)
+            except (ProcessLookupError, PermissionError):
+                continue
+
+
+class ServiceStateWatcher:
+    """
+    Theo dõi ActiveState/SubState của custom units và push thay đổi tới các client đã subscribe.
+    Dùng systemd PropertiesChanged signals qua D-Bus nếu có, nếu không thì poll
+    bằng một lệnh systemctl show mỗi WATCH_POLL_INTERVAL (chỉ khi có subscriber).
+    Units mới cài trong lúc đang watch được thêm vào qua units_changed() hoặc lần poll/quét kế tiếp
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.subscribers = {}  # client_socket -> set(units) hoặc None (tất cả custom units)
+        self.states = {}  # unit -> (active_state, sub_state)
+        self.unit_paths = {}  # D-Bus object path -> unit
+        self.lock = threading.Lock()
+        self.thread = None
+        self.use_dbus = dbus is not None
+
+    def refresh_units(self):
+        """Cập nhật danh sách custom units và trạng thái hiện tại, bỏ units không còn tồn tại"""
+        units = [filename for filename, _ in self.service.get_custom_unit_files()]
+        states = self.service.get_units_state(units)
+        with self.lock:
+            self.unit_paths = {systemd_unit_object_path(unit): unit for unit in units}
+            for unit in set(self.states) - set(units):
+                del self.states[unit]
+            for unit in units:
+                self.states.setdefault(unit, ('unknown', 'unknown'))
+
+        # Cache có thể đã cũ (không poll khi không có subscriber): ghi đè bằng state vừa lấy,
+        # qua update() để subscriber đang có vẫn nhận event nếu state thật sự đổi
+        for unit in units:
+            state = states.get(unit, {})
+            self.update(unit, state.get('ActiveState'), state.get('SubState'))
+        return units
+
+    def subscribe(self, client_socket, units=None):
+        """Đăng ký client, trả về snapshot trạng thái hiện tại"""
+        self.refresh_units()
+        with self.lock:
+            self.subscribers[client_socket] = set(units) if units else None
+            snapshot = {
+                unit: {'active_state': active, 'sub_state': sub}
+                for unit, (active, sub) in self.states.items()
+                if not units or unit in units
+            }
+            if self.thread is None or not self.thread.is_alive():
+                target = self.run_dbus if self.use_dbus else self.run_polling
+                self.thread = threading.Thread(target=target, daemon=True)
+                self.thread.start()
+        return snapshot
+
+    def unsubscribe(self, client_socket):
+        with self.lock:
+            self.subscribers.pop(client_socket, None)
+
+    def units_changed(self):
+        """Unit files vừa được cài/xoá: cập nhật danh sách units nếu đang có subscriber"""
+        with self.lock:
+            if not self.subscribers:
+                return
+        try:
+            self.refresh_units()
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"Service watcher refresh failed: {e}")
+
+    def update(self, unit, active_state, sub_state):
+        """Ghi nhận trạng thái mới, push event nếu khác trạng thái trước"""
+        with self.lock:
+            previous = self.states.get(unit, ('unknown', 'unknown'))
+            active_state = active_state or previous[0]
+            sub_state = sub_state or previous[1]
+            if (active_state, sub_state) == previous:
+                return
+            self.states[unit] = (active_state, sub_state)
+            targets = [sock for sock, units in self.subscribers.items() if units is None or unit in units]
+
+        event = {
+            'action': 'service_state_changed',
+            'service_name': unit,
+            'active_state': active_state,
+            'sub_state': sub_state,
+            'previous_active_state': previous[0],
+            'previous_sub_state': previous[1],
+            'timestamp': time.time()
+        }
+        for client_socket in targets:
+            self.service.send_response(client_socket, event)
+
+    def run_polling(self):
+        logger.info("Service watcher started (polling systemctl show)")
+        while True:
+            with self.lock:
+                if not self.subscribers:
+                    # Reset trong lock: subscribe() sau đó sẽ start poller mới
+                    self.thread = None
+                    break
+
+            try:
+                # Quét lại danh sách units mỗi lần poll để theo dõi cả units mới cài
+                self.refresh_units()
+            except (OSError, subprocess.SubprocessError) as e:
+                logger.warning(f"Service watcher poll failed: {e}")
+
+            time.sleep(WATCH_POLL_INTERVAL)
+        logger.info("Service watcher stopped (no subscribers)")
+
+    def on_properties_changed(self, interface, changed, invalidated, path=None):
+        if interface != SYSTEMD_UNIT_IFACE:
+            return
+        with self.lock:
+            unit = self.unit_paths.get(str(path))
+        if unit and ('ActiveState' in changed or 'SubState' in changed):
+            active_state = changed.get('ActiveState')
+            sub_state = changed.get('SubState')
+            self.update(unit, str(active_state) if active_state else None, str(sub_state) if sub_state else None)
+
+    def run_dbus(self):
+        try:
+            bus = dbus.SystemBus(mainloop=dbus.mainloop.glib.DBusGMainLoop())
+            manager = dbus.Interface(bus.get_object(SYSTEMD_BUS_NAME, SYSTEMD_PATH), SYSTEMD_MANAGER_IFACE)
+            manager.Subscribe()
+            bus.add_signal_receiver(
+                self.on_properties_changed,
+                signal_name='PropertiesChanged',
+                dbus_interface='org.freedesktop.DBus.Properties',
+                bus_name=SYSTEMD_BUS_NAME,
+                path_keyword='path'
+            )
+        except Exception as e:
+            logger.warning(f"Cannot watch systemd over D-Bus, falling back to polling: {e}")
+            self.use_dbus = False
+            self.run_polling()
+            return
+
+        logger.info("Service watcher started (systemd D-Bus signals)")
+        GLib.timeout_add_seconds(WATCH_UNITS_REFRESH_INTERVAL, self.refresh_on_timer)
+        try:
+            GLib.MainLoop().run()
+        finally:
+            with self.lock:
+                self.thread = None
+            logger.info("Service watcher stopped (D-Bus main loop exited)")
+
+    def refresh_on_timer(self):
+        self.units_changed()
+        return True  # Giữ GLib timer
+
+
+class RemoteControlService:
+    def __init__(self):
+        self.clients = []
+        self.framed_clients = set()  # Clients dùng length-prefixed framing
+        self.server_socket = None
+        self.upload_sessions = {}  # upload_id -> UploadSession
+        self.upload_sessions_lock = threading.Lock()
+        self.upload_staging_dir = os.path.join(STATE_DIR, 'uploads')
+        self.hash_index = FileHashIndex(os.path.join(STATE_DIR, 'hash-index.json'))
+        self.file_index = ManagedFileIndex(ALLOWED_EXTENSIONS)
+        self.privileged_helper = PrivilegedHelperClient(HELPER_SOCKET_PATH)
+        self.deploy_history = DeployHistory(os.path.join(STATE_DIR, 'history'), self.privileged_helper)
+        self.unit_changes = UnitChangeCoalescer(self)
+        self.log_tails = {}  # tail_id -> (JournalTail, client_socket)
+        self.log_tails_lock = threading.Lock()
+        self.shell_sessions = {}  # channel -> (ShellSession, client_socket)
+        self.shell_sessions_lock = threading.Lock()
+        self.next_shell_channel = 0
+        self.description_cache = {}  # unit path -> (mtime_ns, description)
+        self.send_locks = {}  # client_socket -> Lock (response có thể gửi từ nhiều threads)
+        self.service_watcher = ServiceStateWatcher(self)
+        self.job_scheduler = JobScheduler(self, os.path.join(STATE_DIR, 'job-limits.json'))
+        self.receive_budget = ReceiveBudget(RECEIVE_MEMORY_BUDGET, RECEIVE_CLIENT_CAP)
+        self.command_pool = ThreadPoolExecutor(max_workers=COMMAND_WORKERS, thread_name_prefix='command')
+        self.transfer_lanes = {}  # client_socket -> queue.Queue các transfer commands
+        self.request_slots = {}  # client_socket -> Semaphore giới hạn MAX_PENDING_REQUESTS
+        self.request_context = threading.local()  # (client_socket, request_id) của command đang xử lý
+        self.action_stats = ActionStats()
+        self.telemetry = TelemetrySampler()
+        self.transfer_throttle = TransferThrottle(self.telemetry, os.path.join(STATE_DIR, 'transfer-limits.json'))
+
+        # Ensure upload directories exist (with proper permissions)
+        for ext, directory in ALLOWED_EXTENSIONS.items():
+            try:
+                if directory == '/home/orangepi':
+                    os.makedirs(directory, exist_ok=True)
+                # Note: /usr/local/bin and /etc/systemd/system should already exist
+                # and need root permissions to write
+            except PermissionError:
+                logger.warning(f"Cannot create directory {directory} - need root permissions")
+
+        self.load_upload_sessions()
+
+    def receive_full_message(self, client_socket):
+        """Nhận đầy đủ JSON message từ client"""
+        buffer = b""
+
+        try:
+            # Nhận data theo chunks
+            while True:
+                chunk = self.receive_chunk(client_socket, len(buffer))
+                if not chunk:
+                    logger.warning("No more data received")
+                    break
+
+                buffer += chunk
+                logger.debug(f"Received chunk: {len(chunk)} bytes, total buffer: {len(buffer)} bytes")
+
+                # Try to decode và parse JSON
+                try:
+                    message_str = buffer.decode('utf-8')
+
+                    # Thử parse JSON
+                    command = json.loads(message_str)
+                    logger.info(f"Successfully received complete JSON: {len(message_str)} bytes")
+                    if isinstance(command, dict):
+                        self.action_stats.add_received(str(command.get('action', 'unknown')), len(buffer))
+                    return command
+
+                except json.JSONDecodeError as e:
+                    # JSON chưa complete, tiếp tục nhận
+                    logger.debug(f"Incomplete JSON, continuing... Error: {e}")
+
+                    # Kiểm tra size limit
+                    if len(buffer) > MAX_MESSAGE_SIZE:
+                        logger.error("Message too large, aborting")
+                        break
+                    continue
+
+                except UnicodeDecodeError:
+                    # UTF-8 decode lỗi, có thể data chưa đủ
+                    logger.debug("Unicode decode error, continuing...")
+                    if len(buffer) > MAX_MESSAGE_SIZE:
+                        logger.error("Message too large, aborting")
+                        break
+                    continue
+
+        except socket.error as e:
+            logger.error(f"Socket error while receiving: {e}")
+        except Exception as e:
+            logger.error(f"Unexpected error receiving message: {e}")
+
+        logger.warning("Failed to receive complete message")
+        return None
+
+    def receive_chunk(self, client_socket, buffered):
+        """recv tối đa RECEIVE_SIZE bytes sau khi đã giữ chỗ trong receive budget"""
+        self.receive_budget.acquire(client_socket, RECEIVE_SIZE)
+        chunk = client_socket.recv(RECEIVE_SIZE)
+        self.receive_budget.settle(client_socket, buffered + len(chunk))
+        return chunk
+
+    def detect_framing(self, client_socket):
+        """
+        Xác định client dùng framed protocol hay legacy JSON.
+        Trả về True/False, hoặc None nếu client đã đóng kết nối
+        """
+        first_byte = client_socket.recv(1, socket.MSG_PEEK)
+        if not first_byte:
+            return None
+        return first_byte[0] == FRAME_MAGIC
+
+    def receive_frame(self, client_socket, decoder, pending_frames):
+        """Nhận frame tiếp theo từ client (framed mode)"""
+        try:
+            while not pending_frames:
+                chunk = self.receive_chunk(client_socket, decoder.buffered_size())
+                if not chunk:
+                    logger.warning("No more data received")
+                    return None
+                pending_frames.extend(decoder.feed(chunk))
+
+            return pending_frames.pop(0)
+
+        except FrameError as e:
+            logger.error(f"Invalid frame from client: {e}")
+        except socket.error as e:
+            logger.error(f"Socket error while receiving: {e}")
+
+        return None
+
+    def receive_command(self, client_socket, decoder, pending_frames):
+        """
+        Nhận command tiếp theo, theo framed hoặc legacy mode.
+        Trả về (command, size) với size là số bytes frame còn được tính trong receive budget
+        """
+        if decoder is None:
+            # Message trước đã xử lý xong, trả lại budget
+            self.receive_budget.settle(client_socket, 0)
+            command = self.receive_full_message(client_socket)
+            return None if command is None else (command, 0)
+
+        while True:
+            # Frames đã xử lý xong được trả lại budget, chỉ giữ phần còn trong buffer
+            self.receive_budget.settle(client_socket, decoder.buffered_size() + sum(
+                FRAME_HEADER.size + len(payload) for _type, payload in pending_frames))
+            frame = self.receive_frame(client_socket, decoder, pending_frames)
+            if frame is None:
+                return None
+
+            frame_type, payload = frame
+            if frame_type == FRAME_UPLOAD_CHUNK:
+                self.action_stats.add_received('upload_chunk_frame', FRAME_HEADER.size + len(payload))
+                self.run_on_transfer_lane(client_socket, self.run_tracked, client_socket, 'upload_chunk_frame', None,
+                                          self.handle_upload_chunk_frame, payload, client_socket)
+                continue
+            if frame_type == FRAME_SHELL_DATA:
+                self.action_stats.add_received('shell_data', FRAME_HEADER.size + len(payload))
+                self.run_tracked(client_socket, 'shell_data', None, self.handle_shell_data, payload, client_socket)
+                continue
+            if frame_type != FRAME_JSON:
+                logger.warning(f"Unexpected frame type: {frame_type}")
+                continue
+
+            try:
+                command = json.loads(payload)
+                logger.info(f"Successfully received JSON frame: {len(payload)} bytes")
+                if isinstance(command, dict):
+                    self.action_stats.add_received(str(command.get('action', 'unknown')), FRAME_HEADER.size + len(payload))
+                return command, FRAME_HEADER.size + len(payload)
+            except ValueError as e:
+                logger.error(f"Invalid JSON frame: {e}")
+                self.send_response(client_socket, {"error": f"Invalid JSON: {e}"})
+
+    def handle_client(self, client_socket, client_address):
+        """Xử lý kết nối từ client"""
+        logger.info(f"Client connected from {client_address}")
+        self.clients.append(client_socket)
+        self.send_locks[client_socket] = threading.Lock()
+
+        # Set socket timeout to None (no timeout)
+        client_socket.settimeout(None)
+
+        try:
+            framed = self.detect_framing(client_socket)
+            decoder = None
+            pending_frames = []
+            if framed:
+                decoder = FrameDecoder()
+                self.framed_clients.add(client_socket)
+                logger.info(f"Client {client_address} using framed protocol")
+
+            while framed is not None:
+                received = self.receive_command(client_socket, decoder, pending_frames)
+                if received is None:
+                    logger.warning("Received None command, breaking connection")
+                    break
+
+                command, size = received
+                if not isinstance(command, dict):
+                    logger.error(f"Invalid command type: {type(command)}")
+                    continue
+
+                self.dispatch_command(command, client_socket, size)
+
+        except Exception as e:
+            logger.error(f"Client handler error: {e}")
+        finally:
+            if client_socket in self.clients:
+                self.clients.remove(client_socket)
+            self.framed_clients.discard(client_socket)
+            # Một bước cleanup lỗi không được làm bỏ qua các bước sau (lane, budget, đóng socket)
+            for cleanup in (self.service_watcher.unsubscribe, self.job_scheduler.release_client,
+                            self.stop_client_log_tails, self.stop_client_shells):
+                try:
+                    cleanup(client_socket)
+                except Exception as e:
+                    logger.error(f"Cleanup {cleanup.__name__} failed for {client_address}: {e}")
+            self.send_locks.pop(client_socket, None)
+            self.request_slots.pop(client_socket, None)
+            lane = self.transfer_lanes.pop(client_socket, None)
+            if lane is not None:
+                lane.put(None)  # Lane xử lý nốt các transfer đã nhận rồi dừng
+            receive_stats = self.receive_budget.release(client_socket)
+            client_socket.close()
+            if receive_stats and receive_stats['stalls']:
+                logger.info(f"Client {client_address} disconnected (peak buffered {receive_stats['peak']} bytes, "
+                            f"stalled {receive_stats['stalls']}x / {receive_stats['stall_time']:.2f}s on memory budget)")
+            else:
+                logger.info(f"Client {client_address} disconnected")
+
+    def dispatch_command(self, command, client_socket, size):
+        """
+        Command không có request_id (hoặc legacy mode) xử lý xong rồi mới đọc command tiếp như trước
+        (transfer commands chạy trên transfer lane, reader chờ kết quả, để reader không bị hạ priority).
+        Có request_id: transfer commands chạy tuần tự trên transfer lane của connection,
+        còn lại chạy trên command pool, nên ping/list/manage_service không phải chờ upload
+        """
+        request_id = command.get('request_id')
+        if request_id is None or client_socket not in self.framed_clients:
+            if command.get('action') in TRANSFER_ACTIONS:
+                self.run_on_transfer_lane(client_socket, self.run_command, command, client_socket, request_id)
+            else:
+                self.run_command(command, client_socket, request_id)
+            return
+
+        # Đủ MAX_PENDING_REQUESTS thì reader dừng đọc tới khi có request xong
+        slots = self.request_slots.setdefault(client_socket, threading.Semaphore(MAX_PENDING_REQUESTS))
+        slots.acquire()
+        self.receive_budget.detach(client_socket, size)
+
+        def task():
+            try:
+                self.run_command(command, client_socket, request_id)
+            finally:
+                self.receive_budget.finish(client_socket, size)
+                slots.release()
+
+        if command.get('action') in TRANSFER_ACTIONS:
+            self.get_transfer_lane(client_socket).put(task)
+        else:
+            self.command_pool.submit(task)
+
+    def get_transfer_lane(self, client_socket):
+        """Transfer lane của connection, tạo lần đầu cần dùng (chỉ reader thread của connection gọi)"""
+        lane = self.transfer_lanes.get(client_socket)
+        if lane is None:
+            lane = self.transfer_lanes[client_socket] = queue.Queue()
+            threading.Thread(target=self.run_transfer_lane, args=(lane,), daemon=True).start()
+        return lane
+
+    def run_on_transfer_lane(self, client_socket, handler, *args):
+        """
+        Chạy transfer work của reader thread trên transfer lane (bulk priority) và chờ xong.
+        Reader giữ nguyên priority cho các command sau (ping, manage_service, open_shell);
+        exception được raise lại trên reader như khi tự xử lý
+        """
+        done = threading.Event()
+        error = []
+
+        def task():
+            try:
+                handler(*args)
+            except Exception as e:
+                error.append(e)
+            finally:
+                done.set()
+
+        self.get_transfer_lane(client_socket).put(task)
+        done.wait()
+        if error:
+            raise error[0]
+
+    def run_transfer_lane(self, lane):
+        lower_thread_priority()
+        while True:
+            task = lane.get()
+            if task is None:
+                break
+            try:
+                task()
+            except Exception as e:
+                logger.error(f"Transfer task failed: {e}")
+
+    def run_command(self, command, client_socket, request_id):
+        """Xử lý command với request context, để send_response gắn request_id vào response"""
+        self.run_tracked(client_socket, str(command.get('action', 'unknown')), request_id,
+                         self.process_command, command, client_socket)
+
+    def run_tracked(self, client_socket, action, request_id, handler, *args):
+        """Chạy handler trong request context, ghi latency và lỗi vào action_stats"""
+        context = self.request_context
+        context.current = (client_socket, request_id)
+        context.action = action
+        context.failed = False
+        started = time.perf_counter()
+        try:
+            handler(*args)
+        finally:
+            self.action_stats.record(action, (time.perf_counter() - started) * 1000, context.failed)
+            context.current = None
+            context.action = None
+
+    def current_request_id(self, client_socket):
+        """request_id của command đang xử lý trên thread này (nếu là của client_socket)"""
+        current = getattr(self.request_context, 'current', None)
+        if current and current[0] is client_socket:
+            return current[1]
+        return None
+
+    def handle_stats(self, command, client_socket):
+        """Counters theo action, connections, threads, job pool và receive budget"""
+        stats = self.action_stats.snapshot()
+        stats.update({
+            'action': 'stats',
+            'connections': len(self.clients),
+            'framed_connections': len(self.framed_clients),
+            'threads': threading.active_count(),
+            'jobs': self.job_scheduler.get_stats(),
+            'receive_budget': self.receive_budget.get_stats(),
+            'telemetry': self.telemetry.get_stats(),
+            'transfer_throttle': self.transfer_throttle.get_stats(),
+            'upload_sessions': len(self.upload_sessions),
+            'shell_sessions': len(self.shell_sessions)
+        })
+        if command.get('reset'):
+            self.action_stats.reset()
+        self.send_response(client_socket, stats)
+
+    def handle_transfer_limits(self, command, client_socket):
+        """Xem hoặc đổi bandwidth_limit / busy_rate / busy_cpu (bytes/s, %), lưu lại qua restart"""
+        changes = {key: command[key] for key in ('bandwidth_limit', 'busy_rate', 'busy_cpu') if key in command}
+        try:
+            if changes:
+                self.transfer_throttle.configure(**changes)
+                self.transfer_throttle.save()
+                logger.info(f"Transfer limits updated: {changes}")
+        except (OSError, ValueError) as e:
+            self.send_response(client_socket, {'action': 'transfer_limits_error', 'error': str(e)})
+            return
+
+        self.send_response(client_socket, dict(self.transfer_throttle.get_stats(), action='transfer_limits'))
+
+    def handle_job_limits(self, command, client_socket):
+        """Xem hoặc đổi max_workers / reserved_workers của script job pool, lưu lại qua restart"""
+        changes = {key: command[key] for key in ('max_workers', 'reserved_workers') if key in command}
+        try:
+            if changes:
+                self.job_scheduler.configure(**changes)
+                self.job_scheduler.save()
+                logger.info(f"Job limits updated: {changes}")
+        except (OSError, ValueError) as e:
+            self.send_response(client_socket, {'action': 'job_limits_error', 'error': str(e)})
+            return
+
+        self.send_response(client_socket, dict(self.job_scheduler.get_stats(), action='job_limits'))
+
+    def handle_telemetry(self, command, client_socket):
+        """Lịch sử telemetry của một window (1s/1m/1h) kèm sample mới nhất"""
+        try:
+            since = command.get('since')
+            limit = command.get('limit')
+            metrics = command.get('metrics')
+            if since is not None and (isinstance(since, bool) or not isinstance(since, (int, float))):
+                raise ValueError('since must be a timestamp (number)')
+            if limit is not None and (isinstance(limit, bool) or not isinstance(limit, int) or limit < 0):
+                raise ValueError('limit must be a non-negative integer')
+            if metrics is not None and (not isinstance(metrics, list) or
+                                        not all(isinstance(metric, str) for metric in metrics)):
+                raise ValueError('metrics must be a list of metric names')
+
+            history = self.telemetry.query(
+                command.get('window', TELEMETRY_WINDOWS[0][0]),
+                since=since,
+                limit=limit,
+                metrics=metrics
+            )
+        except (TypeError, ValueError) as e:
+            self.send_response(client_socket, {'action': 'telemetry_error', 'error': str(e)})
+            return
+
+        history.update({
+            'action': 'telemetry',
+            'units': {metric: TELEMETRY_METRICS[metric] for metric in history['values']},
+            'current': self.telemetry.current(),
+            'sampler': self.telemetry.get_stats()
+        })
+        self.send_response(client_socket, history)
+
+    def process_command(self, command, client_socket):
+        """Dispatch một command tới handler tương ứng"""
+        action = command.get('action', 'unknown')
+        logger.info(f"Processing command: {action}")
+
+        try:
+            if action == 'ping':
+                # Respond to ping for device discovery
+                self.send_response(client_socket, {
+                    'action': 'pong',
+                    'service': 'orangepi-remote-control',
+                    'version': '1.0',
+                    'framing': ['legacy', 'length-prefixed'],
+                    'upload_sessions': True,
+                    'compression': SUPPORTED_COMPRESSION,
+                    'request_ids': True
+                })
+            elif action == 'upload_file':
+                self.handle_file_upload(command, client_socket)
+            elif action == 'upload_begin':
+                self.handle_upload_begin(command, client_socket)
+            elif action == 'upload_chunk':
+                self.handle_upload_chunk(command, client_socket)
+            elif action == 'upload_commit':
+                self.handle_upload_commit(command, client_socket)
+            elif action == 'upload_abort':
+                self.handle_upload_abort(command, client_socket)
+            elif action == 'deploy_bundle':
+                self.handle_deploy_bundle(command, client_socket)
+            elif action == 'have':
+                self.handle_have_query(command, client_socket)
+            elif action == 'delta_signatures':
+                self.handle_delta_signatures(command, client_socket)
+            elif action == 'upload_delta':
+                self.handle_delta_upload(command, client_socket)
+            elif action == 'download_file':
+                self.handle_download_file(command, client_socket)
+            elif action == 'list_files':
+                self.list_uploaded_files(command, client_socket)
+            elif action == 'execute_script':
+                self.handle_script_execution(command, client_socket)
+            elif action == 'cancel_script':
+                self.handle_script_cancel(command, client_socket)
+            elif action == 'job_status':
+                self.handle_job_status(command, client_socket)
+            elif action == 'list_jobs':
+                self.list_script_jobs(client_socket)
+            elif action == 'rollback':
+                self.handle_rollback(command, client_socket)
+            elif action == 'list_history':
+                self.handle_list_history(command, client_socket)
+            elif action == 'tail_logs':
+                self.handle_tail_logs(command, client_socket)
+            elif action == 'stop_logs':
+                self.handle_stop_logs(command, client_socket)
+            elif action == 'open_shell':
+                self.handle_open_shell(command, client_socket)
+            elif action == 'shell_resize':
+                self.handle_shell_resize(command, client_socket)
+            elif action == 'close_shell':
+                self.handle_close_shell(command, client_socket)
+            elif action == 'stats':
+                self.handle_stats(command, client_socket)
+            elif action == 'job_limits':
+                self.handle_job_limits(command, client_socket)
+            elif action == 'transfer_limits':
+                self.handle_transfer_limits(command, client_socket)
+            elif action == 'telemetry':
+                self.handle_telemetry(command, client_socket)
+            elif action == 'memory_stats':
+                self.send_response(client_socket, dict(self.receive_budget.get_stats(), action='memory_stats'))
+            elif action == 'list_services':
+                self.list_custom_services(client_socket)
+            elif action == 'manage_service':
+                self.handle_service_management(command, client_socket)
+            elif action == 'watch_services':
+                self.handle_watch_services(command, client_socket)
+            elif action == 'unwatch_services':
+                self.service_watcher.unsubscribe(client_socket)
+                self.send_response(client_socket, {'action': 'watch_stopped'})
+            else:
+                logger.warning(f"Unknown action: {action}")
+                self.send_response(client_socket, {
+                    "error": f"Unknown action: {action}"
+                })
+
+        except Exception as e:
+            logger.error(f"Error handling command '{action}': {e}")
+            self.send_response(client_socket, {"error": str(e)})
+
+    def send_response(self, client_socket, response):
+        """Gửi response về client (framed hoặc newline-delimited JSON)"""
+        try:
+            current = getattr(self.request_context, 'current', None)
+            in_command = current is not None and current[0] is client_socket
+            if in_command and current[1] is not None and 'request_id' not in response:
+                response = dict(response, request_id=current[1])
+            if in_command and 'error' in response:
+                self.request_context.failed = True
+
+            if client_socket in self.framed_clients:
+                data = encode_frame(FRAME_JSON, json.dumps(response).encode())
+            else:
+                data = (json.dumps(response) + "\n").encode()
+
+            self.action_stats.add_sent(self.request_context.action if in_command else STATS_PUSH_KEY, len(data))
+
+            send_lock = self.send_locks.get(client_socket)
+            if send_lock is None:
+                client_socket.sendall(data)
+            else:
+                with send_lock:
+                    client_socket.sendall(data)
+        except Exception as e:
+            logger.error(f"Error sending response: {e}")
+
+    def broadcast_response(self, response):
+        """Gửi response tới tất cả clients"""
+        for client in self.clients[:]:
+            try:
+                self.send_response(client, response)
+            except:
+                if client in self.clients:
+                    self.clients.remove(client)
+
+    def write_file_with_sudo(self, file_path, file_data, file_ext, decompressor=None):
+        """
+        Ghi file qua StreamingFileWriter (temp file + fsync + atomic rename, tự dùng sudo nếu cần).
+        Nếu có decompressor, file_data là dữ liệu nén và được giải nén streaming vào file.
+        Trả về (success, message, writer)
+        """
+        try:
+            writer = StreamingFileWriter(file_path, file_ext, self.upload_staging_dir, throttle=self.transfer_throttle)
+        except Exception as e:
+            return False, f"Write error: {e}", None
+
+        try:
+            view = memoryview(file_data)
+            for start in range(0, len(view), CHUNK_SIZE):
+                chunk = view[start:start + CHUNK_SIZE]
+                blocks = decompressor.feed(chunk) if decompressor else (chunk,)
+                for block in blocks:
+                    writer.write(block)
+                    if writer.size > MAX_FILE_SIZE:
+                        raise ValueError(f'File too large. Max size: {MAX_FILE_SIZE} bytes')
+
+            if decompressor and not decompressor.eof:
+                raise ValueError('Truncated compressed data')
+        except Exception as e:
+            writer.abort()
+            return False, f"Write error: {e}", writer
+
+        success, message = self.install_writer(writer, 'upload')
+        return success, message, writer
+
+    def handle_file_upload(self, command, client_socket):
+        """Xử lý upload file từ Flutter app"""
+        try:
+            filename = command.get('filename')
+            file_data_b64 = command.get('file_data')
+            file_size = command.get('file_size', 0)
+
+            if not filename or not file_data_b64:
+                self.send_response(client_socket, {
+                    'action': 'upload_error',
+                    'error': 'Missing filename or file_data'
+                })
+                return
+
+            # Check filename/extension, lấy destination directory theo extension
+            try:
+                file_ext, destination_dir, file_path = self.resolve_upload_destination(filename)
+            except ValueError as e:
+                self.send_response(client_socket, {
+                    'action': 'upload_error',
+                    'error': str(e)
+                })
+                return
+
+            if file_size > MAX_FILE_SIZE:
+                self.send_response(client_socket, {
+                    'action': 'upload_error',
+                    'error': f'File too large. Max size: {MAX_FILE_SIZE} bytes'
+                })
+                return
+
+            # Decode file data
+            try:
+                file_data = base64.b64decode(file_data_b64)
+
+            except Exception as e:
+                self.send_response(client_socket, {
+                    'action': 'upload_error',
+                    'error': f'Invalid base64 data: {e}'
+                })
+                return
+
+            # Dữ liệu nén (zlib/lzma) được giải nén streaming khi ghi file
+            compression = command.get('compression')
+            try:
+                decompressor = StreamDecompressor(compression) if compression else None
+            except ValueError as e:
+                self.send_response(client_socket, {
+                    'action': 'upload_error',
+                    'error': str(e)
+                })
+                return
+
+            # Check if file exists (for logging)
+            was_overwrite = os.path.exists(file_path)
+
+            # Write file với auto sudo nếu cần
+            success, message, writer = self.write_file_with_sudo(file_path, file_data, file_ext, decompressor)
+
+            if success:
+                units_pending = self.on_file_installed(file_path, writer.hexdigest('sha256'), client_socket,
+                                                       command.get('apply_units', True))
+                actual_size = writer.size
+                if file_size > 0 and actual_size != file_size:
+                    logger.warning(f"File size mismatch: expected {file_size}, got {actual_size}")
+
+                action_type = "overwritten" if was_overwrite else "uploaded"
+                logger.info(f"File {action_type} successfully: {filename} ({actual_size} bytes) -> {file_path} [{message}]")
+
+                self.send_response(client_socket, {
+                    'action': 'upload_success',
+                    'filename': filename,
+                    'file_path': file_path,
+                    'destination_dir': destination_dir,
+                    'file_size': actual_size,
+                    'md5_hash': writer.hexdigest('md5'),
+                    'sha256': writer.hexdigest('sha256'),
+                    'method': message,
+                    'overwrite': was_overwrite,
+                    'compression': decompressor.get_stats() if decompressor else None,
+                    'units_pending': units_pending
+                })
+            else:
+                self.send_response(client_socket, {
+                    'action': 'upload_error',
+                    'error': f'Failed to write file: {message}'
+                })
+                return
+
+        except Exception as e:
+            logger.error(f"Error handling file upload: {e}")
+            self.send_response(client_socket, {
+                'action': 'upload_error',
+                'error': str(e)
+            })
+
+    def resolve_upload_destination(self, filename):
+        """
+        Tính destination path theo extension.
+        Trả về (file_ext, destination_dir, file_path) hoặc raise ValueError
+        """
+        if not filename or os.path.basename(filename) != filename or filename.startswith('.'):
+            raise ValueError(f'Invalid filename: {filename}')
+        if filename == HELPER_FILENAME:
+            raise ValueError(f'Filename is reserved: {filename}')
+
+        file_ext = os.path.splitext(filename)[1].lower()
+        if file_ext not in ALLOWED_EXTENSIONS:
+            raise ValueError(f'File type not allowed. Allowed: {list(ALLOWED_EXTENSIONS.keys())}')
+
+        destination_dir = ALLOWED_EXTENSIONS[file_ext]
+        return file_ext, destination_dir, os.path.join(destination_dir, filename)
+
+    def resolve_session_destination(self, filename, bundle=False):
+        """Như resolve_upload_destination, bundle archive thì nằm trong staging dir"""
+        if not bundle:
+            return self.resolve_upload_destination(filename)
+
+        if (not filename or os.path.basename(filename) != filename or filename.startswith('.') or
+                not filename.lower().endswith(BUNDLE_EXTENSIONS)):
+            raise ValueError(f'Invalid bundle filename: {filename}. Allowed: {list(BUNDLE_EXTENSIONS)}')
+        return '.tar', self.upload_staging_dir, os.path.join(self.upload_staging_dir, filename)
+
+    def load_upload_sessions(self):
+        """Load các upload session dở dang từ staging dir (resume sau restart)"""
+        try:
+            os.makedirs(self.upload_staging_dir, exist_ok=True)
+        except OSError as e:
+            logger.warning(f"Cannot create upload staging dir {self.upload_staging_dir}: {e}")
+            return
+
+        now = time.time()
+        for name in os.listdir(self.upload_staging_dir):
+            if not name.endswith('.json'):
+                continue
+            meta_path = os.path.join(self.upload_staging_dir, name)
+            try:
+                session = UploadSession.load(meta_path, self.upload_staging_dir)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Dropping corrupt upload session {name}: {e}")
+                os.unlink(meta_path)
+                continue
+
+            # Trạng thái decompressor không lưu được qua restart, client phải upload lại
+            if session.compression and session.offset:
+                logger.info(f"Dropping compressed upload session {session.upload_id} ({session.filename}), cannot resume after restart")
+                session.discard()
+                continue
+
+            if now - session.created_time > UPLOAD_SESSION_TTL:
+                logger.info(f"Dropping expired upload session {session.upload_id} ({session.filename})")
+                session.discard()
+                continue
+
+            self.upload_sessions[session.upload_id] = session
+
+        if self.upload_sessions:
+            logger.info(f"Loaded {len(self.upload_sessions)} resumable upload sessions")
+
+    def get_upload_session(self, upload_id):
+        with self.upload_sessions_lock:
+            return self.upload_sessions.get(upload_id)
+
+    def handle_upload_begin(self, command, client_socket):
+        """Bắt đầu (hoặc resume) một upload session"""
+        try:
+            filename = command.get('filename')
+            file_size = command.get('file_size')
+
+            if 'sha256' in command:
+                hash_algorithm, expected_hash = 'sha256', command['sha256']
+            elif 'md5_hash' in command:
+                hash_algorithm, expected_hash = 'md5', command['md5_hash']
+            else:
+                hash_algorithm, expected_hash = None, None
+
+            if not isinstance(file_size, int) or file_size < 0 or not expected_hash:
+                self.send_response(client_socket, {
+                    'action': 'upload_error',
+                    'error': 'Missing file_size or sha256/md5_hash'
+                })
+                return
+
+            bundle = bool(command.get('bundle'))
+            try:
+                file_ext, destination_dir, file_path = self.resolve_session_destination(filename, bundle)
+            except ValueError as e:
+                self.send_response(client_socket, {
+                    'action': 'upload_error',
+                    'error': str(e)
+                })
+                return
+
+            if file_size > MAX_FILE_SIZE:
+                self.send_response(client_socket, {
+                    'action': 'upload_error',
+                    'error': f'File too large. Max size: {MAX_FILE_SIZE} bytes'
+                })
+                return
+
+            # Chọn codec đầu tiên trong danh sách client đề xuất mà device hỗ trợ
+            compression = next((codec for codec in command.get('accept_compression', [])
+                                if codec in SUPPORTED_COMPRESSION), None)
+
+            expected_hash = expected_hash.lower()
+            with self.upload_sessions_lock:
+                # Resume session cũ nếu cùng file (tên, size, hash, codec)
+                session = next((s for s in self.upload_sessions.values()
+                                if s.matches(filename, file_size, hash_algorithm, expected_hash, compression)), None)
+                resumed = session is not None
+
+                if session is None:
+                    session = UploadSession(uuid.uuid4().hex, filename, file_size,
+                                            hash_algorithm, expected_hash, self.upload_staging_dir,
+                                            compression, bundle)
+                    session.save()
+                    self.upload_sessions[session.upload_id] = session
+
+            session.open_writer(file_path, file_ext, self.transfer_throttle)
+            logger.info(f"Upload session {'resumed' if resumed else 'started'}: {filename} "
+                        f"({session.offset}/{file_size} bytes) [{session.upload_id}]")
+
+            self.send_response(client_socket, {
+                'action': 'upload_ready',
+                'upload_id': session.upload_id,
+                'filename': filename,
+                'file_size': file_size,
+                'offset': session.offset,
+                'resumed': resumed,
+                'compression': compression,
+                'chunk_size': CHUNK_SIZE
+            })
+
+        except Exception as e:
+            logger.error(f"Error starting upload session: {e}")
+            self.send_response(client_socket, {
+                'action': 'upload_error',
+                'error': str(e)
+            })
+
+    def receive_upload_chunk(self, upload_id, offset, data, client_socket):
+        """Ghi một chunk vào session và gửi upload_ack theo UPLOAD_ACK_INTERVAL"""
+        session = self.get_upload_session(upload_id)
+        if session is None:
+            self.send_response(client_socket, {
+                'action': 'upload_error',
+                'upload_id': upload_id,
+                'error': 'Unknown upload_id'
+            })
+            return
+
+        try:
+            new_offset = session.write_chunk(offset, data)
+        except (ValueError, OSError) as e:
+            response = {
+                'action': 'upload_error',
+                'upload_id': upload_id,
+                'error': str(e),
+                'offset': session.offset
+            }
+            if session.failed:
+                with self.upload_sessions_lock:
+                    self.upload_sessions.pop(upload_id, None)
+                session.discard()
+                response.update({'offset': None, 'discarded': True})
+                logger.warning(f"Upload session discarded after partial write: {session.filename} [{upload_id}]: {e}")
+            self.send_response(client_socket, response)
+            return
+
+        if new_offset - session.last_ack_offset >= UPLOAD_ACK_INTERVAL or session.is_complete():
+            session.flush()
+            session.last_ack_offset = new_offset
+            self.send_response(client_socket, {
+                'action': 'upload_ack',
+                'upload_id': upload_id,
+                'offset': new_offset
+            })
+
+    def handle_upload_chunk_frame(self, payload, client_socket):
+        """Xử lý binary upload chunk frame (framed mode)"""
+        if len(payload) < UPLOAD_CHUNK_HEADER.size:
+            logger.warning("Upload chunk frame too short")
+            return
+
+        raw_id, offset = UPLOAD_CHUNK_HEADER.unpack_from(payload)
+        data = memoryview(payload)[UPLOAD_CHUNK_HEADER.size:]
+        self.receive_upload_chunk(raw_id.hex(), offset, data, client_socket)
+
+    def handle_upload_chunk(self, command, client_socket):
+        """Upload chunk dạng JSON + base64 (cho legacy clients không dùng frame)"""
+        try:
+            data = base64.b64decode(command.get('data', ''))
+        except Exception as e:
+            self.send_response(client_socket, {
+                'action': 'upload_error',
+                'upload_id': command.get('upload_id'),
+                'error': f'Invalid base64 data: {e}'
+            })
+            return
+
+        offset = command.get('offset', 0)
+        if isinstance(offset, bool) or not isinstance(offset, int) or offset < 0:
+            self.send_response(client_socket, {
+                'action': 'upload_error',
+                'upload_id': command.get('upload_id'),
+                'error': 'offset must be a non-negative integer'
+            })
+            return
+
+        self.receive_upload_chunk(command.get('upload_id'), offset, data, client_socket)
+
+    def handle_upload_commit(self, command, client_socket):
+        """Verify hash của session đã nhận đủ và install file vào destination"""
+        upload_id = command.get('upload_id')
+        session = self.get_upload_session(upload_id)
+
+        try:
+            if session is None:
+                self.send_response(client_socket, {
+                    'action': 'upload_error',
+                    'upload_id': upload_id,
+                    'error': 'Unknown upload_id'
+                })
+                return
+
+            if session.bundle:
+                self.send_response(client_socket, {
+                    'action': 'upload_error',
+                    'upload_id': upload_id,
+                    'error': 'Bundle uploads are installed with deploy_bundle'
+                })
+                return
+
+            file_ext, destination_dir, file_path = self.resolve_upload_destination(session.filename)
+            session.open_writer(file_path, file_ext, self.transfer_throttle)
+            writer = session.writer
+
+            if not session.is_complete():
+                self.send_response(client_socket, {
+                    'action': 'upload_error',
+                    'upload_id': upload_id,
+                    'error': f'Upload incomplete: {writer.size}/{session.file_size} bytes',
+                    'offset': session.offset
+                })
+                return
+
+            # Hash đã được tính dần khi nhận chunk, không cần đọc lại file
+            if writer.hexdigest(session.hash_algorithm) != session.expected_hash:
+                # Data hỏng: bỏ session để client upload lại từ đầu
+                with self.upload_sessions_lock:
+                    self.upload_sessions.pop(upload_id, None)
+                session.discard()
+                self.send_response(client_socket, {
+                    'action': 'upload_error',
+                    'upload_id': upload_id,
+                    'error': f'{session.hash_algorithm} mismatch, upload discarded'
+                })
+                return
+
+            was_overwrite = os.path.exists(file_path)
+            success, message = self.install_writer(writer, 'upload_session')
+
+            with self.upload_sessions_lock:
+                self.upload_sessions.pop(upload_id, None)
+            session.discard()
+
+            if not success:
+                self.send_response(client_socket, {
+                    'action': 'upload_error',
+                    'upload_id': upload_id,
+                    'error': f'Failed to write file: {message}'
+                })
+                return
+
+            units_pending = self.on_file_installed(file_path, writer.hexdigest('sha256'), client_socket,
+                                                   command.get('apply_units', True))
+
+            action_type = "overwritten" if was_overwrite else "uploaded"
+            logger.info(f"File {action_type} successfully: {session.filename} ({session.file_size} bytes) -> {file_path} [{message}]")
+
+            self.send_response(client_socket, {
+                'action': 'upload_success',
+                'upload_id': upload_id,
+                'filename': session.filename,
+                'file_path': file_path,
+                'destination_dir': destination_dir,
+                'file_size': session.file_size,
+                'md5_hash': writer.hexdigest('md5'),
+                'sha256': writer.hexdigest('sha256'),
+                'method': message,
+                'overwrite': was_overwrite,
+                'compression': session.decompressor.get_stats() if session.decompressor else None,
+                'units_pending': units_pending
+            })
+
+        except Exception as e:
+            logger.error(f"Error committing upload: {e}")
+            self.send_response(client_socket, {
+                'action': 'upload_error',
+                'upload_id': upload_id,
+                'error': str(e)
+            })
+
+    def handle_upload_abort(self, command, client_socket):
+        """Huỷ upload session và xoá data đã nhận"""
+        upload_id = command.get('upload_id')
+        with self.upload_sessions_lock:
+            session = self.upload_sessions.pop(upload_id, None)
+
+        if session is not None:
+            session.discard()
+            logger.info(f"Upload session aborted: {session.filename} [{upload_id}]")
+
+        self.send_response(client_socket, {
+            'action': 'upload_aborted',
+            'upload_id': upload_id,
+            'found': session is not None
+        })
+
+    def install_writer(self, writer, source):
+        """Snapshot bản hiện tại vào deploy history rồi commit writer. Trả về (success, message)"""
+        deploy = self.deploy_history.begin(source)
+        self.deploy_history.snapshot(deploy, writer.file_path, self.current_hash(writer.file_path))
+
+        success, message = writer.commit(self.privileged_helper)
+        if success:
+            self.deploy_history.commit(deploy, {writer.file_path: writer.hexdigest('sha256')})
+        else:
+            self.deploy_history.discard(deploy)
+        return success, message
+
+    def current_hash(self, file_path):
+        try:
+            return self.hash_index.get_hash(file_path)
+        except OSError:
+            return None
+
+    def on_file_installed(self, file_path, sha256, client_socket=None, apply_units=False):
+        """
+        Gọi sau mỗi lần install file thành công.
+        apply_units: đưa file vào đợt daemon-reload/restart gộp nếu nó là unit file
+        hoặc được unit nào đó tham chiếu. Trả về True nếu đã được xếp lịch
+        """
+        self.hash_index.record(file_path, sha256)
+        self.hash_index.save()
+        self.file_index.refresh_path(file_path)
+        if file_path.endswith('.service'):
+            self.service_watcher.units_changed()
+
+        if apply_units and (file_path.endswith('.service') or self.find_affected_units([file_path])):
+            self.unit_changes.add(file_path, client_socket)
+            return True
+        return False
+
+    def apply_pending_unit_changes(self, paths, clients):
+        """Áp dụng một đợt thay đổi từ UnitChangeCoalescer và báo kết quả cho clients đã upload"""
+        own_units = self.find_affected_units([os.path.abspath(__file__)])
+        reload_done, units, errors = self.apply_unit_changes(paths, exclude_units=own_units)
+        skipped = [unit for unit in self.find_affected_units(paths) if unit in own_units]
+        logger.info(f"Applied unit changes for {len(paths)} files: daemon-reload={reload_done}, "
+                    f"restarted {units}, skipped {skipped}")
+
+        response = {
+            'action': 'units_applied',
+            'files': paths,
+            'daemon_reload': reload_done,
+            'restarted_units': units,
+            # Unit chạy chính service này không tự restart (sẽ cắt kết nối), app restart qua manage_service
+            'skipped_units': skipped,
+            'errors': errors
+        }
+        for client_socket in clients:
+            if client_socket in self.clients:
+                self.send_response(client_socket, response)
+
+    def handle_have_query(self, command, client_socket):
+        """
+        Kiểm tra file nào client không cần upload lại.
+        files: list {'filename', 'sha256'} - so với file tại destination
+        hashes: list sha256 - kiểm tra có file managed nào mang nội dung đó không
+        """
+        try:
+            files = command.get('files', [])
+            hashes = [h.lower() for h in command.get('hashes', [])]
+
+            installed = []
+            missing = []
+            for entry in files:
+                filename = entry.get('filename')
+                try:
+                    file_ext, destination_dir, file_path = self.resolve_upload_destination(filename)
+                except ValueError:
+                    missing.append(filename)
+                    continue
+
+                if self.hash_index.get_hash(file_path) == entry.get('sha256', '').lower():
+                    installed.append(filename)
+                else:
+                    missing.append(filename)
+
+            have_hashes = []
+            if hashes:
+                self.hash_index.refresh(ALLOWED_EXTENSIONS)
+                known = self.hash_index.known_hashes()
+                have_hashes = [h for h in hashes if h in known]
+
+            self.hash_index.save()
+
+            self.send_response(client_socket, {
+                'action': 'have_result',
+                'installed': installed,
+                'missing': missing,
+                'have_hashes': have_hashes,
+                'missing_hashes': [h for h in hashes if h not in have_hashes]
+            })
+
+        except Exception as e:
+            logger.error(f"Error handling have query: {e}")
+            self.send_response(client_socket, {
+                'action': 'have_error',
+                'error': str(e)
+            })
+
+    def handle_deploy_bundle(self, command, client_socket):
+        """
+        Deploy nhiều file trong một transaction.
+        Tar archive lấy từ upload session (upload_begin với bundle=true) hoặc bundle_data (base64).
+        manifest: list {'filename', 'sha256'} - phải khớp chính xác với nội dung archive
+        """
+        upload_id = command.get('upload_id')
+        session = None
+
+        try:
+            manifest = command.get('manifest')
+            if not isinstance(manifest, list) or not manifest:
+                raise BundleError('Missing manifest')
+
+            if upload_id:
+                session = self.get_upload_session(upload_id)
+                if session is None or not session.bundle:
+                    raise BundleError('Unknown bundle upload_id')
+
+                file_ext, destination_dir, file_path = self.resolve_session_destination(session.filename, True)
+                session.open_writer(file_path, file_ext, self.transfer_throttle)
+                if not session.is_complete():
+                    raise BundleError(f'Bundle upload incomplete: {session.writer.size}/{session.file_size} bytes')
+                if session.writer.hexdigest(session.hash_algorithm) != session.expected_hash:
+                    raise BundleError(f'Bundle {session.hash_algorithm} mismatch')
+
+                session.writer.prepare()
+                with open(session.writer.temp_path, 'rb') as bundle_file:
+                    result = self.deploy_bundle(bundle_file, manifest)
+
+            elif command.get('bundle_data'):
+                bundle_data = base64.b64decode(command['bundle_data'])
+                result = self.deploy_bundle(io.BytesIO(bundle_data), manifest)
+
+            else:
+                raise BundleError('Missing upload_id or bundle_data')
+
+            result['action'] = 'bundle_deployed'
+            self.send_response(client_socket, result)
+
+        except Exception as e:
+            logger.error(f"Bundle deploy failed: {e}")
+            self.send_response(client_socket, {
+                'action': 'bundle_error',
+                'error': str(e)
+            })
+
+        finally:
+            if session is not None:
+                with self.upload_sessions_lock:
+                    self.upload_sessions.pop(upload_id, None)
+                session.discard()
+
+    def deploy_bundle(self, bundle_file, manifest):
+        """
+        Validate + stage toàn bộ entries, rồi install trong một privileged step
+        (backup bằng hardlink, install, một lần daemon-reload, restart units bị ảnh hưởng).
+        Bất kỳ bước nào lỗi thì toàn bộ bundle được rollback. Trả về dict kết quả
+        """
+        expected = {}
+        for entry in manifest:
+            filename = entry.get('filename')
+            self.resolve_upload_destination(filename)
+            if filename in expected:
+                raise BundleError(f'Duplicate manifest entry: {filename}')
+            expected[filename] = entry.get('sha256', '').lower()
+
+        deploy_id = uuid.uuid4().hex[:12]
+        staged = {}  # filename -> (writer, file_path)
+
+        try:
+            # Stage: stream từng entry ra temp file, verify sha256 theo manifest
+            with tarfile.open(fileobj=bundle_file, mode='r|*') as tar:
+                for member in tar:
+                    if member.isdir():
+                        continue
+                    name = member.name[2:] if member.name.startswith('./') else member.name
+                    if not member.isfile():
+                        raise BundleError(f'Unsupported entry type in bundle: {member.name}')
+                    if name not in expected:
+                        raise BundleError(f'Entry not in manifest: {member.name}')
+                    if name in staged:
+                        raise BundleError(f'Duplicate entry in bundle: {name}')
+                    if member.size > MAX_FILE_SIZE:
+                        raise BundleError(f'Entry too large: {name}')
+
+                    file_ext, destination_dir, file_path = self.resolve_upload_destination(name)
+                    writer = StreamingFileWriter(file_path, file_ext, self.upload_staging_dir, throttle=self.transfer_throttle)
+                    staged[name] = (writer, file_path)
+
+                    member_file = tar.extractfile(member)
+                    for block in iter(lambda: member_file.read(CHUNK_SIZE), b''):
+                        writer.write(block)
+
+                    if writer.hexdigest('sha256') != expected[name]:
+                        raise BundleError(f'sha256 mismatch for {name}')
+
+            missing = set(expected) - set(staged)
+            if missing:
+                raise BundleError(f'Entries missing from bundle: {sorted(missing)}')
+
+            # Chỉ install file có nội dung khác bản hiện tại
+            changed = {}
+            unchanged = []
+            for name, (writer, file_path) in staged.items():
+                if self.hash_index.get_hash(file_path) == expected[name]:
+                    writer.abort()
+                    unchanged.append(name)
+                else:
+                    writer.prepare()
+                    changed[name] = (writer, file_path)
+
+            result = {
+                'deploy_id': deploy_id,
+                'installed': sorted(changed),
+                'unchanged': sorted(unchanged),
+                'daemon_reload': False,
+                'restarted_units': []
+            }
+            if not changed:
+                logger.info(f"Bundle {deploy_id}: all {len(unchanged)} files unchanged, nothing to install")
+                return result
+
+            changed_paths = [file_path for writer, file_path in changed.values()]
+            reload_needed = any(path.endswith('.service') for path in changed_paths)
+            units = self.find_affected_units(changed_paths)
+
+            script = self.build_bundle_script(deploy_id, [writer for writer, _ in changed.values()], reload_needed, units)
+            need_root = reload_needed or bool(units) or not all(writer.in_destination for writer, _ in changed.values())
+
+            history = self.deploy_history.begin('bundle', deploy_id)
+            for name, (writer, file_path) in changed.items():
+                self.deploy_history.snapshot(history, file_path, self.current_hash(file_path))
+
+            logger.info(f"Bundle {deploy_id}: installing {sorted(changed)}, restarting {units}")
+            response = None
+            if need_root:
+                response = self.privileged_helper.call('install_bundle', files=[
+                    {'src': writer.temp_path, 'dest': file_path, 'mode': writer.mode}
+                    for writer, file_path in changed.values()
+                ], daemon_reload=reload_needed, restart_units=units)
+
+            try:
+                if response is not None:
+                    if not response.get('ok'):
+                        raise BundleError(response.get('error'))
+                else:
+                    if need_root:
+                        install_result = run_privileged_script(script, timeout=BUNDLE_INSTALL_TIMEOUT)
+                    else:
+                        install_result = subprocess.run(['sh', '-c', script], capture_output=True, text=True,
+                                                        timeout=BUNDLE_INSTALL_TIMEOUT)
+                    if install_result.returncode != 0:
+                        raise BundleError(f'Bundle install failed and was rolled back: {install_result.stderr.strip()}')
+            except Exception:
+                self.deploy_history.discard(history)
+                raise
+
+            self.deploy_history.commit(history, {file_path: expected[name] for name, (writer, file_path) in changed.items()})
+            for name, (writer, file_path) in changed.items():
+                self.on_file_installed(file_path, expected[name])
+
+            result['daemon_reload'] = reload_needed
+            result['restarted_units'] = units
+            logger.info(f"Bundle {deploy_id} deployed: {len(changed)} installed, {len(unchanged)} unchanged")
+            return result
+
+        except tarfile.TarError as e:
+            raise BundleError(f'Invalid bundle archive: {e}')
+
+        finally:
+            # Temp files đã được mv vào đích thì abort() chỉ bỏ qua
+            for writer, file_path in staged.values():
+                writer.abort()
+
+    def handle_list_history(self, command, client_socket):
+        """Danh sách deploys (mới nhất trước), lọc theo filename nếu có"""
+        try:
+            file_path = None
+            if command.get('filename'):
+                file_path = self.resolve_upload_destination(command['filename'])[2]
+
+            self.send_response(client_socket, {
+                'action': 'history',
+                'filename': command.get('filename'),
+                'max_deploys': HISTORY_MAX_DEPLOYS,
+                'deploys': [dict(deploy, files=[{
+                    'file_path': entry['file_path'],
+                    'restorable': entry['snapshot'] is not None or not entry['existed'],
+                    'existed': entry['existed'],
+                    'sha256_before': entry.get('sha256_before'),
+                    'sha256_after': entry.get('sha256_after')
+                } for entry in deploy['files']]) for deploy in self.deploy_history.list(file_path)]
+            })
+        except ValueError as e:
+            self.send_response(client_socket, {
+                'action': 'history_error',
+                'error': str(e)
+            })
+
+    def handle_rollback(self, command, client_socket):
+        """
+        Đưa files về trạng thái trước một deploy (mặc định deploy gần nhất), chỉ dùng
+        snapshots local (link + rename), không cần client gửi lại data.
+        filename: chỉ rollback file đó. Bản hiện tại được snapshot trước, nên rollback
+        cũng là một deploy và có thể rollback lại
+        """
+        try:
+            deploy_id = command.get('deploy_id')
+            deploy = self.deploy_history.get(deploy_id)
+            if deploy is None:
+                raise ValueError(f'Unknown deploy: {deploy_id}' if deploy_id else 'No deploy history')
+
+            entries = deploy['files']
+            if command.get('filename'):
+                file_path = self.resolve_upload_destination(command['filename'])[2]
+                entries = [entry for entry in entries if entry['file_path'] == file_path]
+                if not entries:
+                    raise ValueError(f"{command['filename']} is not part of deploy {deploy['deploy_id']}")
+
+            not_restorable = [entry['file_path'] for entry in entries
+                              if entry['existed'] and not entry['snapshot']]
+            if not_restorable:
+                raise ValueError(f'No snapshot for: {not_restorable}')
+
+            rollback = self.deploy_history.begin('rollback')
+            rollback['rolled_back'] = deploy['deploy_id']
+            for entry in entries:
+                self.deploy_history.snapshot(rollback, entry['file_path'], self.current_hash(entry['file_path']))
+
+            restored, removed, failed = [], [], []
+            for entry in entries:
+                file_path = entry['file_path']
+                try:
+                    if entry['snapshot']:
+                        self.restore_snapshot(entry['snapshot'], file_path)
+                        restored.append(file_path)
+                    else:
+                        self.remove_managed_file(file_path)
+                        removed.append(file_path)
+                except (OSError, subprocess.SubprocessError) as e:
+                    logger.error(f"Rollback of {file_path} failed: {e}")
+                    failed.append({'file_path': file_path, 'error': str(e)})
+
+            hashes = {entry['file_path']: entry.get('sha256_before') for entry in entries
+                      if entry['file_path'] in restored}
+            self.deploy_history.commit(rollback, hashes)
+            for file_path in restored + removed:
+                sha256 = hashes.get(file_path)
+                if sha256:
+                    self.on_file_installed(file_path, sha256)
+                else:
+                    self.current_hash(file_path)
+                    self.hash_index.save()
+                    self.file_index.refresh_path(file_path)
+
+            reload_done, units, unit_errors = self.apply_unit_changes(restored + removed)
+            logger.info(f"Rolled back deploy {deploy['deploy_id']}: restored {restored}, removed {removed}, "
+                        f"failed {failed}")
+
+            self.send_response(client_socket, {
+                'action': 'rollback_result',
+                'rolled_back': deploy['deploy_id'],
+                'deploy_id': rollback['deploy_id'],
+                'restored': restored,
+                'removed': removed,
+                'failed': failed,
+                'daemon_reload': reload_done,
+                'restarted_units': units,
+                'unit_errors': unit_errors
+            })
+
+        except ValueError as e:
+            self.send_response(client_socket, {
+                'action': 'rollback_error',
+                'error': str(e)
+            })
+        except Exception as e:
+            logger.error(f"Error during rollback: {e}")
+            self.send_response(client_socket, {
+                'action': 'rollback_error',
+                'error': str(e)
+            })
+
+    def restore_snapshot(self, snapshot_path, file_path):
+        """Link snapshot vào temp file trong thư mục đích rồi atomic rename đè lên file hiện tại"""
+        directory = os.path.dirname(file_path)
+        temp_path = os.path.join(directory, f'.{os.path.basename(file_path)}.{uuid.uuid4().hex[:8]}.tmp')
+
+        if os.access(directory, os.W_OK):
             try:
-                self.send_response(client, response)
-            except:
-                if client in self.clients:
-                    self.clients.remove(client)
+                os.link(snapshot_path, temp_path)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM):
+                    raise
+                shutil.copy2(snapshot_path, temp_path)
+            os.replace(temp_path, file_path)
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            return
 
-    def write_file_with_sudo(self, file_path, file_data, file_ext):
-        """Ghi file với sudo permissions nếu cần"""
-        try:
-            # Thử ghi file bình thường trước
-            with open(file_path, 'wb') as f:
-                f.write(file_data)
+        response = self.privileged_helper.call('restore_file', src=snapshot_path, dest=file_path)
+        if response is not None:
+            if not response.get('ok'):
+                raise OSError(f"Helper failed: {response.get('error')}")
+            return
 
-            # Set executable permissions cho .sh files
-            if file_ext == '.sh':
-                os.chmod(file_path, 0o755)
+        src, temp = shlex.quote(snapshot_path), shlex.quote(temp_path)
+        result = run_privileged_script(f"{{ ln -f {src} {temp} 2>/dev/null || cp -p {src} {temp}; }} && "
+                                       f"mv -f {temp} {shlex.quote(file_path)}")
+        if result.returncode != 0:
+            raise OSError(f"Sudo failed: {result.stderr.strip()}")
 
-            return True, "Success"
+    def remove_managed_file(self, file_path):
+        if os.access(os.path.dirname(file_path), os.W_OK):
+            if os.path.lexists(file_path):
+                os.unlink(file_path)
+            return
 
-        except PermissionError:
-            # Nếu không có quyền, dùng sudo
-            try:
-                logger.info(f"Using sudo to write file to {file_path}")
+        response = self.privileged_helper.call('remove_file', path=file_path)
+        if response is not None:
+            if not response.get('ok'):
+                raise OSError(f"Helper failed: {response.get('error')}")
+            return
 
-                # Tạo temp file
-                import tempfile
-                with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                    temp_file.write(file_data)
-                    temp_file_path = temp_file.name
+        result = run_privileged_script(f"rm -f {shlex.quote(file_path)}")
+        if result.returncode != 0:
+            raise OSError(f"Sudo failed: {result.stderr.strip()}")
 
-                # Copy file với sudo
-                copy_cmd = f"echo '{SUDO_PASSWORD}' | sudo -S cp '{temp_file_path}' '{file_path}'"
-                result = subprocess.run(copy_cmd, shell=True, capture_output=True, text=True)
+    def apply_unit_changes(self, changed_paths, exclude_units=()):
+        """
+        Một lần daemon-reload nếu có unit file thay đổi, một lần try-restart tất cả units
+        bị ảnh hưởng. Trả về (daemon_reload đã chạy, units đã restart, errors)
+        """
+        reload_needed = any(path.endswith('.service') for path in changed_paths)
+        units = [unit for unit in self.find_affected_units(changed_paths)
+                 if unit not in exclude_units and os.path.isfile(os.path.join(ALLOWED_EXTENSIONS['.service'], unit))]
+        if not reload_needed and not units:
+            return False, [], []
 
-                # Cleanup temp file
-                os.unlink(temp_file_path)
+        steps = []
+        errors = []
+        if reload_needed:
+            response = self.privileged_helper.call('daemon_reload')
+            if response is None:
+                steps.append("systemctl daemon-reload")
+            elif not response.get('ok') or response.get('return_code'):
+                errors.append(f"daemon-reload failed: {response.get('error') or response.get('stderr')}")
+        if units:
+            response = self.privileged_helper.call('systemctl', verb='try-restart', units=units)
+            if response is None:
+                steps.append(f"systemctl try-restart {' '.join(shlex.quote(unit) for unit in units)}")
+            elif not response.get('ok') or response.get('return_code'):
+                errors.append(f"try-restart failed: {response.get('error') or response.get('stderr')}")
 
-                if result.returncode == 0:
-                    # Set permissions với sudo
-                    if file_ext == '.sh':
-                        chmod_cmd = f"echo '{SUDO_PASSWORD}' | sudo -S chmod 755 '{file_path}'"
-                        subprocess.run(chmod_cmd, shell=True, capture_output=True)
+        if steps:
+            # Không có helper: gộp thành một lần sudo
+            result = run_privileged_script(' && '.join(steps))
+            if result.returncode != 0:
+                errors.append(f"Unit reload/restart failed: {result.stderr.strip()}")
 
-                    return True, "Success with sudo"
-                else:
-                    return False, f"Sudo failed: {result.stderr}"
+        for error in errors:
+            logger.error(error)
+        return reload_needed, units, errors
 
-            except Exception as e:
-                return False, f"Sudo error: {e}"
+    def find_affected_units(self, changed_paths):
+        """Units cần restart: unit file thay đổi, hoặc unit có tham chiếu tới script thay đổi"""
+        systemd_dir = ALLOWED_EXTENSIONS['.service']
+        units = {os.path.basename(path) for path in changed_paths if path.endswith('.service')}
+        scripts = [path for path in changed_paths if not path.endswith('.service')]
 
-        except Exception as e:
-            return False, f"Write error: {e}"
+        if scripts and os.path.isdir(systemd_dir):
+            for filename in os.listdir(systemd_dir):
+                unit_path = os.path.join(systemd_dir, filename)
+                if not filename.endswith('.service') or not os.path.isfile(unit_path):
+                    continue
+                try:
+                    with open(unit_path, 'r') as f:
+                        content = f.read()
+                except OSError:
+                    continue
+                if any(path in content for path in scripts):
+                    units.add(filename)
 
-    def handle_file_upload(self, command, client_socket):
-        """Xử lý upload file từ Flutter app"""
-        try:
-            filename = command.get('filename')
-            file_data_b64 = command.get('file_data')
-            file_size = command.get('file_size', 0)
+        return sorted(units)
 
-            if not filename or not file_data_b64:
-                self.send_response(client_socket, {
-                    'action': 'upload_error',
-                    'error': 'Missing filename or file_data'
-                })
-                return
+    def build_bundle_script(self, deploy_id, writers, reload_needed, units):
+        """
+        Shell script install cả bundle. File cũ được backup bằng hardlink trong cùng thư mục,
+        nếu một bước lỗi thì restore toàn bộ backup (mv là atomic) và reload/restart lại
+        """
+        steps = []
+        restore = []
+        cleanup = []
 
-            # Check file extension
-            file_ext = os.path.splitext(filename)[1].lower()
-            if file_ext not in ALLOWED_EXTENSIONS:
-                self.send_response(client_socket, {
-                    'action': 'upload_error',
-                    'error': f'File type not allowed. Allowed: {list(ALLOWED_EXTENSIONS.keys())}'
-                })
-                return
+        for writer in writers:
+            dest = shlex.quote(writer.file_path)
+            backup = shlex.quote(os.path.join(os.path.dirname(writer.file_path),
+                                              f'.{os.path.basename(writer.file_path)}.bak-{deploy_id}'))
+            if os.path.exists(writer.file_path):
+                steps.append(f"ln -f {dest} {backup}")
+                restore.append(f"mv -f {backup} {dest}")
+                cleanup.append(f"rm -f {backup}")
+            else:
+                restore.append(f"rm -f {dest}")
+            steps.append(writer.install_command())
+            restore.append(writer.install_cleanup_command())
 
-            # Get destination directory based on file extension
-            destination_dir = ALLOWED_EXTENSIONS[file_ext]
+        quoted_units = ' '.join(shlex.quote(unit) for unit in units)
+        if reload_needed:
+            steps.append("systemctl daemon-reload")
+            restore.append("systemctl daemon-reload")
+        if units:
+            steps.append(f"systemctl try-restart {quoted_units}")
+            restore.append(f"systemctl try-restart {quoted_units}")
 
-            if file_size > MAX_FILE_SIZE:
-                self.send_response(client_socket, {
-                    'action': 'upload_error',
-                    'error': f'File too large. Max size: {MAX_FILE_SIZE} bytes'
-                })
-                return
+        return (f"if {{ {' && '.join(steps)}; }}; then {'; '.join(cleanup) or ':'}; "
+                f"else {'; '.join(restore)}; exit 1; fi")
 
-            # Decode file data
-            try:
-                file_data = base64.b64decode(file_data_b64)
-                actual_size = len(file_data)
+    def handle_delta_signatures(self, command, client_socket):
+        """
+        Trả về block signatures của file hiện có tại destination (rsync-style).
+        Mỗi block gồm weak checksum Adler-32 (client tính rolling được) và md5 của block
+        """
+        filename = command.get('filename')
+        try:
+            file_ext, destination_dir, file_path = self.resolve_upload_destination(filename)
 
-                if file_size > 0 and actual_size != file_size:
-                    logger.warning(f"File size mismatch: expected {file_size}, got {actual_size}")
+            block_size = command.get('block_size', DELTA_BLOCK_SIZE)
+            if not isinstance(block_size, int) or not DELTA_MIN_BLOCK_SIZE <= block_size <= DELTA_MAX_BLOCK_SIZE:
+                raise ValueError(f'block_size must be between {DELTA_MIN_BLOCK_SIZE} and {DELTA_MAX_BLOCK_SIZE}')
 
-            except Exception as e:
+            if not os.path.isfile(file_path):
                 self.send_response(client_socket, {
-                    'action': 'upload_error',
-                    'error': f'Invalid base64 data: {e}'
+                    'action': 'delta_signatures',
+                    'filename': filename,
+                    'file_path': file_path,
+                    'exists': False
                 })
                 return
 
-            # Create file path in the appropriate directory
-            file_path = os.path.join(destination_dir, filename)
+            blocks = []
+            sha256 = hashlib.sha256()
+            file_size = 0
+            unthrottled = 0
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(block_size), b''):
+                    blocks.append([zlib.adler32(block), hashlib.md5(block).hexdigest()])
+                    sha256.update(block)
+                    file_size += len(block)
+                    # Đọc + hash cả file là bulk I/O: tính vào throttle theo từng CHUNK_SIZE
+                    unthrottled += len(block)
+                    if unthrottled >= CHUNK_SIZE:
+                        self.transfer_throttle.consume(unthrottled)
+                        unthrottled = 0
 
-            # Check if file exists (for logging)
-            was_overwrite = os.path.exists(file_path)
+            self.send_response(client_socket, {
+                'action': 'delta_signatures',
+                'filename': filename,
+                'file_path': file_path,
+                'exists': True,
+                'file_size': file_size,
+                'sha256': sha256.hexdigest(),
+                'block_size': block_size,
+                'blocks': blocks
+            })
 
-            # Write file với auto sudo nếu cần
-            success, message = self.write_file_with_sudo(file_path, file_data, file_ext)
+        except Exception as e:
+            logger.error(f"Error computing delta signatures: {e}")
+            self.send_response(client_socket, {
+                'action': 'upload_error',
+                'filename': filename,
+                'error': str(e)
+            })
 
-            if success:
-                # Calculate MD5 for verification
-                md5_hash = hashlib.md5(file_data).hexdigest()
+    def handle_delta_upload(self, command, client_socket):
+        """
+        Dựng lại file từ file hiện có + delta instructions rồi install atomic.
+        instructions: list các {'copy': [start_block, block_count]} hoặc {'data': <base64>}
+        """
+        filename = command.get('filename')
+        writer = None
+        try:
+            file_ext, destination_dir, file_path = self.resolve_upload_destination(filename)
+            block_size = command.get('block_size')
+            basis_sha256 = command.get('basis_sha256')
+            expected_sha256 = command.get('sha256')
+            instructions = command.get('instructions')
 
-                action_type = "overwritten" if was_overwrite else "uploaded"
-                logger.info(f"File {action_type} successfully: {filename} ({actual_size} bytes) -> {file_path} [{message}]")
+            if not isinstance(block_size, int) or not basis_sha256 or not expected_sha256 or not isinstance(instructions, list):
+                raise ValueError('Missing block_size, basis_sha256, sha256 or instructions')
+            if not DELTA_MIN_BLOCK_SIZE <= block_size <= DELTA_MAX_BLOCK_SIZE:
+                raise ValueError(f'block_size must be between {DELTA_MIN_BLOCK_SIZE} and {DELTA_MAX_BLOCK_SIZE}')
 
-                self.send_response(client_socket, {
-                    'action': 'upload_success',
-                    'filename': filename,
-                    'file_path': file_path,
-                    'destination_dir': destination_dir,
-                    'file_size': actual_size,
-                    'md5_hash': md5_hash,
-                    'method': message,
-                    'overwrite': was_overwrite
-                })
-            else:
+            copied_bytes = 0
+            literal_bytes = 0
+            # File trên device phải đúng là bản client đã dùng để tính delta
+            if self.hash_index.get_hash(file_path) != basis_sha256.lower():
+                raise ValueError('Basis file changed since signatures were computed, request signatures again')
+
+            with open(file_path, 'rb') as basis:
+                writer = StreamingFileWriter(file_path, file_ext, self.upload_staging_dir, throttle=self.transfer_throttle)
+                for instruction in instructions:
+                    if 'copy' in instruction:
+                        start_block, block_count = instruction['copy']
+                        basis.seek(start_block * block_size)
+                        remaining = block_count * block_size
+                        while remaining > 0:
+                            block = basis.read(min(remaining, CHUNK_SIZE))
+                            if not block:
+                                break
+                            writer.write(block)
+                            copied_bytes += len(block)
+                            remaining -= len(block)
+                    elif 'data' in instruction:
+                        data = base64.b64decode(instruction['data'])
+                        writer.write(data)
+                        literal_bytes += len(data)
+                    else:
+                        raise ValueError(f'Invalid delta instruction: {instruction}')
+
+                    if writer.size > MAX_FILE_SIZE:
+                        raise ValueError(f'File too large. Max size: {MAX_FILE_SIZE} bytes')
+
+            if writer.hexdigest('sha256') != expected_sha256.lower():
+                raise ValueError('sha256 mismatch after applying delta')
+
+            success, message = self.install_writer(writer, 'delta')
+            writer = None
+            if not success:
                 self.send_response(client_socket, {
                     'action': 'upload_error',
+                    'filename': filename,
                     'error': f'Failed to write file: {message}'
                 })
                 return
 
+            units_pending = self.on_file_installed(file_path, expected_sha256.lower(), client_socket,
+                                                   command.get('apply_units', True))
+            logger.info(f"Delta upload applied: {filename} ({copied_bytes} bytes reused, {literal_bytes} bytes sent) -> {file_path}")
+
+            self.send_response(client_socket, {
+                'action': 'upload_success',
+                'filename': filename,
+                'file_path': file_path,
+                'destination_dir': destination_dir,
+                'file_size': copied_bytes + literal_bytes,
+                'sha256': expected_sha256.lower(),
+                'method': message,
+                'overwrite': True,
+                'delta': {
+                    'copied_bytes': copied_bytes,
+                    'literal_bytes': literal_bytes
+                },
+                'units_pending': units_pending
+            })
+
         except Exception as e:
-            logger.error(f"Error handling file upload: {e}")
+            if writer is not None:
+                writer.abort()
+            logger.error(f"Error applying delta upload: {e}")
             self.send_response(client_socket, {
                 'action': 'upload_error',
+                'filename': filename,
                 'error': str(e)
             })
 
-    def list_uploaded_files(self, client_socket):
-        """Liệt kê files đã upload từ tất cả directories"""
+    def list_uploaded_files(self, command, client_socket):
+        """
+        Liệt kê managed files từ file index (không quét disk mỗi request).
+        Hỗ trợ offset/limit, lọc theo file_type hoặc name (chuỗi con hoặc glob),
+        since=<version> chỉ trả về files thay đổi (và 'removed') sau version đó.
+        include_hashes=true thêm sha256 (lấy từ hash index, chỉ hash lại file đã đổi)
+        """
         try:
-            all_files = []
+            file_type = command.get('file_type')
+            name = command.get('name')
+            since = command.get('since')
+            offset = command.get('offset', 0)
+            limit = command.get('limit')
 
-            # List files từ từng directory theo file type
-            for file_ext, directory in ALLOWED_EXTENSIONS.items():
-                try:
-                    if os.path.exists(directory):
-                        for filename in os.listdir(directory):
-                            file_path = os.path.join(directory, filename)
-                            if os.path.isfile(file_path) and filename.endswith(file_ext):
-                                stat = os.stat(file_path)
-                                all_files.append({
-                                    'filename': filename,
-                                    'file_path': file_path,
-                                    'directory': directory,
-                                    'file_type': file_ext,
-                                    'size': stat.st_size,
-                                    'modified_time': stat.st_mtime,
-                                    'created_time': stat.st_ctime,
-                                    'permissions': oct(stat.st_mode)[-3:]
-                                })
-                except PermissionError:
-                    logger.warning(f"Cannot access directory {directory}")
-                    continue
+            if file_type is not None and file_type not in ALLOWED_EXTENSIONS:
+                raise ValueError(f'Unknown file_type: {file_type}')
+            for key, value in (('since', since), ('offset', offset), ('limit', limit)):
+                if value is not None and (not isinstance(value, int) or value < 0):
+                    raise ValueError(f'{key} must be a non-negative integer')
 
-            self.send_response(client_socket, {
+            files, removed, version, reset = self.file_index.query(file_type, name, since)
+            total = len(files)
+            page = files[offset:offset + limit if limit is not None else None]
+
+            if command.get('include_hashes'):
+                for info in page:
+                    try:
+                        info['sha256'] = self.hash_index.get_hash(info['file_path'])
+                    except OSError:
+                        info['sha256'] = None
+                self.hash_index.save()
+
+            response = {
                 'action': 'file_list',
-                'files': all_files,
+                'files': page,
                 'directories': ALLOWED_EXTENSIONS,
-                'total_files': len(all_files)
-            })
+                'total_files': total,
+                'offset': offset,
+                'limit': limit,
+                'has_more': offset + len(page) < total,
+                'version': version
+            }
+            if since is not None:
+                response.update({'since': since, 'removed': removed, 'reset': reset})
+            self.send_response(client_socket, response)
 
         except Exception as e:
             logger.error(f"Error listing files: {e}")
@@ -354,10 +4401,153 @@ class RemoteControlService:
                 'error': str(e)
             })
 
+    def resolve_download_path(self, path):
+        """realpath của file được phép download: managed file hoặc file trong DOWNLOAD_ALLOWED_DIRS"""
+        if not isinstance(path, str) or not os.path.isabs(path):
+            raise ValueError(f'Invalid path: {path}')
+
+        real_path = os.path.realpath(path)
+        file_ext = os.path.splitext(real_path)[1].lower()
+        managed = ALLOWED_EXTENSIONS.get(file_ext) == os.path.dirname(real_path)
+        if not managed and not any(real_path.startswith(directory + os.sep) for directory in DOWNLOAD_ALLOWED_DIRS):
+            raise PermissionError(f'Path not allowed: {path}')
+        if not os.path.isfile(real_path):
+            raise FileNotFoundError(f'File not found: {path}')
+        return real_path, managed
+
+    def hash_download(self, fd, file_path, managed, file_stat):
+        """sha256 của file_stat.st_size bytes đầu (managed file chưa đổi thì lấy từ hash index)"""
+        if managed:
+            try:
+                current = os.stat(file_path)
+                if (current.st_ino, current.st_size, current.st_mtime_ns) == \
+                        (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns):
+                    sha256 = self.hash_index.get_hash(file_path)
+                    self.hash_index.save()
+                    return sha256
+            except OSError:
+                pass
+
+        digest = hashlib.sha256()
+        position = 0
+        while position < file_stat.st_size:
+            data = os.pread(fd, min(DOWNLOAD_FRAME_SIZE, file_stat.st_size - position), position)
+            if not data:
+                break
+            self.transfer_throttle.consume(len(data))
+            digest.update(data)
+            position += len(data)
+        return digest.hexdigest()
+
+    def send_file_frames(self, client_socket, fd, raw_id, offset, end):
+        """
+        Gửi [offset, end) bằng socket.sendfile (os.sendfile, không copy qua Python).
+        Send lock được giữ cho cả header lẫn data để frame của response khác không xen vào giữa
+        """
+        send_lock = self.send_locks.get(client_socket) or threading.Lock()
+        action = getattr(self.request_context, 'action', None) or STATS_PUSH_KEY
+        position = offset
+        with os.fdopen(fd, 'rb', closefd=False) as source:
+            while position < end:
+                count = min(DOWNLOAD_FRAME_SIZE, end - position)
+                self.transfer_throttle.consume(count)
+                header = (FRAME_HEADER.pack(FRAME_MAGIC, FRAME_DOWNLOAD_CHUNK, DOWNLOAD_CHUNK_HEADER.size + count) +
+                          DOWNLOAD_CHUNK_HEADER.pack(raw_id, position))
+                with send_lock:
+                    client_socket.sendall(header, socket.MSG_MORE)
+                    sent = client_socket.sendfile(source, position, count)
+                    if sent < count:
+                        client_socket.sendall(bytes(count - sent))  # File bị cắt ngắn: pad để giữ framing
+                self.action_stats.add_sent(action, len(header) + count)
+
+                if sent < count:
+                    raise IOError(f'File shrank during download ({position + sent} of {end} bytes)')
+                position += count
+        return position - offset
+
+    def handle_download_file(self, command, client_socket):
+        """
+        Gửi file về client (chỉ framed mode): 'download_begin' báo trước size, mtime và sha256
+        của cả file, sau đó là FRAME_DOWNLOAD_CHUNK frames, cuối cùng 'download_complete'.
+        offset/length chọn byte range để resume. File root-only được mở qua privileged helper
+        """
+        fd = None
+        download_id = None
+        try:
+            if client_socket not in self.framed_clients:
+                raise ValueError('download_file requires length-prefixed framing')
+
+            file_path, managed = self.resolve_download_path(command.get('path'))
+            offset = command.get('offset', 0)
+            length = command.get('length')
+            for key, value in (('offset', offset), ('length', length)):
+                if value is not None and (not isinstance(value, int) or value < 0):
+                    raise ValueError(f'{key} must be a non-negative integer')
+
+            try:
+                fd = os.open(file_path, os.O_RDONLY | os.O_CLOEXEC)
+            except PermissionError:
+                fd = self.privileged_helper.open_file(file_path)
+                if fd is None:
+                    raise
+
+            file_stat = os.fstat(fd)
+            size = file_stat.st_size  # File đang ghi thêm (logs): chỉ gửi tới size lúc mở
+            if offset > size:
+                raise ValueError(f'offset {offset} beyond file size {size}')
+            end = size if length is None else min(size, offset + length)
+            sha256 = self.hash_download(fd, file_path, managed, file_stat) if command.get('hash', True) else None
+
+            download_id = uuid.uuid4()
+            self.send_response(client_socket, {
+                'action': 'download_begin',
+                'download_id': download_id.hex,
+                'path': file_path,
+                'size': size,
+                'mtime': file_stat.st_mtime,
+                'sha256': sha256,
+                'offset': offset,
+                'length': end - offset,
+                'frame_size': DOWNLOAD_FRAME_SIZE
+            })
+
+            started = time.time()
+            sent = self.send_file_frames(client_socket, fd, download_id.bytes, offset, end)
+            elapsed = time.time() - started
+            self.send_response(client_socket, {
+                'action': 'download_complete',
+                'download_id': download_id.hex,
+                'bytes_sent': sent,
+                'elapsed': round(elapsed, 3)
+            })
+            logger.info(f"Download {file_path} [{offset}, {end}) sent {sent} bytes in {elapsed:.2f}s")
+
+        except Exception as e:
+            logger.error(f"Error sending file: {e}")
+            self.send_response(client_socket, {
+                'action': 'download_error',
+                'download_id': download_id.hex if download_id else None,
+                'path': command.get('path'),
+                'error': str(e)
+            })
+        finally:
+            if fd is not None:
+                os.close(fd)
+
     def handle_script_execution(self, command, client_socket):
-        """Thực thi script trên thiết bị"""
+        """
+        Chạy script trên worker của JobScheduler.
+        stream=true hoặc detach=true: trả về ngay 'script_queued' với job_id,
+        stream thì output gửi dần qua script_output, kết thúc bằng script_finished.
+        Mặc định: chỉ một response 'script_success'/'script_error' chứa toàn bộ stdout/stderr
+        như trước (timeout 30s), worker gửi khi job xong. Handler không chờ job, nên reader
+        xử lý tiếp các command sau (ping, ...) trong lúc script chạy
+        """
         try:
             script_path = command.get('script_path')
+            stream = bool(command.get('stream'))
+            timeout = command.get('timeout', None if stream else SCRIPT_DEFAULT_TIMEOUT)
+            priority = command.get('priority', 0)
 
             if not script_path:
                 self.send_response(client_socket, {
@@ -374,40 +4564,38 @@ class RemoteControlService:
                 })
                 return
 
-            logger.info(f"Executing script: {script_path}")
-
-            # Thực thi script
-            try:
-                result = subprocess.run(
-                    ['bash', script_path],
-                    capture_output=True,
-                    text=True,
-                    timeout=30  # 30 seconds timeout
-                )
-
-                self.send_response(client_socket, {
-                    'action': 'script_success',
-                    'script_path': script_path,
-                    'return_code': result.returncode,
-                    'stdout': result.stdout,
-                    'stderr': result.stderr
-                })
-
-                logger.info(f"Script executed successfully: {script_path} (exit code: {result.returncode})")
-
-            except subprocess.TimeoutExpired:
+            if timeout is not None and (not isinstance(timeout, (int, float)) or timeout < 0):
                 self.send_response(client_socket, {
                     'action': 'script_error',
-                    'error': 'Script execution timeout (30s)'
+                    'error': 'timeout must be a non-negative number of seconds'
                 })
-                logger.error(f"Script timeout: {script_path}")
+                return
 
-            except Exception as e:
+            if not isinstance(priority, int):
                 self.send_response(client_socket, {
                     'action': 'script_error',
-                    'error': f'Execution failed: {e}'
+                    'error': 'priority must be an integer'
                 })
-                logger.error(f"Script execution error: {e}")
+                return
+
+            job = ScriptJob(script_path, ['bash', script_path], timeout or None, priority, stream,
+                            client_socket, detach=bool(command.get('detach')))
+            job.request_id = self.current_request_id(client_socket)
+            position = self.job_scheduler.submit(job)
+
+            logger.info(f"Script queued: {script_path} [{job.job_id}] (priority {priority}, position {position})")
+            if not stream and not job.detach:
+                # Một request - một response: worker gửi script_success/script_error khi xong
+                return
+
+            self.send_response(client_socket, {
+                'action': 'script_queued',
+                'job_id': job.job_id,
+                'execution_id': job.job_id,
+                'script_path': script_path,
+                'priority': priority,
+                'position': position
+            })
 
         except Exception as e:
             logger.error(f"Error handling script execution: {e}")
@@ -416,77 +4604,512 @@ class RemoteControlService:
                 'error': str(e)
             })
 
+    def send_job_response(self, job, response):
+        """Gửi response tới client sở hữu job (bỏ qua nếu client đã ngắt kết nối)"""
+        client_socket = job.client_socket
+        if client_socket is not None:
+            if job.request_id is not None:
+                response = dict(response, request_id=job.request_id)
+            self.send_response(client_socket, response)
+
+    def run_script_job(self, job, execution):
+        """Chạy job trên worker thread của JobScheduler"""
+        if job.stream:
+            self.send_job_response(job, {
+                'action': 'script_started',
+                'job_id': job.job_id,
+                'execution_id': job.job_id,
+                'script_path': job.script_path,
+                'timeout': job.timeout
+            })
+
+        logger.info(f"Executing script: {job.script_path} [{job.job_id}]")
+        result = execution.run()
+        output = {stream: ''.join(chunks) for stream, chunks in job.output.items()}
+        job.finish(result)
+
+        logger.info(f"Script finished: {job.script_path} [{job.job_id}] (exit code: {result['return_code']}, "
+                    f"{result['duration']}s, timed_out={result['timed_out']}, cancelled={result['cancelled']})")
+
+        if job.stream:
+            response = dict(result, action='script_finished', job_id=job.job_id, script_path=job.script_path)
+        elif result['timed_out']:
+            response = {
+                'action': 'script_error',
+                'job_id': job.job_id,
+                'error': f'Script execution timeout ({job.timeout}s)'
+            }
+        elif result['cancelled']:
+            response = {
+                'action': 'script_error',
+                'job_id': job.job_id,
+                'error': 'Script cancelled'
+            }
+        else:
+            response = {
+                'action': 'script_success',
+                'job_id': job.job_id,
+                'script_path': job.script_path,
+                'return_code': result['return_code'],
+                'stdout': output['stdout'],
+                'stderr': output['stderr']
+            }
+        self.send_job_response(job, response)
+
+    def on_job_output(self, job, stream, text):
+        if job.stream:
+            self.send_job_response(job, {
+                'action': 'script_output',
+                'job_id': job.job_id,
+                'execution_id': job.job_id,
+                'stream': stream,
+                'data': text
+            })
+
+    def on_job_failed(self, job, error):
+        logger.error(f"Script execution error [{job.job_id}]: {error}")
+        self.send_job_response(job, {
+            'action': 'script_error',
+            'job_id': job.job_id,
+            'error': f'Execution failed: {error}'
+        })
+
+    def on_job_cancelled_in_queue(self, job):
+        """Job bị huỷ trước khi được chạy"""
+        if job.stream:
+            self.send_job_response(job, dict(job.result, action='script_finished', job_id=job.job_id,
+                                             script_path=job.script_path))
+        else:
+            self.send_job_response(job, {
+                'action': 'script_error',
+                'job_id': job.job_id,
+                'error': 'Script cancelled'
+            })
+
+    def get_custom_unit_files(self):
+        """Danh sách (filename, path) các custom .service trong /etc/systemd/system (bỏ system services)"""
+        systemd_dir = ALLOWED_EXTENSIONS['.service']
+        units = []
+
+        if os.path.exists(systemd_dir):
+            for filename in sorted(os.listdir(systemd_dir)):
+                if filename.endswith('.service'):
+                    # Bỏ qua system services
+                    is_system = any(sys_service in filename for sys_service in SYSTEM_SERVICE_PATTERNS)
+                    if is_system:
+                        continue
+
+                    service_path = os.path.join(systemd_dir, filename)
+                    if os.path.isfile(service_path):
+                        units.append((filename, service_path))
+
+        return units
+
+    def build_journal_command(self, command):
+        """journalctl command cho tail_logs, raise ValueError nếu tham số không hợp lệ"""
+        unit = command.get('unit')
+        if unit not in [filename for filename, _ in self.get_custom_unit_files()]:
+            raise ValueError(f'Unknown custom unit: {unit}')
+
+        args = ['journalctl', '-u', unit, '-o', 'json', '--no-pager',
+                '--output-fields=' + ','.join(JOURNAL_FIELDS)]
+
+        cursor = command.get('cursor')
+        lines = command.get('lines')
+        if lines is not None and (not isinstance(lines, int) or not 0 <= lines <= LOG_TAIL_MAX_LINES):
+            raise ValueError(f'lines must be between 0 and {LOG_TAIL_MAX_LINES}')
+        if cursor:
+            # Resume: chỉ entries sau cursor client đã nhận
+            args += ['--after-cursor', str(cursor)]
+        elif lines is not None or not command.get('since'):
+            args += ['-n', str(LOG_TAIL_DEFAULT_LINES if lines is None else lines)]
+
+        priority = command.get('priority')
+        if priority is not None:
+            if priority in JOURNAL_PRIORITIES:
+                priority = JOURNAL_PRIORITIES.index(priority)
+            if not isinstance(priority, int) or not 0 <= priority <= 7:
+                raise ValueError(f'priority must be 0-7 or one of {JOURNAL_PRIORITIES}')
+            args += ['-p', str(priority)]
+
+        for key in ('since', 'until'):
+            value = command.get(key)
+            if value is None:
+                continue
+            if isinstance(value, (int, float)):
+                value = f'@{int(value)}'  # Unix timestamp
+            elif not isinstance(value, str):
+                raise ValueError(f'Invalid {key}: {value}')
+            args.append(f'--{key}={value}')
+
+        if command.get('follow'):
+            args.append('-f')
+        return args
+
+    def can_read_journal(self):
+        """User hiện tại đọc được system journal không (root hoặc thuộc JOURNAL_GROUPS)"""
+        if os.geteuid() == 0:
+            return True
+        groups = set(os.getgroups())
+        for name in JOURNAL_GROUPS:
+            try:
+                if grp.getgrnam(name).gr_gid in groups:
+                    return True
+            except KeyError:
+                continue
+        return False
+
+    def handle_tail_logs(self, command, client_socket):
+        """
+        Stream journal entries của một custom unit theo batch ('log_entries').
+        cursor: tiếp tục sau entry cuối đã nhận; priority/since/until lọc phía journalctl;
+        follow: tiếp tục gửi entries mới tới khi stop_logs hoặc client ngắt kết nối
+        """
+        try:
+            args = self.build_journal_command(command)
+        except ValueError as e:
+            self.send_response(client_socket, {
+                'action': 'logs_error',
+                'unit': command.get('unit'),
+                'error': str(e)
+            })
+            return
+
+        tail_id = uuid.uuid4().hex[:12]
+        request_id = self.current_request_id(client_socket)
+        unit = command.get('unit')
+
+        def send(response):
+            if request_id is not None:
+                response['request_id'] = request_id
+            self.send_response(client_socket, response)
+
+        def on_batch(entries, cursor):
+            send({
+                'action': 'log_entries',
+                'tail_id': tail_id,
+                'unit': unit,
+                'entries': entries,
+                'cursor': cursor
+            })
+
+        password = None
+        if not self.can_read_journal():
+            args = ['sudo', '-S', '-p', ''] + args
+            password = SUDO_PASSWORD
+
+        tail = JournalTail(tail_id, args, on_batch, password)
+        try:
+            tail.start()
+        except OSError as e:
+            self.send_response(client_socket, {
+                'action': 'logs_error',
+                'unit': unit,
+                'error': f'Cannot run journalctl: {e}'
+            })
+            return
+
+        with self.log_tails_lock:
+            self.log_tails[tail_id] = (tail, client_socket)
+
+        def run():
+            try:
+                return_code, stderr = tail.run()
+                send({
+                    'action': 'logs_end',
+                    'tail_id': tail_id,
+                    'unit': unit,
+                    'count': tail.count,
+                    'cursor': tail.last_cursor,
+                    'stopped': tail.stopped,
+                    'return_code': return_code,
+                    'stderr': stderr if return_code and not tail.stopped else ''
+                })
+            except Exception as e:
+                logger.error(f"Log tail {tail_id} failed: {e}")
+                tail.stop()
+                send({
+                    'action': 'logs_error',
+                    'tail_id': tail_id,
+                    'unit': unit,
+                    'error': str(e)
+                })
+            finally:
+                with self.log_tails_lock:
+                    self.log_tails.pop(tail_id, None)
+
+        logger.info(f"Tailing logs of {unit} [{tail_id}] (follow={bool(command.get('follow'))})")
+        self.send_response(client_socket, {
+            'action': 'logs_started',
+            'tail_id': tail_id,
+            'unit': unit,
+            'follow': bool(command.get('follow'))
+        })
+        threading.Thread(target=run, daemon=True).start()
+
+    def handle_stop_logs(self, command, client_socket):
+        tail_id = command.get('tail_id')
+        with self.log_tails_lock:
+            entry = self.log_tails.get(tail_id)
+        if entry:
+            entry[0].stop()
+
+        self.send_response(client_socket, {
+            'action': 'logs_stop_result',
+            'tail_id': tail_id,
+            'found': entry is not None
+        })
+
+    def stop_client_log_tails(self, client_socket):
+        with self.log_tails_lock:
+            tails = [tail for tail, owner in self.log_tails.values() if owner is client_socket]
+        for tail in tails:
+            tail.stop()
+
+    def handle_open_shell(self, command, client_socket):
+        """
+        Mở shell trên PTY (chỉ framed mode). Input và output là FRAME_SHELL_DATA frames
+        mang channel id, 'shell_resize' đổi window size, 'close_shell' hoặc client ngắt kết nối
+        thì shell bị huỷ. Khi shell thoát client nhận 'shell_closed' kèm exit code
+        """
+        try:
+            if client_socket not in self.framed_clients:
+                raise ValueError('open_shell requires length-prefixed framing')
+            cols, rows = self.parse_window_size(command)
+            shell = SHELL_COMMAND if os.path.exists(SHELL_COMMAND[0]) else ['/bin/sh', '-l']
+
+            with self.shell_sessions_lock:
+                if len(self.shell_sessions) >= SHELL_MAX_SESSIONS:
+                    raise ValueError(f'Too many shell sessions (max {SHELL_MAX_SESSIONS})')
+                self.next_shell_channel += 1
+                channel = self.next_shell_channel
+                session = ShellSession(channel, shell, cols, rows, str(command.get('term') or SHELL_DEFAULT_TERM),
+                                       lambda data: self.send_shell_output(session, client_socket, data))
+                session.start()
+                self.shell_sessions[channel] = (session, client_socket)
+
+            # Keystroke echo là các gói nhỏ, không để Nagle giữ lại
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        except Exception as e:
+            logger.error(f"Error opening shell: {e}")
+            self.send_response(client_socket, {'action': 'shell_error', 'error': str(e)})
+            return
+
+        logger.info(f"Shell {channel} opened (pid {session.process.pid}, {cols}x{rows})")
+        self.send_response(client_socket, {
+            'action': 'shell_opened',
+            'channel': channel,
+            'pid': session.process.pid,
+            'cols': cols,
+            'rows': rows
+        })
+        # Relay output chỉ bắt đầu sau shell_opened để client biết channel trước frame đầu tiên
+        threading.Thread(target=self.run_shell_session, args=(session, client_socket), daemon=True).start()
+
+    @staticmethod
+    def parse_window_size(command):
+        cols, rows = command.get('cols', 80), command.get('rows', 24)
+        for key, value in (('cols', cols), ('rows', rows)):
+            if isinstance(value, bool) or not isinstance(value, int) or not 0 < value < 65536:
+                raise ValueError(f'{key} must be an integer between 1 and 65535')
+        return cols, rows
+
+    def run_shell_session(self, session, client_socket):
+        exit_code = None
+        try:
+            exit_code = session.run()
+        except Exception as e:
+            logger.error(f"Shell {session.channel} relay error: {e}")
+            session.close()
+        finally:
+            with self.shell_sessions_lock:
+                self.shell_sessions.pop(session.channel, None)
+
+        logger.info(f"Shell {session.channel} closed (exit code {exit_code})")
+        if client_socket in self.clients:
+            self.send_response(client_socket, {
+                'action': 'shell_closed',
+                'channel': session.channel,
+                'exit_code': exit_code
+            })
+
+    def send_shell_output(self, session, client_socket, data):
+        frame = encode_frame(FRAME_SHELL_DATA, SHELL_DATA_HEADER.pack(session.channel) + data)
+        send_lock = self.send_locks.get(client_socket)
+        try:
+            if send_lock is None:
+                raise ConnectionError('Client disconnected')
+            with send_lock:
+                client_socket.sendall(frame)
+            self.action_stats.add_sent('shell_data', len(frame))
+        except OSError as e:
+            logger.warning(f"Shell {session.channel} output not delivered, closing: {e}")
+            session.close()
+
+    def get_shell_session(self, channel, client_socket):
+        """Session của channel, chỉ client đã mở nó mới dùng được"""
+        with self.shell_sessions_lock:
+            entry = self.shell_sessions.get(channel)
+        if entry is None or entry[1] is not client_socket:
+            raise ValueError(f'Unknown shell channel: {channel}')
+        return entry[0]
+
+    def handle_shell_data(self, payload, client_socket):
+        """Input của shell (framed mode): SHELL_DATA_HEADER + raw bytes"""
+        if len(payload) < SHELL_DATA_HEADER.size:
+            logger.warning("Shell data frame too short")
+            return
+
+        channel, = SHELL_DATA_HEADER.unpack_from(payload)
+        try:
+            self.get_shell_session(channel, client_socket).write(memoryview(payload)[SHELL_DATA_HEADER.size:])
+        except (OSError, ValueError) as e:
+            self.send_response(client_socket, {'action': 'shell_error', 'channel': channel, 'error': str(e)})
+
+    def handle_shell_resize(self, command, client_socket):
+        channel = command.get('channel')
+        try:
+            cols, rows = self.parse_window_size(command)
+            self.get_shell_session(channel, client_socket).resize(cols, rows)
+        except (OSError, ValueError) as e:
+            self.send_response(client_socket, {'action': 'shell_error', 'channel': channel, 'error': str(e)})
+            return
+
+        self.send_response(client_socket, {'action': 'shell_resized', 'channel': channel, 'cols': cols, 'rows': rows})
+
+    def handle_close_shell(self, command, client_socket):
+        channel = command.get('channel')
+        try:
+            session = self.get_shell_session(channel, client_socket)
+            session.close()
+        except ValueError:
+            session = None
+
+        self.send_response(client_socket, {
+            'action': 'shell_close_result',
+            'channel': channel,
+            'found': session is not None
+        })
+
+    def stop_client_shells(self, client_socket):
+        with self.shell_sessions_lock:
+            sessions = [session for session, owner in self.shell_sessions.values() if owner is client_socket]
+        for session in sessions:
+            session.close()
+
+    def get_units_state(self, unit_names):
+        """
+        Lấy trạng thái của nhiều units bằng MỘT lệnh systemctl show.
+        Trả về dict unit -> {'ActiveState', 'SubState', 'UnitFileState', ...}
+        """
+        if not unit_names:
+            return {}
+
+        result = subprocess.run(
+            ['systemctl', 'show', '--property=' + ','.join(UNIT_STATE_PROPERTIES), '--'] + list(unit_names),
+            capture_output=True,
+            text=True,
+            timeout=30
+        )
+
+        # Output: mỗi unit là một block "Key=Value", các block cách nhau bởi dòng trống
+        states = {}
+        for block in result.stdout.strip().split('\n\n'):
+            props = {}
+            for line in block.splitlines():
+                if '=' in line:
+                    key, value = line.split('=', 1)
+                    props[key] = value
+            if props.get('Id'):
+                states[props['Id']] = props
+
+        return states
+
+    def get_unit_description(self, service_path):
+        """Đọc Description= từ unit file, cache theo mtime"""
+        try:
+            mtime = os.stat(service_path).st_mtime_ns
+        except OSError:
+            return "Custom service"
+
+        cached = self.description_cache.get(service_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        description = "Custom service"
+        try:
+            with open(service_path, 'r') as f:
+                for line in f:
+                    if line.strip().startswith('Description='):
+                        description = line.split('=', 1)[1].strip()
+                        break
+        except OSError:
+            pass
+
+        self.description_cache[service_path] = (mtime, description)
+        return description
+
+    def handle_script_cancel(self, command, client_socket):
+        """Huỷ job: đang chờ thì bỏ khỏi queue, đang chạy thì SIGTERM process group"""
+        job_id = command.get('job_id') or command.get('execution_id')
+        state = self.job_scheduler.cancel(job_id)
+
+        if state:
+            logger.info(f"Script cancelled: {job_id} (was {state})")
+
+        self.send_response(client_socket, {
+            'action': 'script_cancel_result',
+            'job_id': job_id,
+            'execution_id': job_id,
+            'found': state is not None,
+            'previous_state': state
+        })
+
+    def handle_job_status(self, command, client_socket):
+        """Trạng thái một job (kể cả job đã xong, còn được giữ kết quả)"""
+        job_id = command.get('job_id')
+        job = self.job_scheduler.get(job_id)
+
+        if job is None:
+            self.send_response(client_socket, {
+                'action': 'job_status_error',
+                'job_id': job_id,
+                'error': f'Unknown job: {job_id}'
+            })
+            return
+
+        self.send_response(client_socket, {
+            'action': 'job_status',
+            'job': job.to_dict(include_output=True)
+        })
+
+    def list_script_jobs(self, client_socket):
+        self.send_response(client_socket, dict(self.job_scheduler.get_stats(), action='job_list',
+                                               jobs=[job.to_dict() for job in self.job_scheduler.list_jobs()]))
+
     def list_custom_services(self, client_socket):
         """Liệt kê custom services từ /etc/systemd/system/"""
         try:
             services = []
-            systemd_dir = '/etc/systemd/system'
-
-            if os.path.exists(systemd_dir):
-                # Danh sách service cần lọc (hệ thống)
-                system_services = {
-                    'dbus.service', 'dbus-', 'systemd-', 'getty@', 'network', 'ssh', 'bluetooth',
-                    'avahi-', 'cups-', 'plymouth-', 'udev-', 'ModemManager', 'NetworkManager',
-                    'accounts-daemon', 'polkit', 'udisks2', 'packagekit', 'snapd',
-                    'rsyslog', 'cron', 'atd', 'smartmontools', 'thermald', 'display', 'chronyd',
-                    'log', 'smartd'
-                }
+            unit_files = self.get_custom_unit_files()
+
+            try:
+                states = self.get_units_state([filename for filename, _ in unit_files])
+            except (OSError, subprocess.SubprocessError) as e:
+                logger.warning(f"Could not get unit states: {e}")
+                states = {}
 
-                for filename in os.listdir(systemd_dir):
-                    if filename.endswith('.service'):
-                        # Bỏ qua system services
-                        is_system = any(sys_service in filename for sys_service in system_services)
-                        if is_system:
-                            continue
-
-                        service_path = os.path.join(systemd_dir, filename)
-                        if os.path.isfile(service_path):
-                            try:
-                                # Lấy status service
-                                result = subprocess.run(
-                                    ['systemctl', 'is-active', filename],
-                                    capture_output=True,
-                                    text=True
-                                )
-                                status = result.stdout.strip()
-
-                                # Lấy enabled status
-                                enabled_result = subprocess.run(
-                                    ['systemctl', 'is-enabled', filename],
-                                    capture_output=True,
-                                    text=True
-                                )
-                                enabled = enabled_result.stdout.strip()
-
-                                # Đọc description từ service file
-                                description = "Custom service"
-                                try:
-                                    with open(service_path, 'r') as f:
-                                        content = f.read()
-                                        for line in content.split('\n'):
-                                            if line.strip().startswith('Description='):
-                                                description = line.split('=', 1)[1].strip()
-                                                break
-                                except:
-                                    pass
-
-                                services.append({
-                                    'name': filename,
-                                    'status': status,
-                                    'enabled': enabled,
-                                    'description': description,
-                                    'path': service_path
-                                })
-
-                            except Exception as e:
-                                logger.warning(f"Could not get status for {filename}: {e}")
-                                services.append({
-                                    'name': filename,
-                                    'status': 'unknown',
-                                    'enabled': 'unknown',
-                                    'description': 'Custom service',
-                                    'path': service_path
-                                })
+            for filename, service_path in unit_files:
+                state = states.get(filename, {})
+                services.append({
+                    'name': filename,
+                    'status': state.get('ActiveState') or 'unknown',
+                    'sub_state': state.get('SubState') or 'unknown',
+                    'enabled': state.get('UnitFileState') or 'unknown',
+                    'description': self.get_unit_description(service_path),
+                    'path': service_path
+                })
 
             self.send_response(client_socket, {
                 'action': 'services_list',
@@ -503,6 +5126,25 @@ class RemoteControlService:
                 'error': str(e)
             })
 
+    def handle_watch_services(self, command, client_socket):
+        """Subscribe client nhận service_state_changed events (không cần poll list_services)"""
+        try:
+            units = command.get('services')
+            snapshot = self.service_watcher.subscribe(client_socket, units)
+            self.send_response(client_socket, {
+                'action': 'watch_started',
+                'services': snapshot,
+                'mode': 'dbus' if self.service_watcher.use_dbus else 'polling',
+                'timestamp': time.time()
+            })
+
+        except Exception as e:
+            logger.error(f"Error starting service watch: {e}")
+            self.send_response(client_socket, {
+                'action': 'service_error',
+                'error': str(e)
+            })
+
     def handle_service_management(self, command, client_socket):
         """Quản lý services (start/stop/restart)"""
         try:
@@ -547,15 +5189,22 @@ class RemoteControlService:
                         timeout=30
                     )
                 else:
-                    # Use echo password | sudo -S for non-interactive sudo
-                    cmd = f"echo '{SUDO_PASSWORD}' | sudo -S systemctl {service_action} {service_name}"
-                    result = subprocess.run(
-                        cmd,
-                        shell=True,
-                        capture_output=True,
-                        text=True,
-                        timeout=30
-                    )
+                    # Ưu tiên privileged helper, fallback về echo password | sudo -S
+                    response = self.privileged_helper.call('systemctl', verb=service_action, unit=service_name)
+                    if response is not None and response.get('ok'):
+                        result = subprocess.CompletedProcess(['systemctl', service_action, service_name],
+                                                             response['return_code'], response['stdout'], response['stderr'])
+                    elif response is not None:
+                        result = subprocess.CompletedProcess([], 1, '', response.get('error', ''))
+                    else:
+                        cmd = f"echo '{SUDO_PASSWORD}' | sudo -S systemctl {service_action} {service_name}"
+                        result = subprocess.run(
+                            cmd,
+                            shell=True,
+                            capture_output=True,
+                            text=True,
+                            timeout=30
+                        )
 
                 # Get current status after action
                 status_result = subprocess.run(
@@ -639,6 +5288,9 @@ class RemoteControlService:
         # Setup mDNS advertisement
         self.setup_mdns_advertisement()
 
+        self.file_index.start()
+        self.telemetry.start()
+
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((HOST, PORT))
@@ -667,7 +5319,10 @@ class RemoteControlService:
         for ext, directory in ALLOWED_EXTENSIONS.items():
             print(f"   {ext:<10} → {directory}")
         print(f"📦 Max file size: {MAX_FILE_SIZE // (1024*1024)}MB")
-        print(f"🔐 Auto sudo: Enabled (password configured)")
+        if self.privileged_helper.available():
+            print(f"🔐 Privileged helper: {HELPER_SOCKET_PATH}")
+        else:
+            print(f"🔐 Auto sudo: Enabled (password configured, helper not running)")
         print(f"{'='*60}\n")
 
         logger.info(f"Remote Control Service listening on {HOST}:{PORT}")